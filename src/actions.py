@@ -2,25 +2,29 @@ import random
 import re
 
 from dataclasses import dataclass
-from typing import List, Type
-from pathlib import Path
-
-from anchorpy import Program, Idl, Provider
+from typing import List, Optional, Type
 
 from solana.rpc.core import RPCException
 from solders.pubkey import Pubkey  # type: ignore
 
 from driftpy.admin import Admin
-from driftpy.drift_client import DEFAULT_TX_OPTIONS
-from driftpy.setup.helpers import set_price_feed
 from driftpy.constants.numeric_constants import PRICE_PRECISION
 
+from src.metrics import metrics
+from src.oracles import get_oracle_controller, oracle_source_multiplier
+from src.preflight import PreflightCache
+from src.recorder import recorded_action
+
 
 @dataclass
 class Action:
     market_index: int
 
-    async def execute(self, admin: Admin):
+    # metrics key, not a dataclass field
+    event_name = "action"
+
+    async def execute(self, admin: Admin, preflight: Optional[PreflightCache] = None):
+        """Returns the tx signature on success and None otherwise"""
         raise NotImplementedError("Each action must implement an execute method.")
 
 
@@ -28,14 +32,24 @@ class Action:
 class UpdateCurveAction(Action):
     new_peg_candidate: int
 
-    async def execute(self, admin: Admin):
+    event_name = "update_curve"
+
+    @recorded_action
+    async def execute(self, admin: Admin, preflight: Optional[PreflightCache] = None):
         perp_market = admin.get_perp_market_account(self.market_index)
         print(f"updating curve for market: {self.market_index} old peg: {perp_market.amm.peg_multiplier} new peg candidate: {self.new_peg_candidate}")  # type: ignore
+        if preflight is not None:
+            ix = await admin.repeg_curve_ix(self.new_peg_candidate, self.market_index)
+            if not await passes_preflight(preflight, admin, ix, self.event_name):
+                return
         try:
-            sig = (
-                await admin.repeg_curve(self.new_peg_candidate, self.market_index)
-            ).tx_sig
+            async with metrics.track(self.event_name, admin.connection) as sample:
+                sig = (
+                    await admin.repeg_curve(self.new_peg_candidate, self.market_index)
+                ).tx_sig
+                sample.sig = sig
             print(f"updated peg for {self.market_index}: {sig}")
+            return sig
         except RPCException as e:
             print(f"failed to update peg for {self.market_index}")
             print(f"error message: {extract_error(e.args[0])}")  # type: ignore
@@ -45,12 +59,22 @@ class UpdateCurveAction(Action):
 class UpdateKAction(Action):
     sqrt_k: int
 
-    async def execute(self, admin: Admin):
+    event_name = "update_k"
+
+    @recorded_action
+    async def execute(self, admin: Admin, preflight: Optional[PreflightCache] = None):
         perp_market = admin.get_perp_market_account(self.market_index)
         print(f"updating sqrt_k for market: {self.market_index} old sqrt_k: {perp_market.amm.sqrt_k} new sqrt_k: {self.sqrt_k}")  # type: ignore
+        if preflight is not None:
+            ix = await admin.update_k_ix(self.sqrt_k, self.market_index)
+            if not await passes_preflight(preflight, admin, ix, self.event_name):
+                return
         try:
-            sig = (await admin.update_k(self.sqrt_k, self.market_index)).tx_sig
+            async with metrics.track(self.event_name, admin.connection) as sample:
+                sig = (await admin.update_k(self.sqrt_k, self.market_index)).tx_sig
+                sample.sig = sig
             print(f"updated sqrt_k for {self.market_index}: {sig}")
+            return sig
         except RPCException as e:
             print(f"failed to update sqrt_k for {self.market_index}")
             print(f"error message: {extract_error(e.args[0])}")  # type: ignore
@@ -61,12 +85,18 @@ class UpdateImfAction(Action):
     imf_factor: int
     upnl_imf_factor: int
 
-    async def execute(self, admin: Admin):
+    event_name = "update_imf"
+
+    @recorded_action
+    async def execute(self, admin: Admin, preflight: Optional[PreflightCache] = None):
         perp_market = admin.get_perp_market_account(self.market_index)
         print(f"updating imf for market: {self.market_index} old imf: {perp_market.imf_factor} new imf: {self.imf_factor} old upnl_imf: {perp_market.unrealized_pnl_imf_factor} new upnl_imf: {self.upnl_imf_factor}")  # type: ignore
         try:
-            sig = await admin.update_perp_market_imf_factor(self.market_index, self.imf_factor, self.upnl_imf_factor)  # type: ignore
+            async with metrics.track(self.event_name, admin.connection) as sample:
+                sig = await admin.update_perp_market_imf_factor(self.market_index, self.imf_factor, self.upnl_imf_factor)  # type: ignore
+                sample.sig = sig
             print(f"updated imf factors for {self.market_index}: {sig}")
+            return sig
         except RPCException as e:
             print(f"failed to update imf factors for {self.market_index}")
             print(f"error message: {extract_error(e.args[0])}")  # type: ignore
@@ -77,30 +107,60 @@ class UpdateOracleAction(Action):
     oracle: Pubkey
     oracle_price: int
 
-    async def execute(self, admin: Admin):
+    event_name = "update_oracle"
+
+    @recorded_action
+    async def execute(self, admin: Admin, preflight: Optional[PreflightCache] = None):
         price = admin.get_oracle_price_data_for_perp_market(self.market_index).price  # type: ignore
+        oracle_source = admin.get_perp_market_account(self.market_index).amm.oracle_source  # type: ignore
         print(
             f"updating oracle for market: {self.market_index} old price: {price} new price: {self.oracle_price}"
         )
         try:
-            sig = await set_oracle_price(admin, self.oracle, self.oracle_price)
+            async with metrics.track(self.event_name, admin.connection) as sample:
+                sig = await set_oracle_price(
+                    admin,
+                    self.oracle,
+                    self.oracle_price,
+                    oracle_source_multiplier(oracle_source),
+                )
+                sample.sig = sig
             print(f"updated oracle price for {self.market_index}: {sig}")
+            return sig
         except RPCException as e:
             print(f"failed to update oracle price for {self.market_index}")
             print(f"error message: {extract_error(e.args[0])}")  # type: ignore
 
 
-def get_action(admin: Admin) -> Action:
-    action_classes: List[Type[Action]] = [
-        UpdateCurveAction,
-        UpdateKAction,
-        UpdateImfAction,
-        UpdateOracleAction,
-    ]
-    chosen_action_class = random.choice(action_classes)
-    market_index = random.randint(0, 23)
+ACTION_CLASSES: List[Type[Action]] = [
+    UpdateCurveAction,
+    UpdateKAction,
+    UpdateImfAction,
+    UpdateOracleAction,
+]
+
+
+def get_action(admin: Admin, rng: Optional[random.Random] = None) -> Action:
+    """Draws a random action on one of the admin's loaded perp markets"""
+    rng = rng if rng is not None else random.Random()
+    chosen_action_class = rng.choice(ACTION_CLASSES)
+    market_index = rng.choice(perp_market_indexes(admin))
+    pct_delta = rng.uniform(-0.1, 0.1)
+    return build_action(admin, chosen_action_class, market_index, pct_delta)
+
+
+def perp_market_indexes(admin: Admin) -> list[int]:
+    return sorted(market.market_index for market in admin.get_perp_market_accounts())
+
+
+def build_action(
+    admin: Admin,
+    chosen_action_class: Type[Action],
+    market_index: int,
+    pct_delta: float,
+) -> Action:
+    """Builds `chosen_action_class` moving the market's current value by `pct_delta`"""
     perp_market = admin.get_perp_market_account(market_index)
-    pct_delta = random.uniform(-0.1, 0.1)
 
     if chosen_action_class == UpdateCurveAction:
         old_peg = perp_market.amm.peg_multiplier  # type: ignore
@@ -136,6 +196,16 @@ def get_action(admin: Admin) -> Action:
         )
 
 
+async def passes_preflight(
+    preflight: PreflightCache, admin: Admin, ix, event_name: str
+) -> bool:
+    outcome = (await preflight.check([(admin.authority, [ix])]))[0]
+    if not outcome.ok:
+        cached = " (cached)" if outcome.cached else ""
+        print(f"skipping {event_name}, preflight failed{cached}: {outcome.error_message}")
+    return outcome.ok
+
+
 def extract_error(logs):
     error_pattern = re.compile(r"Error Message: (.+)")
     for log in logs.data.logs:
@@ -146,17 +216,20 @@ def extract_error(logs):
     return None
 
 
-async def set_oracle_price(admin: Admin, oracle: Pubkey, price: int):
-    file_path = Path("src/pyth.json")
-    raw = file_path.read_text()
-    idl = Idl.from_json(raw)
-    provider = Provider(admin.connection, admin.wallet, DEFAULT_TX_OPTIONS)
-    program = Program(
-        idl,
-        Pubkey.from_string("FsJ3A3u2vn5cTVofAjvy6y5kwABJAqYWpe4975bi2epH"),
-        provider,
-    )
+async def set_oracle_price(
+    admin: Admin, oracle: Pubkey, price: int, multiplier: int = 1
+):
+    """`multiplier` is the scale of Pyth1K/Pyth1M sources, see `src.oracles`"""
     price_normalized = price / PRICE_PRECISION
     print(f"setting price (normalized) {price_normalized}")
-    sig = await set_price_feed(program, oracle, price_normalized)
-    return sig
+    return await get_oracle_controller(admin).set_price(oracle, price, multiplier)
+
+
+async def set_oracle_prices(
+    admin: Admin,
+    prices: dict[Pubkey, int],
+    multipliers: Optional[dict[Pubkey, int]] = None,
+):
+    """Sets many oracles at once, packed into as few txs as fit"""
+    print(f"setting {len(prices)} oracle prices")
+    return await get_oracle_controller(admin).set_prices(prices, multipliers)
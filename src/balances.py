@@ -0,0 +1,70 @@
+import struct
+
+from dataclasses import dataclass
+from typing import Optional
+
+from solana.rpc.async_api import AsyncClient
+
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.types import SpotMarketAccount
+
+from src.oracles import ACCOUNTS_PER_REQUEST
+
+# an spl token account is mint (32) | owner (32) | amount (u64 le) | ...
+SPL_TOKEN_AMOUNT_OFFSET = 64
+
+
+@dataclass
+class VaultBalances:
+    """Ui amounts (tokens), None if the vault account does not exist"""
+
+    market_index: int
+    spot_vault_balance: Optional[float]
+    insurance_fund_balance: Optional[float]
+
+
+def parse_token_amount(data: bytes) -> int:
+    return struct.unpack_from("<Q", data, SPL_TOKEN_AMOUNT_OFFSET)[0]
+
+
+async def get_token_amounts(
+    connection: AsyncClient, accounts: list[Pubkey]
+) -> list[Optional[int]]:
+    amounts: list[Optional[int]] = []
+    for i in range(0, len(accounts), ACCOUNTS_PER_REQUEST):
+        chunk = accounts[i : i + ACCOUNTS_PER_REQUEST]
+        resp = await connection.get_multiple_accounts(chunk)
+        amounts += [
+            parse_token_amount(account.data) if account is not None else None
+            for account in resp.value
+        ]
+    return amounts
+
+
+async def get_vault_balances(
+    connection: AsyncClient, spot_markets: list[SpotMarketAccount]
+) -> dict[int, VaultBalances]:
+    """
+    Spot vault and insurance fund vault balances of every market, read in one
+    getMultipleAccounts (per 50 markets) instead of two rpc calls per market.
+    """
+    vaults = [market.vault for market in spot_markets]
+    vaults += [market.insurance_fund.vault for market in spot_markets]
+    amounts = await get_token_amounts(connection, vaults)
+    spot_vault_amounts = amounts[: len(spot_markets)]
+    insurance_fund_amounts = amounts[len(spot_markets) :]
+
+    def ui_amount(amount: Optional[int], market: SpotMarketAccount):
+        return amount / 10**market.decimals if amount is not None else None
+
+    return {
+        market.market_index: VaultBalances(
+            market.market_index,
+            ui_amount(spot_vault_amount, market),
+            ui_amount(insurance_fund_amount, market),
+        )
+        for market, spot_vault_amount, insurance_fund_amount in zip(
+            spot_markets, spot_vault_amounts, insurance_fund_amounts
+        )
+    }
@@ -0,0 +1,231 @@
+"""
+Throughput benchmarks against the local validator started by start_local.sh.
+
+    poetry run python -m src.bench --market-index 9 --concurrency 1,4,16,64
+
+Every agent event type in src/main.py and every admin action in src/actions.py
+is run at each concurrency level. Results (sustained tps, latency percentiles,
+failure rates) are written as JSON so runs can be compared. ClosePositionEvent
+closes the positions it benchmarks, so it runs last and every concurrency level
+gets agents no earlier level touched; restart the validator before re-running.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Optional, Type
+
+from solana.rpc.async_api import AsyncClient
+
+from driftpy.admin import Admin
+from driftpy.drift_client import DriftClient
+
+from src.actions import ACTION_CLASSES, Action, build_action
+from src.experiments import load_subaccounts
+from src.helpers import load_local_users, load_nonidle_users_for_market
+from src.main import (
+    ClosePositionEvent,
+    Event,
+    SettleLPEvent,
+    SettlePnLEvent,
+    _send_ix,
+)
+from src.metrics import percentiles
+
+# returns True on success, False on failure and None when there was nothing to do
+Op = Callable[[], Awaitable[Optional[bool]]]
+
+EVENT_CLASSES: list[Type[Event]] = [SettleLPEvent, SettlePnLEvent, ClosePositionEvent]
+# events that leave nothing for a second run on the same agents
+DESTRUCTIVE_EVENTS: set[Type[Event]] = {ClosePositionEvent}
+
+
+@dataclass
+class BenchResult:
+    name: str
+    kind: str
+    concurrency: int
+    ops: int
+    succeeded: int
+    failed: int
+    skipped: int
+    wall_time_s: float
+    latency_s: dict = field(default_factory=dict)
+
+    @property
+    def tps(self) -> float:
+        return self.succeeded / self.wall_time_s if self.wall_time_s > 0 else 0.0
+
+    @property
+    def failure_rate(self) -> float:
+        attempted = self.succeeded + self.failed
+        return self.failed / attempted if attempted > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        result = asdict(self)
+        result["tps"] = self.tps
+        result["failure_rate"] = self.failure_rate
+        return result
+
+
+async def run_level(
+    name: str, kind: str, ops: list[Op], concurrency: int
+) -> BenchResult:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(op: Op) -> Optional[bool]:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await op()
+            except Exception as e:
+                print(f"{name} failed: {e}")
+                ok = False
+            if ok is not None:
+                latencies.append(time.perf_counter() - start)
+            return ok
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[timed(op) for op in ops])
+    wall_time = time.perf_counter() - start
+
+    result = BenchResult(
+        name,
+        kind,
+        concurrency,
+        len(ops),
+        len([r for r in results if r is True]),
+        len([r for r in results if r is False]),
+        len([r for r in results if r is None]),
+        wall_time,
+        percentiles(latencies),
+    )
+    print(
+        f"{name:<16} c={concurrency:<4} {result.succeeded}/{result.ops} ok "
+        f"{result.tps:.1f} tps, failure rate {result.failure_rate:.2%}"
+    )
+    return result
+
+
+def event_ops(
+    agents: list[DriftClient], event_class: Type[Event], market_index: int, n: int
+) -> list[Op]:
+    # one op per agent so no two ops race on an agent's active subaccount
+    ops = []
+    for agent in agents[:n]:
+        sub_account_id = agent.sub_account_ids[0]
+        timestamp = int(time.time())
+        event = event_class(timestamp, sub_account_id, market_index)  # type: ignore
+
+        async def op(agent=agent, event=event, sub_account_id=sub_account_id):
+            agent.switch_active_user(sub_account_id)
+            ix = await event.run_sdk(agent)
+            if ix is None:
+                return None
+            failed, _, _ = await _send_ix(
+                agent, ix, event._event_name, silent_fail=True, silent_success=True
+            )
+            return failed == 0
+
+        ops.append(op)
+    return ops
+
+
+def action_ops(
+    admin: Admin,
+    action_class: Type[Action],
+    market_index: int,
+    n: int,
+    rng: random.Random,
+) -> list[Op]:
+    ops = []
+    for _ in range(n):
+        # small moves so repeated actions keep the market valid
+        pct_delta = rng.uniform(-0.01, 0.01)
+        action = build_action(admin, action_class, market_index, pct_delta)
+
+        async def op(action=action):
+            return (await action.execute(admin)) is not None
+
+        ops.append(op)
+    return ops
+
+
+async def run_benchmarks(
+    url: str,
+    market_index: int,
+    concurrency_levels: list[int],
+    ops_per_level: int,
+    seed: int,
+) -> dict:
+    connection = AsyncClient(url)
+    _, admin = await load_local_users(None, connection, num_users=1)
+    agents = await load_subaccounts(
+        await load_nonidle_users_for_market(admin, market_index)
+    )
+    rng = random.Random(seed)
+
+    results = []
+    for action_class in ACTION_CLASSES:
+        for concurrency in concurrency_levels:
+            await admin.account_subscriber.update_cache()
+            ops = action_ops(admin, action_class, market_index, ops_per_level, rng)
+            results.append(
+                await run_level(action_class.event_name, "action", ops, concurrency)
+            )
+
+    # close_position is destructive so it goes last
+    for event_class in EVENT_CLASSES:
+        event_name: str = event_class._event_name  # type: ignore
+        unused = agents
+        for concurrency in concurrency_levels:
+            ops = event_ops(unused, event_class, market_index, ops_per_level)
+            if event_class in DESTRUCTIVE_EVENTS:
+                # later levels must not re-run on positions already closed
+                unused = unused[len(ops) :]
+            if len(ops) == 0:
+                print(f"{event_name:<16} c={concurrency:<4} skipped, no agents left")
+                continue
+            results.append(await run_level(event_name, "event", ops, concurrency))
+
+    return {
+        "commit": os.environ.get("COMMIT"),
+        "created_at": time.time(),
+        "rpc": url,
+        "market_index": market_index,
+        "agents": len(agents),
+        "ops_per_level": ops_per_level,
+        "seed": seed,
+        "results": [result.to_dict() for result in results],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8899")
+    parser.add_argument("--market-index", type=int, default=9)
+    parser.add_argument("--concurrency", default="1,4,16,64")
+    parser.add_argument("--ops", type=int, default=64, help="ops per level")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    report = await run_benchmarks(
+        args.url,
+        args.market_index,
+        [int(c) for c in args.concurrency.split(",")],
+        args.ops,
+        args.seed,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"benchmark results written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from typing import Optional, Sequence, Union
+
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.commitment import Commitment, Confirmed
+from solana.rpc.types import TxOpts
+
+from solana.transaction import Transaction
+
+from solders.address_lookup_table_account import AddressLookupTableAccount  # type: ignore
+from solders.hash import Hash  # type: ignore
+from solders.instruction import Instruction  # type: ignore
+from solders.keypair import Keypair  # type: ignore
+from solders.pubkey import Pubkey  # type: ignore
+from solders.transaction import VersionedTransaction  # type: ignore
+
+from driftpy.drift_client import DEFAULT_TX_OPTIONS
+from driftpy.tx.standard_tx_sender import StandardTxSender
+from driftpy.tx.types import TxSigAndSlot
+
+from src.recorder import recorder
+
+
+class BlockhashProvider:
+    """
+    Serves a recent blockhash from memory and refreshes it on a timer, so
+    thousands of clients sending in parallel share one `getLatestBlockhash`
+    every `refresh_interval` seconds instead of one per tx.
+
+    A blockhash stays valid for ~150 slots (~60s), far longer than the
+    refresh interval. Note that re-sending an identical tx from the same
+    signer within one refresh window yields the same signature.
+    """
+
+    def __init__(
+        self,
+        connection: AsyncClient,
+        refresh_interval: float = 5.0,
+        commitment: Commitment = Confirmed,
+    ):
+        self.connection = connection
+        self.refresh_interval = refresh_interval
+        self.commitment = commitment
+        self.blockhash: Optional[Hash] = None
+        self.last_refresh = 0.0
+        self.lock = asyncio.Lock()
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> Hash:
+        resp = await self.connection.get_latest_blockhash(self.commitment)
+        self.blockhash = resp.value.blockhash
+        self.last_refresh = time.monotonic()
+        return self.blockhash
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"failed to refresh blockhash: {e}")
+
+    def is_stale(self) -> bool:
+        # the timer keeps this fresh, this only guards against a stalled loop
+        return (
+            self.blockhash is None
+            or time.monotonic() - self.last_refresh > 2 * self.refresh_interval
+        )
+
+    async def get_blockhash(self) -> Hash:
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._refresh_loop())
+
+        if self.is_stale():
+            # single flight: concurrent callers wait for one fetch
+            async with self.lock:
+                if self.is_stale():
+                    await self.refresh()
+
+        return self.blockhash  # type: ignore
+
+    def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+
+
+_providers: dict[str, BlockhashProvider] = {}
+
+
+def get_blockhash_provider(connection: AsyncClient) -> BlockhashProvider:
+    """Returns the process wide provider for the connection's rpc endpoint"""
+    endpoint = connection._provider.endpoint_uri
+    if endpoint not in _providers:
+        _providers[endpoint] = BlockhashProvider(connection)
+    return _providers[endpoint]
+
+
+def reset_blockhash_providers():
+    """Drops all providers, e.g. before reusing an endpoint after a validator restart"""
+    for provider in _providers.values():
+        provider.stop()
+    _providers.clear()
+
+
+class SharedBlockhashTxSender(StandardTxSender):
+    """
+    `StandardTxSender` that takes its blockhash from a `BlockhashProvider`.
+    Also the point where agent instructions are handed to the run recorder.
+    """
+
+    def __init__(
+        self,
+        connection: AsyncClient,
+        opts: TxOpts = DEFAULT_TX_OPTIONS,
+        blockhash_provider: Optional[BlockhashProvider] = None,
+    ):
+        super().__init__(connection, opts)
+        self.blockhash_provider = (
+            blockhash_provider
+            if blockhash_provider is not None
+            else get_blockhash_provider(connection)
+        )
+        # id(tx) -> (payer, ixs) for txs built while the recorder is active
+        self.recording: dict[int, tuple[Pubkey, Sequence[Instruction]]] = {}
+
+    async def get_blockhash(self) -> Hash:
+        return await self.blockhash_provider.get_blockhash()
+
+    async def fetch_latest_blockhash(self) -> Hash:
+        return await self.blockhash_provider.get_blockhash()
+
+    async def get_legacy_tx(
+        self,
+        ixs: Sequence[Instruction],
+        payer: Keypair,
+        additional_signers: Optional[Sequence[Keypair]],
+    ) -> Transaction:
+        tx = await super().get_legacy_tx(ixs, payer, additional_signers)
+        if recorder.active:
+            self.recording[id(tx)] = (payer.pubkey(), list(ixs))
+        return tx
+
+    async def get_versioned_tx(
+        self,
+        ixs: Sequence[Instruction],
+        payer: Keypair,
+        lookup_tables: Sequence[AddressLookupTableAccount],
+        additional_signers: Optional[Sequence[Keypair]],
+    ) -> VersionedTransaction:
+        tx = await super().get_versioned_tx(
+            ixs, payer, lookup_tables, additional_signers
+        )
+        if recorder.active:
+            self.recording[id(tx)] = (payer.pubkey(), list(ixs))
+        return tx
+
+    async def send(self, tx: Union[Transaction, VersionedTransaction]) -> TxSigAndSlot:
+        recording = self.recording.pop(id(tx), None)
+        if recording is None:
+            return await super().send(tx)
+        try:
+            result = await super().send(tx)
+        except Exception as e:
+            recorder.record_instructions(*recording, error=e)
+            raise
+        recorder.record_instructions(*recording, result.tx_sig, result.slot)
+        return result
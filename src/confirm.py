@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.commitment import Commitment, Confirmed
+
+from solders.signature import Signature  # type: ignore
+from solders.transaction_status import TransactionConfirmationStatus  # type: ignore
+
+# getSignatureStatuses rejects requests with more than 256 signatures
+MAX_SIGNATURE_STATUS_BATCH = 256
+
+COMMITMENT_RANK = {
+    "processed": 0,
+    "confirmed": 1,
+    "finalized": 2,
+}
+
+
+def status_rank(status: TransactionConfirmationStatus) -> int:
+    # solders statuses are not hashable but convert to 0/1/2 in commitment order
+    return int(status)
+
+
+@dataclass
+class ConfirmationResult:
+    sig: Signature
+    confirmed: bool
+    slot: Optional[int] = None
+    err: Any = None
+    status: Optional[TransactionConfirmationStatus] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.confirmed and self.err is None
+
+
+def to_signature(sig: Union[Signature, str, Any]) -> Signature:
+    """Accepts a `Signature`, its base58 string or a `TxSigAndSlot`."""
+    if isinstance(sig, Signature):
+        return sig
+    if hasattr(sig, "tx_sig"):
+        return to_signature(sig.tx_sig)
+    return Signature.from_string(str(sig))
+
+
+@dataclass
+class _Pending:
+    future: asyncio.Future
+    deadline: float
+
+
+class SignatureConfirmer:
+    """
+    Collects pending signatures and resolves them from batched
+    `getSignatureStatuses` polls instead of one `solana confirm` per tx.
+
+    A single background task runs while there are pending signatures and
+    exits once everything has resolved, so no explicit shutdown is needed.
+    """
+
+    def __init__(
+        self,
+        connection: AsyncClient,
+        commitment: Commitment = Confirmed,
+        poll_interval: float = 0.4,
+        timeout: float = 60.0,
+        batch_size: int = MAX_SIGNATURE_STATUS_BATCH,
+    ):
+        assert 0 < batch_size <= MAX_SIGNATURE_STATUS_BATCH
+        self.connection = connection
+        self.commitment_rank = COMMITMENT_RANK[str(commitment)]
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.pending: dict[Signature, _Pending] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+
+    def submit(
+        self, sig: Union[Signature, str, Any], timeout: Optional[float] = None
+    ) -> asyncio.Future:
+        sig = to_signature(sig)
+        if sig in self.pending:
+            return self.pending[sig].future
+
+        future = asyncio.get_running_loop().create_future()
+        timeout = timeout if timeout is not None else self.timeout
+        self.pending[sig] = _Pending(future, time.monotonic() + timeout)
+
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(self._poll_loop())
+
+        return future
+
+    async def confirm(
+        self, sig: Union[Signature, str, Any], timeout: Optional[float] = None
+    ) -> ConfirmationResult:
+        return await self.submit(sig, timeout)
+
+    async def confirm_all(
+        self, sigs: list, timeout: Optional[float] = None
+    ) -> list[ConfirmationResult]:
+        return await asyncio.gather(*[self.submit(sig, timeout) for sig in sigs])
+
+    def _resolve(self, sig: Signature, result: ConfirmationResult):
+        pending = self.pending.pop(sig, None)
+        if pending is not None and not pending.future.done():
+            pending.future.set_result(result)
+
+    async def _poll_batch(self, sigs: list[Signature]):
+        try:
+            resp = await self.connection.get_signature_statuses(sigs)
+        except Exception as e:
+            print(f"failed to fetch signature statuses: {e}")
+            return
+
+        for sig, status in zip(sigs, resp.value):
+            if status is None or status.confirmation_status is None:
+                continue
+            if status_rank(status.confirmation_status) < self.commitment_rank:
+                continue
+            self._resolve(
+                sig,
+                ConfirmationResult(
+                    sig,
+                    True,
+                    status.slot,
+                    status.err,
+                    status.confirmation_status,
+                ),
+            )
+
+    async def _poll_loop(self):
+        while len(self.pending) > 0:
+            sigs = list(self.pending.keys())
+            batches = [
+                sigs[i : i + self.batch_size]
+                for i in range(0, len(sigs), self.batch_size)
+            ]
+            await asyncio.gather(*[self._poll_batch(batch) for batch in batches])
+
+            now = time.monotonic()
+            for sig, pending in list(self.pending.items()):
+                if pending.deadline < now:
+                    self._resolve(sig, ConfirmationResult(sig, False))
+
+            if len(self.pending) > 0:
+                await asyncio.sleep(self.poll_interval)
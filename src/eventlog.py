@@ -0,0 +1,223 @@
+"""
+Columnar event log: one table per `Event` subclass, stored as a directory of
+`.npz` chunks per table so millions of events can be written and streamed
+back without pandas or per-row json.
+
+    log/
+        settle_pnl/000000.npz   # columns: seq, timestamp, user_index, market_index
+        settle_lp/000000.npz
+        ...
+
+Column dtypes come from the event's dataclass field types. Every row carries a
+global `seq` so the reader can merge the tables back into recorded order.
+"""
+import heapq
+import json
+import os
+
+from dataclasses import fields
+from typing import Any, Iterable, Iterator, Optional, Type
+
+import numpy as np
+
+from src.main import Event
+
+DEFAULT_CHUNK_SIZE = 100_000
+
+COLUMN_DTYPES: dict[Any, Any] = {
+    int: np.int64,
+    float: np.float64,
+    bool: np.bool_,
+    str: np.str_,
+}
+
+
+def event_classes() -> dict[str, Type[Event]]:
+    """Every loaded `Event` subclass keyed by its `_event_name`"""
+    classes = {}
+    pending = list(Event.__subclasses__())
+    while len(pending) > 0:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        name = getattr(cls, "_event_name", None)
+        if name is not None:
+            classes[name] = cls
+    return classes
+
+
+def event_columns(event_class: Type[Event]) -> list[tuple[str, Any]]:
+    # _event_name is constant per table so it is implied by the table name
+    return [(f.name, f.type) for f in fields(event_class) if f.name != "_event_name"]
+
+
+def _to_column(values: list, field_type: Any) -> np.ndarray:
+    dtype = COLUMN_DTYPES.get(field_type)
+    if dtype is not None:
+        try:
+            return np.asarray(values, dtype=dtype)
+        except OverflowError:
+            # u128 amounts do not fit in int64, keep them exact as strings
+            return np.asarray([str(v) for v in values], dtype=np.str_)
+    return np.asarray([json.dumps(v, default=str) for v in values], dtype=np.str_)
+
+
+def _from_column(column: np.ndarray, field_type: Any) -> list:
+    if field_type in COLUMN_DTYPES:
+        values = column.tolist()
+        if column.dtype.kind == "U" and field_type is not str:
+            return [field_type(v) for v in values]
+        return values
+    return [json.loads(v) for v in column.tolist()]
+
+
+class EventTableWriter:
+    def __init__(self, path: str, event_class: Type[Event], chunk_size: int):
+        self.path = path
+        self.event_class = event_class
+        self.columns = event_columns(event_class)
+        self.chunk_size = chunk_size
+        self.seqs: list[int] = []
+        self.rows: list[Event] = []
+        self.chunks = 0
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, seq: int, event: Event):
+        self.seqs.append(seq)
+        self.rows.append(event)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        arrays = {"seq": np.asarray(self.seqs, dtype=np.int64)}
+        for name, field_type in self.columns:
+            arrays[name] = _to_column(
+                [getattr(event, name) for event in self.rows], field_type
+            )
+        chunk_path = os.path.join(self.path, f"{self.chunks:06d}.npz")
+        np.savez_compressed(chunk_path, **arrays)  # type: ignore
+        self.chunks += 1
+        self.seqs = []
+        self.rows = []
+
+
+class EventLogWriter:
+    """
+    Buffers events per class and writes a compressed chunk whenever a table
+    reaches `chunk_size` rows. Use as a context manager or call `close()`.
+    """
+
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.tables: dict[str, EventTableWriter] = {}
+        self.seq = 0
+        os.makedirs(path, exist_ok=True)
+        # continue the sequence when appending to an existing log
+        for name in os.listdir(path):
+            table_path = os.path.join(path, name)
+            if os.path.isdir(table_path):
+                for chunk in EventLogReader._chunk_paths(table_path):
+                    with np.load(chunk) as data:
+                        if len(data["seq"]) > 0:
+                            self.seq = max(self.seq, int(data["seq"].max()) + 1)
+
+    def _table(self, event_class: Type[Event]) -> EventTableWriter:
+        name = event_class._event_name  # type: ignore
+        table = self.tables.get(name)
+        if table is None:
+            table_path = os.path.join(self.path, name)
+            table = EventTableWriter(table_path, event_class, self.chunk_size)
+            table.chunks = len(EventLogReader._chunk_paths(table_path))
+            self.tables[name] = table
+        return table
+
+    def append(self, event: Event):
+        self._table(type(event)).append(self.seq, event)
+        self.seq += 1
+
+    def extend(self, events: Iterable[Event]):
+        for event in events:
+            self.append(event)
+
+    def flush(self):
+        for table in self.tables.values():
+            table.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventLogReader:
+    """
+    Streams typed events back out of an event log, one chunk in memory per
+    table at a time.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        classes = event_classes()
+        self.tables: dict[str, Type[Event]] = {}
+        for name in sorted(os.listdir(path)):
+            if not os.path.isdir(os.path.join(path, name)):
+                continue
+            if name not in classes:
+                raise ValueError(f"no Event subclass is registered for table {name}")
+            self.tables[name] = classes[name]
+
+    @staticmethod
+    def _chunk_paths(table_path: str) -> list[str]:
+        if not os.path.isdir(table_path):
+            return []
+        return [
+            os.path.join(table_path, name)
+            for name in sorted(os.listdir(table_path))
+            if name.endswith(".npz")
+        ]
+
+    def _table_rows(self, name: str) -> Iterator[tuple[int, Event]]:
+        event_class = self.tables[name]
+        columns = event_columns(event_class)
+        for chunk_path in self._chunk_paths(os.path.join(self.path, name)):
+            with np.load(chunk_path) as data:
+                # fields added since the chunk was written take their default
+                present = [(c, t) for c, t in columns if c in data.files]
+                seqs = data["seq"].tolist()
+                values = [_from_column(data[c], t) for c, t in present]
+            names = [c for c, _ in present]
+            for seq, row in zip(seqs, zip(*values)):
+                yield seq, event_class(**dict(zip(names, row)))
+
+    def read_table(self, event_class: Type[Event]) -> Iterator[Event]:
+        """Yields the events of one class in recorded order"""
+        name = event_class._event_name  # type: ignore
+        if name not in self.tables:
+            return
+        for _, event in self._table_rows(name):
+            yield event
+
+    def __iter__(self) -> Iterator[Event]:
+        """Yields every event across all tables in recorded order"""
+        streams = [self._table_rows(name) for name in self.tables]
+        for _, event in heapq.merge(*streams, key=lambda row: row[0]):
+            yield event
+
+    def batches(
+        self, batch_size: int, event_class: Optional[Type[Event]] = None
+    ) -> Iterator[list[Event]]:
+        events = iter(self) if event_class is None else self.read_table(event_class)
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
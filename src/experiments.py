@@ -1,11 +1,14 @@
 import asyncio
 import os
 import pathlib
-import subprocess
+import random
 import datetime as dt
 import time
 
 from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
 
 from solana.rpc.async_api import AsyncClient
 
@@ -16,13 +19,25 @@ from anchorpy import Wallet
 
 from driftpy.accounts import get_user_account_public_key
 from driftpy.account_subscription_config import AccountSubscriptionConfig
-from driftpy.types import MarketType, UserAccount, is_variant
+from driftpy.types import MarketType
 from driftpy.drift_client import DriftClient
 from driftpy.drift_user import DriftUser
 from driftpy.address_lookup_table import get_address_lookup_table
 
+from src.balances import get_vault_balances
+from src.confirm import SignatureConfirmer
+from src.preflight import PreflightCache
+from src.recorder import recorder
+from src.registry import RUN_END, RunEntry, RunRegistry, snapshot_slot
+from src.results import ResultsWriter
+from src.sampler import MarketSampler
 from src.slack import SimulationResultBuilder, Slack
-from src.helpers import append_to_csv, load_local_users, load_nonidle_users_for_market
+from src.metrics import metrics
+from src.invariants import InvariantChecker
+from src.liquidator import Liquidator
+from src.orders import OpenOrderIndex
+from src.waiters import WaitTimeoutError, wait_until
+from src.helpers import load_local_users, load_nonidle_users_for_market
 from src.actions import get_action
 from src.scenarios import move_oracle_up_40, move_oracle_down_40
 
@@ -54,20 +69,41 @@ async def load_subaccounts(chs):
 
 
 class Simulator:
-    def __init__(self, sim_results: SimulationResultBuilder):
+    def __init__(
+        self,
+        sim_results: SimulationResultBuilder,
+        preflight: bool = False,
+        record_path: Optional[str] = None,
+        url: str = "http://127.0.0.1:8899",
+        results_path: Optional[str] = None,
+    ):
         self.admin = None
         self.agents: list[DriftClient] = []
-        self.connection = AsyncClient("http://127.0.0.1:8899")
+        self.connection = AsyncClient(url)
+        self.confirmer = SignatureConfirmer(self.connection)
+        self.preflight = PreflightCache(self.connection) if preflight else None
         self.tester = None
         self.sim_results = sim_results
+        self.record_path = record_path
+        if results_path is None:
+            if record_path is not None:
+                results_path = os.path.join(record_path, "results.npz")
+            else:
+                results_path = f"results/{dt.datetime.utcnow():%Y%m%d-%H%M%S}.npz"
+        self.results = ResultsWriter(results_path)
+        self.snapshot_slot: Optional[int] = None
 
     async def setup(self):
+        if self.record_path is not None:
+            await recorder.start(self.record_path, self.connection)
+
         agents, admin = await load_local_users(None, self.connection, num_users=1)
 
         self.admin = admin
 
         slot = (await self.connection.get_slot()).value
         self.sim_results.set_start_slot(slot)
+        self.snapshot_slot = snapshot_slot(admin.get_perp_market_accounts())
 
         users = 0
         # for agent in agents:
@@ -84,15 +120,46 @@ class Simulator:
             for _ in agent.sub_account_ids:
                 users += 1
         self.sim_results.add_total_users(users)
-        await asyncio.sleep(30)
 
-    async def generate_and_execute_action(self):
-        action = get_action(self.admin)
-        await action.execute(self.admin)
+    def register(self, scenario: str, ok: bool = True) -> RunEntry:
+        self.sim_results.write_results(self.results)
+        self.results.close()
+        return RunRegistry().register(
+            scenario, self.snapshot_slot, self.results.path, ok
+        )
+
+    async def finish(self, scenario: str) -> RunEntry:
+        """Records the end of run state of every market and registers the run"""
+        admin = self.admin
+        await admin.account_subscriber.update_cache()  # type: ignore
+        for perp_market in admin.get_perp_market_accounts():  # type: ignore
+            self.results.append(perp_market, RUN_END)
+        spot_markets = admin.get_spot_market_accounts()  # type: ignore
+        for spot_market in spot_markets:
+            self.results.append(spot_market, RUN_END)
+        balances = await get_vault_balances(self.connection, spot_markets)
+        self.results.write_columns(
+            "vault_balance",
+            {
+                "market_index": np.array(list(balances.keys())),
+                "spot_vault_balance": np.array(
+                    [b.spot_vault_balance for b in balances.values()], dtype=float
+                ),
+                "insurance_fund_balance": np.array(
+                    [b.insurance_fund_balance for b in balances.values()], dtype=float
+                ),
+            },
+        )
+        return self.register(scenario)
+
+    async def generate_and_execute_action(self, rng: Optional[random.Random] = None):
+        action = get_action(self.admin, rng)  # type: ignore
+        await action.execute(self.admin, self.preflight)  # type: ignore
 
-    async def experiment(self, num_actions: int):
+    async def experiment(self, num_actions: int, seed: Optional[int] = None):
+        rng = random.Random(seed)
         for _ in range(num_actions):
-            await self.generate_and_execute_action()
+            await self.generate_and_execute_action(rng)
 
     async def create_tester(self):
         print("initializing tester")
@@ -103,11 +170,8 @@ class Simulator:
         sig = (
             await self.connection.request_airdrop(tester_kp.pubkey(), int(10 * 1e9))
         ).value
-        await asyncio.sleep(3)  # give the airdrop a second
-
-        command = ["solana", "confirm", f"{sig}"]
-        output = subprocess.run(command, capture_output=True, text=True).stdout.strip()
-        print(f"airdrop status: {output}")
+        result = await self.confirmer.confirm(sig)
+        print(f"airdrop status: {result.status} (err: {result.err})")
 
         drift_client = DriftClient(
             self.connection,
@@ -117,11 +181,8 @@ class Simulator:
         )
 
         sig = await drift_client.initialize_user()
-        await asyncio.sleep(15)
-
-        command = ["solana", "confirm", f"{sig}"]
-        output = subprocess.run(command, capture_output=True, text=True).stdout.strip()
-        print(f"initialize user status: {output}")
+        result = await self.confirmer.confirm(sig)
+        print(f"initialize user status: {result.status} (err: {result.err})")
 
         await drift_client.subscribe()
         # await drift_client.add_user(0)
@@ -149,101 +210,115 @@ class Simulator:
         print(len(lut.addresses))
 
         market = admin.get_perp_market_account(market_index)  # type: ignore
-        append_to_csv(market, "sim_results.csv", "init market")
+        self.results.append(market, "init market")
 
         usdc_spot_market = admin.get_spot_market_account(0)  # type: ignore
         insurance_vault = usdc_spot_market.insurance_fund  # type: ignore
-        append_to_csv(insurance_vault, "sim_results.csv", "init if")
+        self.results.append(insurance_vault, "init if", spot_market_index=0)
+
+        sampler = MarketSampler(admin, self.results)  # type: ignore
+        sampler.start()
 
-        # tasks = []
+        checker = InvariantChecker(admin)  # type: ignore
+        await checker.refresh()
+        checker.report()
 
-        def orders(user):
-            counter = 0
-            for subaccount in user.sub_account_ids:
-                user_account: UserAccount = user.get_user(subaccount).get_user_account()
-                for order in user_account.orders:
-                    if is_variant(order.market_type, "Perp"):
-                        if order.market_index == market_index:
-                            counter += 1
-            return counter
+        index = OpenOrderIndex(self.agents)
+        await index.refresh_users()
+        targets = index.users(MarketType.Perp(), market_index)
 
         start = time.time()
-        counter = 0
         tasks = []
-        for user in self.agents:
-            await user.account_subscriber.update_cache()
-            for subaccount in user.sub_account_ids:
-                try:
-                    num = orders(user)
-                    if num > 0:
-                        print(
-                            f"canceling orders: {num} for user: {user.authority} market index: {market_index}"
-                        )
-                        tasks.append(
-                            asyncio.create_task(
-                                user.cancel_orders(
-                                    sub_account_id=subaccount,
-                                    market_index=market_index,
-                                    market_type=MarketType.Perp(),
-                                )
-                            )
-                        )
-                        counter += 1
-
-                except Exception as e:
-                    print(e)
-                    raise e
+        for (agent_index, subaccount), num in targets.items():
+            user = self.agents[agent_index]
+            print(
+                f"canceling orders: {num} for user: {user.authority} "
+                f"subaccount: {subaccount} market index: {market_index}"
+            )
+            tasks.append(
+                asyncio.create_task(
+                    user.cancel_orders(
+                        sub_account_id=subaccount,
+                        market_index=market_index,
+                        market_type=MarketType.Perp(),
+                    )
+                )
+            )
 
         await asyncio.gather(*tasks)
-        print(f"cancelled {counter} orders in {time.time() - start}s")
-        await asyncio.sleep(30)
-
-        for user in self.agents:
-            await user.get_user().account_subscriber.update_cache()
-            for subaccount in user.sub_account_ids:
-                num = orders(user)
-                assert (
-                    num == 0
-                ), f"orders: {num} remaining for user: {user.authority} market index: {market_index}"
+        print(f"cancelled orders of {len(tasks)} subaccounts in {time.time() - start}s")
+
+        # only the subaccounts that had orders can still have them
+        async def cancelled() -> bool:
+            await index.refresh_users(targets.keys())
+            return index.count(MarketType.Perp(), market_index) == 0
+
+        try:
+            await wait_until(cancelled, timeout=30, description="orders cancelled")
+        except WaitTimeoutError:
+            pass
+        remaining = index.users(MarketType.Perp(), market_index)
+        for (agent_index, subaccount), num in remaining.items():
+            user = self.agents[agent_index]
+            print(
+                f"orders: {num} remaining for user: {user.authority} "
+                f"subaccount: {subaccount} market index: {market_index}"
+            )
+        assert len(remaining) == 0, (
+            f"orders remaining for {len(remaining)} subaccounts "
+            f"market index: {market_index}"
+        )
+        await checker.refresh(
+            self.agents[agent_index].get_user_account_public_key(subaccount)
+            for agent_index, subaccount in targets
+        )
+        checker.report()
 
         await move_oracle_down_40(admin, 9)  # type: ignore
 
-        # this is a hacky way to wait for the keepyrs script to be done
-        # i was having issues getting keepyrs into here as a dep so i run it separately
-        # see https://github.com/soundsonacid/keepyrs/tree/sim-keepyrs for the script
-        flag_file = os.path.expanduser("~/file.txt")
-        while True:
-            if os.path.exists(flag_file):
-                print("keepyrs done")
-                os.remove(flag_file)
-                break
-            else:
-                print("waiting for keepyrs to finish..")
-            await asyncio.sleep(1)
+        liquidator = Liquidator(self.agents, self.sim_results)
+        await liquidator.run()
+        # liquidations touch liquidators and liquidatees, re-read everyone
+        await checker.refresh()
+        checker.report()
 
         # dump final state of amm & insurance into csv
-        await asyncio.sleep(30)
         await admin.account_subscriber.update_cache()  # type: ignore
+        await sampler.stop()
 
         market = admin.get_perp_market_account(market_index)  # type: ignore
-        append_to_csv(market, "sim_results.csv", "final market")
+        self.results.append(market, "final market")
 
         usdc_spot_market = admin.get_spot_market_account(0)  # type: ignore
         insurance_vault = usdc_spot_market.insurance_fund  # type: ignore
-        append_to_csv(insurance_vault, "sim_results.csv", "final if")
+        self.results.append(insurance_vault, "final if", spot_market_index=0)
+        self.results.close()
+        print(f"results written to {self.results.path}")
 
 
 async def main():
     print("spinning up drift simulation..")
     slack = Slack()
     sim_results = SimulationResultBuilder(slack)
-    sim_results.set_start_time(dt.datetime.utcnow())
+    start_time = dt.datetime.utcnow()
+    sim_results.set_start_time(start_time)
 
-    simulator = Simulator(sim_results)
+    # replay with src.recorder.replay to reproduce this run
+    record_path = f"runs/{start_time:%Y%m%d-%H%M%S}"
+    simulator = Simulator(sim_results, record_path=record_path)
 
     await simulator.setup()
 
     await simulator.test_exchange_behavior(9)
+    await simulator.finish("exchange_behavior")
+
+    await recorder.stop()
+    print(f"run recorded to {record_path}")
+
+    await metrics.flush()
+    metrics.print_summary()
+    metrics.dump("sim_metrics.json")
+    await slack.close()
 
 if __name__ == "__main__":
     import asyncio
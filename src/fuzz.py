@@ -0,0 +1,314 @@
+"""
+Seeded action fuzzer. Draws action sequences over the perp markets that exist
+in the snapshot, runs many sequences in parallel on `src.runner` validators,
+and shrinks every failing sequence to a minimal reproducer.
+
+    poetry run python -m src.fuzz --sequences 16 --length 50 --seed 0
+
+A sequence fails when an action raises (as opposed to being rejected by the
+program, which `Action.execute` reports by returning None) or when a market
+invariant that held before the sequence started is broken after a step.
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+from driftpy.admin import Admin
+
+from src.actions import ACTION_CLASSES, build_action, perp_market_indexes
+from src.experiments import Simulator
+from src.runner import Scenario, run_scenarios
+
+# returns a description of the violation, or None if the invariant holds
+Invariant = Callable[[Admin, int], Optional[str]]
+
+AMM_POSITIVE_FIELDS = [
+    "sqrt_k",
+    "peg_multiplier",
+    "base_asset_reserve",
+    "quote_asset_reserve",
+]
+
+
+def amm_reserves_positive(admin: Admin, market_index: int) -> Optional[str]:
+    amm = admin.get_perp_market_account(market_index).amm  # type: ignore
+    for name in AMM_POSITIVE_FIELDS:
+        if getattr(amm, name) <= 0:
+            return f"amm.{name} = {getattr(amm, name)}"
+    return None
+
+
+def amm_constant_product(admin: Admin, market_index: int) -> Optional[str]:
+    amm = admin.get_perp_market_account(market_index).amm  # type: ignore
+    k = amm.base_asset_reserve * amm.quote_asset_reserve
+    # reserves are rounded on every update, allow a relative error of 1e-6
+    if abs(amm.sqrt_k**2 - k) * 1_000_000 > k:
+        return f"sqrt_k^2 {amm.sqrt_k**2} != base * quote reserve {k}"
+    return None
+
+
+def amm_net_base_asset_amount(admin: Admin, market_index: int) -> Optional[str]:
+    amm = admin.get_perp_market_account(market_index).amm  # type: ignore
+    net = amm.base_asset_amount_long + amm.base_asset_amount_short
+    with_amm = amm.base_asset_amount_with_amm + amm.base_asset_amount_with_unsettled_lp
+    if net != with_amm:
+        return f"long + short {net} != with_amm + with_unsettled_lp {with_amm}"
+    return None
+
+
+DEFAULT_INVARIANTS: list[Invariant] = [
+    amm_reserves_positive,
+    amm_constant_product,
+    amm_net_base_asset_amount,
+]
+
+
+@dataclass
+class FuzzStep:
+    action: str
+    market_index: int
+    pct_delta: float
+
+
+@dataclass
+class FuzzFailure:
+    step: int
+    # "exception: <type>" or "invariant: <name>", used to tell failures apart
+    kind: str
+    message: str
+
+
+def generate_sequence(
+    market_indexes: list[int], length: int, seed: int
+) -> list[FuzzStep]:
+    rng = random.Random(seed)
+    return [
+        FuzzStep(
+            rng.choice(ACTION_CLASSES).__name__,
+            rng.choice(market_indexes),
+            rng.uniform(-0.1, 0.1),
+        )
+        for _ in range(length)
+    ]
+
+
+def check_invariants(
+    admin: Admin, market_indexes: list[int], invariants: list[Invariant]
+) -> dict[tuple[str, int], str]:
+    violations = {}
+    for invariant in invariants:
+        for market_index in market_indexes:
+            message = invariant(admin, market_index)
+            if message is not None:
+                violations[(invariant.__name__, market_index)] = message
+    return violations
+
+
+async def run_sequence(
+    simulator: Simulator,
+    steps: list[dict],
+    invariants: Optional[list[Invariant]] = None,
+) -> dict:
+    """Runner scenario: executes `steps` in order and stops at the first failure"""
+    admin: Admin = simulator.admin  # type: ignore
+    invariants = invariants if invariants is not None else DEFAULT_INVARIANTS
+    action_classes = {cls.__name__: cls for cls in ACTION_CLASSES}
+    fuzz_steps = [FuzzStep(**step) for step in steps]
+    market_indexes = sorted({step.market_index for step in fuzz_steps})
+
+    await admin.account_subscriber.update_cache()
+    # only invariants that held at the start can be broken by the sequence
+    baseline = check_invariants(admin, market_indexes, invariants)
+
+    failure = None
+    executed = 0
+    rejected = 0
+    start = time.time()
+    for i, step in enumerate(fuzz_steps):
+        try:
+            await admin.account_subscriber.update_cache()
+            action = build_action(
+                admin, action_classes[step.action], step.market_index, step.pct_delta
+            )
+            if await action.execute(admin) is None:
+                rejected += 1
+            executed += 1
+        except Exception as e:
+            failure = FuzzFailure(i, f"exception: {type(e).__name__}", str(e))
+            break
+
+        await admin.account_subscriber.update_cache()
+        violations = check_invariants(admin, [step.market_index], invariants)
+        broken = [key for key in violations if key not in baseline]
+        if len(broken) > 0:
+            name, market_index = broken[0]
+            message = f"market {market_index}: {violations[broken[0]]}"
+            failure = FuzzFailure(i, f"invariant: {name}", message)
+            break
+    elapsed = time.time() - start
+
+    return {
+        "executed": executed,
+        "rejected": rejected,
+        "elapsed": elapsed,
+        "actions_per_second": executed / elapsed if elapsed > 0 else 0.0,
+        "failure": asdict(failure) if failure is not None else None,
+    }
+
+
+async def fuzz_market_indexes(simulator: Simulator) -> dict:
+    return {"market_indexes": perp_market_indexes(simulator.admin)}  # type: ignore
+
+
+class Fuzzer:
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        invariants: Optional[list[Invariant]] = None,
+    ):
+        self.workers = workers
+        self.invariants = invariants
+        self.runs = 0
+        self.actions = 0
+        self.action_time = 0.0
+
+    def run(self, name: str, sequences: list[list[FuzzStep]]) -> list[dict]:
+        """Runs each sequence on its own fresh validator, in parallel"""
+        scenarios = [
+            Scenario(
+                f"{name}-{i}",
+                run_sequence,
+                {
+                    "steps": [asdict(step) for step in sequence],
+                    "invariants": self.invariants,
+                },
+            )
+            for i, sequence in enumerate(sequences)
+        ]
+        results = run_scenarios(scenarios, self.workers, output=None)
+        for result in results:
+            self.runs += 1
+            if result["ok"]:
+                self.actions += result["result"]["executed"]
+                self.action_time += result["result"]["elapsed"]
+        return results
+
+    @staticmethod
+    def failure_of(result: dict) -> Optional[FuzzFailure]:
+        if not result["ok"]:
+            # the scenario itself crashed (e.g. the validator did not start)
+            return None
+        failure = result["result"]["failure"]
+        return FuzzFailure(**failure) if failure is not None else None
+
+    def shrink(self, sequence: list[FuzzStep], failure: FuzzFailure) -> list[FuzzStep]:
+        """
+        Delta debugging: drops chunks of the sequence while it still fails
+        with the same kind of failure, testing all complements of a round in
+        parallel.
+        """
+        steps = sequence[: failure.step + 1]
+        n = 2
+        while len(steps) >= 2:
+            chunk = -(-len(steps) // n)
+            candidates = [
+                steps[:i] + steps[i + chunk :] for i in range(0, len(steps), chunk)
+            ]
+            results = self.run("shrink", candidates)
+            for candidate, result in zip(candidates, results):
+                found = self.failure_of(result)
+                if found is not None and found.kind == failure.kind:
+                    steps = candidate[: found.step + 1]
+                    n = max(n - 1, 2)
+                    break
+            else:
+                if n >= len(steps):
+                    break
+                n = min(len(steps), 2 * n)
+            print(f"shrunk to {len(steps)} steps")
+        return steps
+
+    @property
+    def actions_per_second(self) -> float:
+        return self.actions / self.action_time if self.action_time > 0 else 0.0
+
+
+def fuzz(
+    sequences: int,
+    length: int,
+    seed: int = 0,
+    workers: Optional[int] = None,
+    invariants: Optional[list[Invariant]] = None,
+    output: Optional[str] = "fuzz_results.json",
+) -> dict:
+    fuzzer = Fuzzer(workers, invariants)
+    start = time.time()
+
+    market_indexes = run_scenarios(
+        [Scenario("fuzz-markets", fuzz_market_indexes)], 1, output=None
+    )[0]["result"]["market_indexes"]
+    print(f"fuzzing {len(market_indexes)} perp markets: {market_indexes}")
+
+    generated = [
+        generate_sequence(market_indexes, length, seed + i) for i in range(sequences)
+    ]
+    results = fuzzer.run("fuzz", generated)
+
+    reports = []
+    for i, (sequence, result) in enumerate(zip(generated, results)):
+        failure = fuzzer.failure_of(result)
+        if failure is None:
+            continue
+        print(f"sequence {seed + i} failed at step {failure.step}: {failure.kind}")
+        reproducer = fuzzer.shrink(sequence, failure)
+        reports.append(
+            {
+                "seed": seed + i,
+                "failure": asdict(failure),
+                "reproducer": [asdict(step) for step in reproducer],
+            }
+        )
+
+    report = {
+        "commit": os.environ.get("COMMIT"),
+        "created_at": time.time(),
+        "market_indexes": market_indexes,
+        "sequences": sequences,
+        "length": length,
+        "seed": seed,
+        "runs": fuzzer.runs,
+        "actions": fuzzer.actions,
+        "actions_per_second": fuzzer.actions_per_second,
+        "elapsed": time.time() - start,
+        "failures": reports,
+    }
+    print(
+        f"{fuzzer.actions} actions over {fuzzer.runs} runs, "
+        f"{fuzzer.actions_per_second:.2f} actions/s per validator, "
+        f"{len(reports)} failing sequences"
+    )
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"fuzz results written to {output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sequences", type=int, default=8)
+    parser.add_argument("--length", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="fuzz_results.json")
+    args = parser.parse_args()
+    fuzz(args.sequences, args.length, args.seed, args.workers, output=args.output)
+
+
+if __name__ == "__main__":
+    main()
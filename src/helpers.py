@@ -1,13 +1,11 @@
 import asyncio
-import csv
 import time
 import base64
 import jsonrpcclient
 import pathlib
-import os
 import time
 
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
 from typing import Generic, Tuple, TypeVar
 
 from anchorpy import Wallet
@@ -22,6 +20,9 @@ from driftpy.admin import Admin
 from driftpy.decode.user import decode_user
 from driftpy.types import UserAccount
 
+from src.blockhash import SharedBlockhashTxSender
+from src.confirm import SignatureConfirmer
+
 T = TypeVar("T")
 
 @dataclass
@@ -62,14 +63,17 @@ async def load_local_users(
                 connection,
                 wallet,
                 "mainnet",
-                account_subscription=AccountSubscriptionConfig("cached")
+                account_subscription=AccountSubscriptionConfig("cached"),
+                # admin ixs are recorded by the sender too, so replays match
+                tx_sender=SharedBlockhashTxSender(connection),
             )
         else:
             ch = DriftClient(
                 connection,
                 wallet,
                 "mainnet",
-                account_subscription=AccountSubscriptionConfig("cached")
+                account_subscription=AccountSubscriptionConfig("cached"),
+                tx_sender=SharedBlockhashTxSender(connection),
             )
             chs.append(ch)
 
@@ -153,6 +157,7 @@ async def load_nonidle_users_for_market(
                     "mainnet",
                     account_subscription=AccountSubscriptionConfig("cached"),
                     initial_user_data=DataAndSlot(slot, user),
+                    tx_sender=SharedBlockhashTxSender(admin.connection),
                 )
 
                 agents.append(agent)
@@ -161,24 +166,12 @@ async def load_nonidle_users_for_market(
     print(f"total identified lp shares: {running_lp_shares}")
     print(f"loaded {len(agents)} agents.          ")
 
-    asyncio.gather(*tasks)
+    airdrop_sigs = [resp.value for resp in await asyncio.gather(*tasks)]
+    airdrops = await SignatureConfirmer(admin.connection).confirm_all(airdrop_sigs)
+    failed_airdrops = len([result for result in airdrops if not result.ok])
+    if failed_airdrops > 0:
+        print(f"failed to confirm {failed_airdrops}/{len(airdrops)} airdrops")
 
     print(f"Loaded {len(agents)} agents in {time.time() - start}s")
 
     return agents
-
-
-def append_to_csv(data_object, filename, record_type):
-    data_dict = asdict(data_object)
-    data_dict["record_type"] = record_type  
-
-    write_headers = not os.path.exists(filename) or os.path.getsize(filename) == 0
-
-    with open(filename, "a", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=data_dict.keys())
-
-        if write_headers:
-            writer.writeheader()
-        writer.writerow(data_dict)
-
-    print(f"{record_type} data appended to {filename} successfully.")
@@ -0,0 +1,403 @@
+"""
+Protocol invariants over every user and market, checked with NumPy column sums
+so they can run after each scenario step instead of once at the end:
+
+    perp base     sum(user longs) == amm.base_asset_amount_long, shorts likewise,
+                  and sum(user baa) == baa with amm + baa with unsettled lp
+    lp shares     sum(user lp shares) == amm.user_lp_shares
+    spot balance  sum(user deposits) + pools == market.deposit_balance,
+                  sum(user borrows) == market.borrow_balance
+    spot vault    vault tokens >= deposit tokens - borrow tokens
+    pnl pool      in Settlement, pnl pool tokens >= the net pnl still owed to
+                  users at the expiry price
+
+Pools (revenue, spot fee, and every perp market's pnl and amm fee pool) are
+deposits of the spot market they are denominated in. Each user is a row of
+per-market arrays, so after a step only the users it touched are re-read:
+
+    checker = InvariantChecker(admin)
+    await checker.refresh()  # markets, vaults and all users
+    ...
+    await checker.refresh(touched_user_pubkeys)
+    checker.report()
+
+    poetry run python -m src.invariants --account-dir=accounts/
+"""
+import argparse
+import time
+
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+
+from solana.rpc.types import MemcmpOpts
+
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.admin import Admin
+from driftpy.constants.numeric_constants import BASE_PRECISION
+from driftpy.decode.user import decode_user
+from driftpy.types import PerpMarketAccount, SpotMarketAccount, UserAccount, is_variant
+
+from src.balances import get_token_amounts
+from src.oracles import ACCOUNTS_PER_REQUEST
+from src.risk import load_snapshot
+
+# base58 of the User account discriminator
+USER_DISCRIMINATOR = "TfwwBiNJtao"
+
+
+@dataclass
+class Violation:
+    invariant: str
+    # "perp" or "spot"
+    market_type: str
+    market_index: int
+    expected: float
+    actual: float
+
+    def __str__(self) -> str:
+        return (
+            f"{self.invariant} violated in {self.market_type} market "
+            f"{self.market_index}: expected {self.expected:.0f}, "
+            f"got {self.actual:.0f} ({self.actual - self.expected:+.0f})"
+        )
+
+
+def token_amount(scaled_balance, cumulative_interest, decimals):
+    """`get_token_amount`, in ints or over arrays"""
+    return scaled_balance * cumulative_interest // 10 ** (19 - decimals)
+
+
+class InvariantChecker:
+    """
+    Users are rows of (users, perps) and (users, spots) arrays, grown as new
+    users show up. `update_user` rewrites one row, the `update_*_market`
+    methods replace a market, and `check` compares column sums against the
+    markets.
+    """
+
+    def __init__(
+        self,
+        admin: Optional[Admin] = None,
+        capacity: int = 1024,
+        rtol: float = 1e-12,
+    ):
+        self.admin = admin
+        self.rtol = rtol
+        self.perp_markets: dict[int, PerpMarketAccount] = {}
+        self.spot_markets: dict[int, SpotMarketAccount] = {}
+        self.vault_amounts: dict[int, int] = {}
+        self.perp_column: dict[int, int] = {}
+        self.spot_column: dict[int, int] = {}
+        self.rows: dict[str, int] = {}
+        self.capacity = capacity
+        self._allocate(capacity, 0, 0)
+
+    def _allocate(self, capacity: int, perps: int, spots: int):
+        def grow(old: Optional[np.ndarray], columns: int) -> np.ndarray:
+            new = np.zeros((capacity, columns))
+            if old is not None:
+                new[: old.shape[0], : old.shape[1]] = old
+            return new
+
+        self.base_long = grow(getattr(self, "base_long", None), perps)
+        self.base_short = grow(getattr(self, "base_short", None), perps)
+        self.lp_shares = grow(getattr(self, "lp_shares", None), perps)
+        self.quote = grow(getattr(self, "quote", None), perps)
+        self.deposits = grow(getattr(self, "deposits", None), spots)
+        self.borrows = grow(getattr(self, "borrows", None), spots)
+        self.capacity = capacity
+
+    def _column(self, columns: dict[int, int], market_index: int) -> int:
+        if market_index not in columns:
+            columns[market_index] = len(columns)
+            self._allocate(self.capacity, len(self.perp_column), len(self.spot_column))
+        return columns[market_index]
+
+    def update_perp_market(self, market: PerpMarketAccount):
+        self._column(self.perp_column, market.market_index)
+        self.perp_markets[market.market_index] = market
+
+    def update_spot_market(self, market: SpotMarketAccount):
+        self._column(self.spot_column, market.market_index)
+        self.spot_markets[market.market_index] = market
+
+    def update_vault_amounts(self, amounts: dict[int, Optional[int]]):
+        """Spot vault token amounts by market index"""
+        for market_index, amount in amounts.items():
+            if amount is not None:
+                self.vault_amounts[market_index] = amount
+
+    def _row(self, key: str) -> int:
+        if key not in self.rows:
+            if len(self.rows) == self.capacity:
+                self._allocate(
+                    self.capacity * 2, len(self.perp_column), len(self.spot_column)
+                )
+            self.rows[key] = len(self.rows)
+        return self.rows[key]
+
+    def update_user(self, key: str, user: UserAccount):
+        """Positions in markets the checker does not know yet are skipped"""
+        row = self._row(key)
+        for array in [self.base_long, self.base_short, self.lp_shares, self.quote]:
+            array[row] = 0
+        self.deposits[row] = 0
+        self.borrows[row] = 0
+
+        for position in user.perp_positions:
+            if position.market_index not in self.perp_column:
+                continue
+            column = self.perp_column[position.market_index]
+            base = position.base_asset_amount
+            if base > 0:
+                self.base_long[row, column] += base
+            else:
+                self.base_short[row, column] += base
+            self.lp_shares[row, column] += position.lp_shares
+            self.quote[row, column] += position.quote_asset_amount
+        for position in user.spot_positions:
+            if position.market_index not in self.spot_column:
+                continue
+            column = self.spot_column[position.market_index]
+            if is_variant(position.balance_type, "Deposit"):
+                self.deposits[row, column] += position.scaled_balance
+            else:
+                self.borrows[row, column] += position.scaled_balance
+
+    def remove_user(self, key: str):
+        """Zeroes the user's row (e.g. after the account was deleted)"""
+        row = self.rows.get(key)
+        if row is None:
+            return
+        for array in [
+            self.base_long,
+            self.base_short,
+            self.lp_shares,
+            self.quote,
+            self.deposits,
+            self.borrows,
+        ]:
+            array[row] = 0
+
+    def _compare(
+        self,
+        invariant: str,
+        market_type: str,
+        market_indexes: list[int],
+        expected: np.ndarray,
+        actual: np.ndarray,
+    ) -> list[Violation]:
+        ok = np.isclose(actual, expected, rtol=self.rtol, atol=0)
+        return [
+            Violation(invariant, market_type, market_indexes[i], expected[i], actual[i])
+            for i in np.flatnonzero(~ok)
+        ]
+
+    def check(self) -> list[Violation]:
+        n = len(self.rows)
+        violations: list[Violation] = []
+
+        perp_indexes = [i for i in self.perp_column if i in self.perp_markets]
+        perp_columns = [self.perp_column[i] for i in perp_indexes]
+        perps = [self.perp_markets[i] for i in perp_indexes]
+
+        def perp_field(get) -> np.ndarray:
+            return np.array([get(m) for m in perps], dtype=np.float64)
+
+        long = self.base_long[:n, perp_columns].sum(axis=0)
+        short = self.base_short[:n, perp_columns].sum(axis=0)
+        violations += self._compare(
+            "sum(user long baa) == amm.base_asset_amount_long",
+            "perp",
+            perp_indexes,
+            perp_field(lambda m: m.amm.base_asset_amount_long),
+            long,
+        )
+        violations += self._compare(
+            "sum(user short baa) == amm.base_asset_amount_short",
+            "perp",
+            perp_indexes,
+            perp_field(lambda m: m.amm.base_asset_amount_short),
+            short,
+        )
+        violations += self._compare(
+            "sum(user baa) == baa with amm + baa with unsettled lp",
+            "perp",
+            perp_indexes,
+            perp_field(
+                lambda m: m.amm.base_asset_amount_with_amm
+                + m.amm.base_asset_amount_with_unsettled_lp
+            ),
+            long + short,
+        )
+        violations += self._compare(
+            "sum(user lp shares) == amm.user_lp_shares",
+            "perp",
+            perp_indexes,
+            perp_field(lambda m: m.amm.user_lp_shares),
+            self.lp_shares[:n, perp_columns].sum(axis=0),
+        )
+
+        spot_indexes = [i for i in self.spot_column if i in self.spot_markets]
+        spot_columns = [self.spot_column[i] for i in spot_indexes]
+        spots = [self.spot_markets[i] for i in spot_indexes]
+
+        def spot_field(get) -> np.ndarray:
+            return np.array([get(m) for m in spots], dtype=np.float64)
+
+        pools = spot_field(
+            lambda m: m.revenue_pool.scaled_balance + m.spot_fee_pool.scaled_balance
+        )
+        spot_position = {market_index: i for i, market_index in enumerate(spot_indexes)}
+        for market in perps:
+            for pool in [market.pnl_pool, market.amm.fee_pool]:
+                if pool.market_index in spot_position:
+                    pools[spot_position[pool.market_index]] += pool.scaled_balance
+        deposits = self.deposits[:n, spot_columns].sum(axis=0)
+        borrows = self.borrows[:n, spot_columns].sum(axis=0)
+        violations += self._compare(
+            "sum(user deposits) + pools == deposit_balance",
+            "spot",
+            spot_indexes,
+            spot_field(lambda m: m.deposit_balance),
+            deposits + pools,
+        )
+        violations += self._compare(
+            "sum(user borrows) == borrow_balance",
+            "spot",
+            spot_indexes,
+            spot_field(lambda m: m.borrow_balance),
+            borrows,
+        )
+
+        for market in spots:
+            vault = self.vault_amounts.get(market.market_index)
+            if vault is None:
+                continue
+            deposit_tokens = token_amount(
+                market.deposit_balance,
+                market.cumulative_deposit_interest,
+                market.decimals,
+            )
+            borrow_tokens = token_amount(
+                market.borrow_balance,
+                market.cumulative_borrow_interest,
+                market.decimals,
+            )
+            if vault < deposit_tokens - borrow_tokens:
+                violations.append(
+                    Violation(
+                        "vault >= deposit tokens - borrow tokens",
+                        "spot",
+                        market.market_index,
+                        deposit_tokens - borrow_tokens,
+                        vault,
+                    )
+                )
+
+        for column, market in zip(perp_columns, perps):
+            quote_market = self.spot_markets.get(market.pnl_pool.market_index)
+            if not is_variant(market.status, "Settlement") or quote_market is None:
+                continue
+            base = self.base_long[:n, column] + self.base_short[:n, column]
+            pnl = self.quote[:n, column] + base * market.expiry_price / BASE_PRECISION
+            # losers pay into the pool when they settle, so it only has to
+            # cover the winners' pnl net of what the losers still owe
+            owed = pnl.sum()
+            pnl_pool = token_amount(
+                market.pnl_pool.scaled_balance,
+                quote_market.cumulative_deposit_interest,
+                quote_market.decimals,
+            )
+            if pnl_pool < owed:
+                violations.append(
+                    Violation(
+                        "pnl pool >= net pnl owed at expiry price",
+                        "perp",
+                        market.market_index,
+                        owed,
+                        pnl_pool,
+                    )
+                )
+
+        return violations
+
+    async def refresh_markets(self):
+        """Re-reads every perp and spot market and the spot vaults"""
+        assert self.admin is not None
+        await self.admin.account_subscriber.update_cache()  # type: ignore
+        for perp_market in self.admin.get_perp_market_accounts():
+            self.update_perp_market(perp_market)
+        spot_markets = self.admin.get_spot_market_accounts()
+        for spot_market in spot_markets:
+            self.update_spot_market(spot_market)
+        amounts = await get_token_amounts(
+            self.admin.connection, [m.vault for m in spot_markets]  # type: ignore
+        )
+        self.update_vault_amounts(
+            {m.market_index: amount for m, amount in zip(spot_markets, amounts)}
+        )
+
+    async def refresh_users(self, users: Optional[Iterable[Pubkey]] = None):
+        """Re-reads `users`, or every User account of the program"""
+        assert self.admin is not None
+        connection = self.admin.connection
+        if users is None:
+            resp = await connection.get_program_accounts(
+                self.admin.program_id,
+                encoding="base64",
+                filters=[MemcmpOpts(offset=0, bytes=USER_DISCRIMINATOR)],
+            )
+            for keyed in resp.value:
+                self.update_user(str(keyed.pubkey), decode_user(keyed.account.data))
+            return
+
+        users = list(users)
+        for i in range(0, len(users), ACCOUNTS_PER_REQUEST):
+            chunk = users[i : i + ACCOUNTS_PER_REQUEST]
+            resp = await connection.get_multiple_accounts(chunk)
+            for pubkey, account in zip(chunk, resp.value):
+                if account is None:
+                    self.remove_user(str(pubkey))
+                else:
+                    self.update_user(str(pubkey), decode_user(account.data))
+
+    async def refresh(self, users: Optional[Iterable[Pubkey]] = None):
+        await self.refresh_markets()
+        await self.refresh_users(users)
+
+    def report(self) -> list[Violation]:
+        start = time.time()
+        violations = self.check()
+        print(
+            f"checked invariants of {len(self.rows)} users, "
+            f"{len(self.perp_markets)} perp and {len(self.spot_markets)} spot "
+            f"markets in {(time.time() - start) * 1000:.1f}ms: "
+            f"{len(violations)} violated"
+        )
+        for violation in violations:
+            print(f"  {violation}")
+        return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--account-dir", default="accounts/")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.account_dir)
+    checker = InvariantChecker(capacity=max(1, len(snapshot.users)))
+    for perp_market in snapshot.perp_markets:
+        checker.update_perp_market(perp_market)
+    for spot_market in snapshot.spot_markets:
+        checker.update_spot_market(spot_market)
+    for pubkey, user in snapshot.users.items():
+        checker.update_user(pubkey, user)
+    checker.report()
+
+
+if __name__ == "__main__":
+    main()
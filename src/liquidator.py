@@ -0,0 +1,366 @@
+"""
+In-process liquidation keeper over the loaded agents' subaccounts.
+
+Users are kept in a max-heap keyed by maintenance margin shortfall, so the most
+underwater user is liquidated first. After a liquidation only that user is
+re-read and re-queued; the whole book is rescanned every `rescan_interval`
+seconds to pick up users pushed underwater by price moves. Liquidation txs
+are sent by one liquidator agent (the one with the most free collateral) with
+at most `concurrency` in flight.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from driftpy.drift_client import DriftClient
+from driftpy.drift_user import DriftUser
+from driftpy.math.margin import MarginCategory
+
+from src.metrics import metrics
+from src.settle import settle_error_reason
+from src.slack import SimulationResultBuilder
+
+# UserStatus bit flags of the program
+USER_STATUS_BEING_LIQUIDATED = 1
+USER_STATUS_BANKRUPT = 2
+
+UserKey = tuple[int, int]  # (agent index, sub account id)
+
+
+@dataclass
+class LiquidationStats:
+    liquidations: int = 0
+    failures: int = 0
+    users_liquidated: int = 0
+    # users still with a shortfall, including those out of attempts
+    users_remaining: int = 0
+    rescans: int = 0
+    elapsed: float = 0.0
+    # seconds from the start until no user had a shortfall, None if never
+    time_to_solvency: Optional[float] = None
+    by_kind: Counter = field(default_factory=Counter)
+    fail_reasons: Counter = field(default_factory=Counter)
+
+    @property
+    def liquidations_per_second(self) -> float:
+        return self.liquidations / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def user_shortfall(user: DriftUser, liquidation_buffer: int) -> int:
+    """Maintenance requirement not covered by maintenance collateral"""
+    user_account = user.get_user_account()
+    buffer = None
+    if user_account.status & USER_STATUS_BEING_LIQUIDATED:
+        # the program keeps liquidating until the buffer is restored too
+        buffer = liquidation_buffer
+    requirement = user.get_margin_requirement(MarginCategory.MAINTENANCE, buffer)
+    collateral = user.get_total_collateral(MarginCategory.MAINTENANCE)
+    return requirement - collateral
+
+
+class Liquidator:
+    def __init__(
+        self,
+        agents: list[DriftClient],
+        sim_results: Optional[SimulationResultBuilder] = None,
+        liquidator: Optional[DriftClient] = None,
+        liquidator_sub_account_id: int = 0,
+        concurrency: int = 16,
+        rescan_interval: float = 5.0,
+        max_attempts: int = 20,
+        timeout: float = 600.0,
+    ):
+        self.agents = agents
+        self.sim_results = sim_results
+        self.liquidator = liquidator
+        self.liquidator_sub_account_id = liquidator_sub_account_id
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.rescan_interval = rescan_interval
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        self.heap: list[tuple[int, int, UserKey]] = []
+        self.shortfalls: dict[UserKey, int] = {}
+        self.attempts: Counter = Counter()
+        # users still underwater that are out of attempts (or liquidations)
+        self.exhausted: set[UserKey] = set()
+        self.in_flight: set[UserKey] = set()
+        self.liquidated: set[UserKey] = set()
+        self.counter = itertools.count()
+        self.changed = asyncio.Condition()
+        self.stats = LiquidationStats()
+
+    def _user(self, key: UserKey) -> DriftUser:
+        agent_index, sub_account_id = key
+        return self.agents[agent_index].get_user(sub_account_id)
+
+    def _keys(self) -> list[UserKey]:
+        return [
+            (i, sub_account_id)
+            for i, agent in enumerate(self.agents)
+            for sub_account_id in agent.sub_account_ids
+        ]
+
+    def _liquidation_buffer(self) -> int:
+        state = self.liquidator.get_state_account()  # type: ignore
+        return state.liquidation_margin_buffer_ratio
+
+    def _update(self, key: UserKey):
+        """Recomputes the shortfall of `key` from its cached account"""
+        if self._is_liquidator(key):
+            return
+        shortfall = user_shortfall(self._user(key), self._liquidation_buffer())
+        if shortfall <= 0:
+            self.shortfalls.pop(key, None)
+            self.exhausted.discard(key)
+        elif self.attempts[key] >= self.max_attempts:
+            self.shortfalls.pop(key, None)
+            self.exhausted.add(key)
+        else:
+            self.shortfalls[key] = shortfall
+            # stale entries are skipped on pop, no need to remove them
+            heapq.heappush(self.heap, (-shortfall, next(self.counter), key))
+
+    def _pop(self) -> Optional[UserKey]:
+        while len(self.heap) > 0:
+            neg_shortfall, _, key = heapq.heappop(self.heap)
+            if key in self.in_flight or self.shortfalls.get(key) != -neg_shortfall:
+                continue
+            del self.shortfalls[key]
+            return key
+        return None
+
+    def _is_liquidator(self, key: UserKey) -> bool:
+        agent_index, sub_account_id = key
+        return (
+            self.agents[agent_index] is self.liquidator
+            and sub_account_id == self.liquidator_sub_account_id
+        )
+
+    async def _refresh_user(self, key: UserKey):
+        async with self.semaphore:
+            await self._user(key).account_subscriber.update_cache()
+
+    async def _refresh_all(self):
+        await asyncio.gather(
+            *[agent.account_subscriber.update_cache() for agent in self.agents]
+        )
+        await asyncio.gather(*[self._refresh_user(key) for key in self._keys()])
+
+    def _rebuild(self):
+        self.heap = []
+        self.shortfalls = {}
+        for key in self._keys():
+            if key not in self.in_flight:
+                self._update(key)
+
+    async def rescan(self):
+        """Re-reads every market and user account and rebuilds the queue"""
+        await self._refresh_all()
+        async with self.changed:
+            self._rebuild()
+            self.changed.notify_all()
+        self.stats.rescans += 1
+
+    async def _rescan_periodically(self):
+        while True:
+            await asyncio.sleep(self.rescan_interval)
+            # prices may have moved users that were not touched underwater
+            await self.rescan()
+
+    def pick_liquidator(self) -> DriftClient:
+        """The agent subaccount with the most free collateral"""
+        best = max(
+            self._keys(),
+            key=lambda key: self._user(key).get_free_collateral(),
+        )
+        self.liquidator_sub_account_id = best[1]
+        return self.agents[best[0]]
+
+    def next_liquidation(
+        self, key: UserKey
+    ) -> Optional[tuple[str, Callable[[], Awaitable]]]:
+        """The liquidation (kind, send) that makes progress on `key` first"""
+        user = self._user(key)
+        user_account = user.get_user_account()
+        authority = user_account.authority
+        sub_account_id = key[1]
+        liquidator: DriftClient = self.liquidator  # type: ignore
+        liq_sub_account_id = self.liquidator_sub_account_id
+
+        perp_positions = [
+            p
+            for p in user_account.perp_positions
+            if p.base_asset_amount != 0 or p.quote_asset_amount != 0
+        ]
+        spot_amounts = {
+            p.market_index: user.get_token_amount(p.market_index)
+            for p in user_account.spot_positions
+            if p.scaled_balance != 0
+        }
+        deposits = {i: a for i, a in spot_amounts.items() if a > 0}
+        borrows = {i: -a for i, a in spot_amounts.items() if a < 0}
+
+        if user_account.status & USER_STATUS_BANKRUPT:
+            for position in perp_positions:
+                if position.base_asset_amount == 0 and position.quote_asset_amount < 0:
+                    market_index = position.market_index
+                    return "resolve_perp_bankruptcy", lambda: (
+                        liquidator.resolve_perp_bankruptcy(
+                            authority, market_index, sub_account_id, liq_sub_account_id
+                        )
+                    )
+            for market_index in borrows:
+                return "resolve_spot_bankruptcy", lambda: (
+                    liquidator.resolve_spot_bankruptcy(
+                        authority, market_index, sub_account_id, liq_sub_account_id
+                    )
+                )
+
+        # the largest position first, it frees the most margin
+        with_base = [p for p in perp_positions if p.base_asset_amount != 0]
+        if len(with_base) > 0:
+            position = max(with_base, key=lambda p: abs(p.base_asset_amount))
+            return "liquidate_perp", lambda: liquidator.liquidate_perp(
+                authority,
+                position.market_index,
+                abs(position.base_asset_amount),
+                None,
+                sub_account_id,
+                liq_sub_account_id,
+            )
+
+        if len(borrows) > 0 and len(deposits) > 0:
+            liability = max(borrows, key=lambda i: borrows[i])
+            asset = max(deposits, key=lambda i: deposits[i])
+            return "liquidate_spot", lambda: liquidator.liquidate_spot(
+                authority,
+                asset,
+                liability,
+                borrows[liability],
+                sub_account_id,
+                liq_sub_account_id,
+            )
+
+        negative_pnl = [p for p in perp_positions if p.quote_asset_amount < 0]
+        if len(negative_pnl) > 0 and len(deposits) > 0:
+            position = min(negative_pnl, key=lambda p: p.quote_asset_amount)
+            asset = max(deposits, key=lambda i: deposits[i])
+            return "liquidate_perp_pnl_for_deposit", lambda: (
+                liquidator.liquidate_perp_pnl_for_deposit(
+                    authority,
+                    position.market_index,
+                    asset,
+                    -position.quote_asset_amount,
+                    sub_account_id,
+                    liq_sub_account_id,
+                )
+            )
+        return None
+
+    async def _liquidate(self, key: UserKey):
+        self.attempts[key] += 1
+        liquidation = self.next_liquidation(key)
+        if liquidation is None:
+            # nothing the liquidator can take over, e.g. only open orders
+            self.attempts[key] = self.max_attempts
+            return
+        kind, send = liquidation
+        try:
+            connection = self.liquidator.connection  # type: ignore
+            retries = self.attempts[key] - 1
+            async with metrics.track(kind, connection, retries=retries) as sample:
+                sample.sig = await send()
+            self.stats.liquidations += 1
+            self.stats.by_kind[kind] += 1
+            self.liquidated.add(key)
+        except Exception as e:
+            self.stats.failures += 1
+            self.stats.fail_reasons[settle_error_reason(e)] += 1
+
+    async def _worker(self):
+        while True:
+            async with self.changed:
+                key = self._pop()
+                while key is None:
+                    if len(self.in_flight) == 0:
+                        return
+                    await self.changed.wait()
+                    key = self._pop()
+                self.in_flight.add(key)
+
+            try:
+                await self._liquidate(key)
+                await asyncio.gather(
+                    self._user(key).account_subscriber.update_cache(),
+                    self.liquidator.get_user(  # type: ignore
+                        self.liquidator_sub_account_id
+                    ).account_subscriber.update_cache(),
+                )
+            finally:
+                async with self.changed:
+                    self.in_flight.discard(key)
+                    self._update(key)
+                    self.changed.notify_all()
+
+    async def run(self) -> LiquidationStats:
+        """Liquidates until no user has a shortfall (or `timeout`)"""
+        start = time.time()
+        await self._refresh_all()
+        if self.liquidator is None:
+            self.liquidator = self.pick_liquidator()
+        self._rebuild()
+        print(
+            f"{len(self.shortfalls)} users with a shortfall, liquidating with "
+            f"{self.liquidator.authority} subaccount {self.liquidator_sub_account_id}"
+        )
+
+        while len(self.shortfalls) > 0:
+            remaining = self.timeout - (time.time() - start)
+            if remaining <= 0:
+                break
+            rescanner = asyncio.create_task(self._rescan_periodically())
+            workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+            ]
+            _, pending = await asyncio.wait(workers, timeout=remaining)
+            for task in [rescanner, *pending]:
+                task.cancel()
+            await asyncio.gather(rescanner, *pending, return_exceptions=True)
+            # the queue drained, make sure nobody went underwater meanwhile
+            await self.rescan()
+
+        if len(self.shortfalls) == 0 and len(self.exhausted) == 0:
+            self.stats.time_to_solvency = time.time() - start
+        self.stats.elapsed = time.time() - start
+        self.stats.users_liquidated = len(self.liquidated)
+        self.stats.users_remaining = len(self.shortfalls) + len(self.exhausted)
+        self.report()
+        return self.stats
+
+    def report(self):
+        stats = self.stats
+        solvency = (
+            f"{stats.time_to_solvency:.2f}s"
+            if stats.time_to_solvency is not None
+            else "not reached"
+        )
+        print(
+            f"{stats.liquidations} liquidations ({stats.failures} failed) of "
+            f"{stats.users_liquidated} users in {stats.elapsed:.2f}s "
+            f"({stats.liquidations_per_second:.2f} liquidations/s), "
+            f"time to solvency: {solvency}, "
+            f"{stats.users_remaining} users still underwater"
+        )
+        for kind, count in stats.by_kind.items():
+            print(f"  {kind}: {count}")
+        for reason, count in stats.fail_reasons.most_common(5):
+            print(f"  failed: {reason}: {count}")
+        if self.sim_results is not None:
+            self.sim_results.add_phase_timing("liquidation", stats.elapsed)
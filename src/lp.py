@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from solders.signature import Signature  # type: ignore
+
+from driftpy.admin import Admin
+from driftpy.drift_client import DriftClient
+
+from src.confirm import SignatureConfirmer
+from src.metrics import metrics
+from src.waiters import wait_for_perp_market
+
+
+@dataclass
+class LpRemoval:
+    agent: DriftClient
+    sub_account_id: int
+    shares: int
+    sig: Optional[Signature] = None
+    error: Any = None
+
+
+@dataclass
+class LpUnwindResult:
+    removals: list[LpRemoval]
+    before_user_lp_shares: int
+    removed_shares: int
+    elapsed: float
+
+    @property
+    def failed(self) -> list[LpRemoval]:
+        return [removal for removal in self.removals if removal.error is not None]
+
+
+def lp_removals(agents: list[DriftClient], market_index: int) -> list[LpRemoval]:
+    """One removal per agent subaccount with lp shares in `market_index`"""
+    removals = []
+    for agent in agents:
+        for sub_account_id in agent.sub_account_ids:
+            position = agent.get_perp_position(market_index, sub_account_id)
+            if position is not None and position.lp_shares > 0:
+                removals.append(LpRemoval(agent, sub_account_id, position.lp_shares))
+    return removals
+
+
+async def unwind_lp_positions(
+    admin: Admin,
+    agents: list[DriftClient],
+    market_index: int,
+    confirmer: SignatureConfirmer,
+    concurrency: int = 32,
+    removals: Optional[list[LpRemoval]] = None,
+) -> LpUnwindResult:
+    """
+    Removes every agent subaccount's lp shares in `market_index` with at most
+    `concurrency` removals in flight, confirms them as one batch and then checks
+    market.amm.user_lp_shares against the sum of the removed shares once.
+    Pass `removals` to resubmit only those, e.g. the failures of an earlier unwind.
+    """
+    start = time.time()
+    perp_market = admin.get_perp_market_account(market_index)
+    before_user_lp_shares = perp_market.amm.user_lp_shares  # type: ignore
+
+    if removals is None:
+        removals = lp_removals(agents, market_index)
+    else:
+        removals = [LpRemoval(r.agent, r.sub_account_id, r.shares) for r in removals]
+
+    print(
+        f"removing {sum(r.shares for r in removals)} lp shares "
+        f"from {len(removals)} subaccounts on market {market_index}"
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def submit(removal: LpRemoval):
+        async with semaphore:
+            try:
+                async with metrics.track(
+                    "remove_liquidity", removal.agent.connection
+                ) as sample:
+                    removal.sig = await removal.agent.remove_liquidity(
+                        removal.shares, market_index, removal.sub_account_id
+                    )
+                    sample.sig = removal.sig
+            except Exception as e:
+                removal.error = e
+
+    await asyncio.gather(*[submit(removal) for removal in removals])
+
+    submitted = [removal for removal in removals if removal.sig is not None]
+    results = await confirmer.confirm_all([removal.sig for removal in submitted])
+    for removal, result in zip(submitted, results):
+        if not result.ok:
+            removal.error = result.err if result.err is not None else "unconfirmed"
+
+    for removal in removals:
+        if removal.error is not None:
+            print(
+                f"failed to remove lp for user: {removal.agent.authority} "
+                f"(sub_account_id: {removal.sub_account_id}): {removal.error}"
+            )
+
+    removed_shares = sum(r.shares for r in removals if r.error is None)
+    expected_lp_shares = before_user_lp_shares - removed_shares
+    await wait_for_perp_market(
+        admin,
+        market_index,
+        lambda m: m.amm.user_lp_shares == expected_lp_shares,
+        description=f"user lp shares == {expected_lp_shares}",
+    )
+
+    elapsed = time.time() - start
+    print(f"removed {removed_shares} lp shares in {elapsed:.2f}s")
+
+    return LpUnwindResult(removals, before_user_lp_shares, removed_shares, elapsed)
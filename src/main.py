@@ -21,7 +21,8 @@ from termcolor import colored
 from solders.instruction import Instruction  # type: ignore
 
 from solana.rpc.core import RPCException  # type: ignore
-import re  # type: ignore
+
+from src.metrics import compute_units_from_meta, fetch_transaction_meta, metrics
 
 
 @dataclass
@@ -74,6 +75,11 @@ class Event:
         event = Event.deserialize_from_row(class_type, event_row)
         return event.run_sdk(clearing_house)
 
+    # typed counterpart of run_row_sdk for batches streamed by src.eventlog
+    @staticmethod
+    async def run_batch_sdk(clearing_house: DriftClient, events: list["Event"]):
+        return [await event.run_sdk(clearing_house) for event in events]
+
     def run(self, clearing_house: DriftClient) -> DriftClient:
         raise NotImplementedError
 
@@ -101,7 +107,7 @@ class SettleLPEvent(Event):
 
     async def run_sdk(self, clearing_house: DriftClient):
         return await clearing_house.get_settle_lp_ix(
-            clearing_house.authority, self.market_index
+            clearing_house.get_user_account_public_key(), self.market_index
         )
 
 
@@ -123,8 +129,10 @@ class SettlePnLEvent(Event):
 
         user_account = clearing_house.get_user_account()
 
-        return await clearing_house.get_settle_pnl_ix(
-            clearing_house.authority, user_account, self.market_index
+        return clearing_house.get_settle_pnl_ix(
+            clearing_house.get_user_account_public_key(),
+            user_account,
+            self.market_index,
         )
 
 
@@ -158,7 +166,8 @@ class ClosePositionEvent(Event):
             if _position.market_index == self.market_index:
                 position = _position
                 break
-        assert position is not None, "user not in market"
+        if position is None or position.base_asset_amount == 0:
+            return None
 
         direction = (
             PositionDirection.Long()
@@ -174,7 +183,15 @@ class ClosePositionEvent(Event):
                 position.base_asset_amount, direction, market, oracle_program  # type: ignore
             )
 
-        return await clearing_house.get_close_position_ix(self.market_index)
+        # reduce only market order, filled against the amm in the same ix
+        order_params = OrderParams(
+            order_type=OrderType.Market(),
+            base_asset_amount=abs(position.base_asset_amount),
+            market_index=self.market_index,
+            direction=direction,
+            reduce_only=True,
+        )
+        return clearing_house.get_place_and_take_perp_order_ix(order_params)
 
 
 async def _send_ix(
@@ -189,18 +206,23 @@ async def _send_ix(
     failed = 1  # 1 = fail, 0 = success
     provider: Provider = ch.program.provider
     slot = (await provider.connection.get_slot()).value
-    compute_used = -1
     err = None
     sig = None
     logs = None
     try:
-        if event_name == SettleLPEvent._event_name:
-            sig = await ch.send_ixs(ix, signers=[])
-        else:
-            sig = await ch.send_ixs(ix)
+        async with metrics.track(event_name) as sample:
+            if event_name == SettleLPEvent._event_name:
+                sig = await ch.send_ixs(ix, signers=[])
+            else:
+                sig = await ch.send_ixs(ix)
+            sample.sig = sig
         failed = 0
         if view_logs_flag:
-            logs = await view_logs(sig, provider, False)  # type: ignore
+            meta = await fetch_transaction_meta(provider.connection, sig)
+            logs = meta.log_messages if meta is not None else None
+            sample.compute_units = compute_units_from_meta(meta)
+        else:
+            metrics.fill_compute_units(provider.connection, sample)
 
     except RPCException as e:
         err = e.args
@@ -213,18 +235,10 @@ async def _send_ix(
         pprint.pprint(err)
 
     if logs:
-        try:
-            logs = await logs
-            if view_logs_flag:
-                pprint.pprint(logs)
-            for log in logs:
-                if "compute units" in log:
-                    result = re.search(r".* consumed (\d+) of (\d+)", log)
-                    compute_used = result.group(1)  # type: ignore
-        except Exception as e:
-            pprint.pprint(e)
+        pprint.pprint(logs)
 
     # ix_args["user_index"] = ch.active_sub_account_id
 
-    # return failed, sig, (slot, event_name, ix_args, err, compute_used)
-    return failed, sig, (slot, event_name, err, compute_used)
+    # compute units are recorded on the metrics sample, see `metrics.summary`
+    # return failed, sig, (slot, event_name, ix_args, err)
+    return failed, sig, (slot, event_name, err)
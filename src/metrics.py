@@ -0,0 +1,218 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.core import RPCException
+
+from src.confirm import to_signature
+
+PERCENTILES = [50, 95, 99]
+
+compute_units_pattern = re.compile(r".* consumed (\d+) of (\d+)")
+anchor_error_pattern = re.compile(r"Error Code: (\w+)")
+custom_error_pattern = re.compile(r"custom program error: (0x[0-9a-fA-F]+)")
+
+
+@dataclass
+class InstructionSample:
+    event_type: str
+    latency: float
+    compute_units: Optional[int] = None
+    retries: int = 0
+    error_code: Optional[str] = None
+    sig: Any = None
+
+
+def parse_compute_units(logs: list[str]) -> Optional[int]:
+    # the last "consumed N of M" line belongs to the outermost program invocation
+    compute_units = None
+    for log in logs:
+        result = compute_units_pattern.search(log)
+        if result:
+            compute_units = int(result.group(1))
+    return compute_units
+
+
+def error_code_from_logs(logs: list[str]) -> Optional[str]:
+    for pattern in [anchor_error_pattern, custom_error_pattern]:
+        for log in logs:
+            match = pattern.search(log)
+            if match:
+                return match.group(1)
+    return None
+
+
+def error_code_from_exception(e: BaseException) -> str:
+    if isinstance(e, RPCException) and len(e.args) > 0:
+        logs = getattr(getattr(e.args[0], "data", None), "logs", None)
+        if logs:
+            code = error_code_from_logs(logs)
+            if code is not None:
+                return code
+    return type(e).__name__
+
+
+async def fetch_transaction_meta(connection: AsyncClient, sig):
+    resp = await connection.get_transaction(
+        to_signature(sig), commitment="confirmed", max_supported_transaction_version=0
+    )
+    if resp.value is None:
+        return None
+    return resp.value.transaction.meta
+
+
+def compute_units_from_meta(meta) -> Optional[int]:
+    if meta is None:
+        return None
+    if meta.compute_units_consumed is not None:
+        return meta.compute_units_consumed
+    return parse_compute_units(meta.log_messages or [])
+
+
+async def fetch_compute_units(connection: AsyncClient, sig) -> Optional[int]:
+    return compute_units_from_meta(await fetch_transaction_meta(connection, sig))
+
+
+def percentiles(values: list) -> dict:
+    if len(values) == 0:
+        return {}
+    arr = np.asarray(values, dtype=np.float64)
+    summary = {
+        f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(arr, PERCENTILES))
+    }
+    summary["mean"] = float(arr.mean())
+    summary["max"] = float(arr.max())
+    counts, edges = np.histogram(arr, bins=10)
+    summary["histogram"] = {"counts": counts.tolist(), "edges": edges.tolist()}
+    return summary
+
+
+class MetricsCollector:
+    """
+    Collects latency, compute units, retries and error codes per event type
+    (settle_pnl, close_position, settle_lp, admin actions, ...).
+
+    Compute units are looked up with getTransaction in the background after
+    the tracked block exits so they never add to the measured latency; call
+    `flush` before reading the summary.
+    """
+
+    def __init__(self, collect_compute_units: bool = True):
+        self.collect_compute_units = collect_compute_units
+        self.samples: dict[str, list[InstructionSample]] = defaultdict(list)
+        self.pending: list[asyncio.Task] = []
+
+    def reset(self):
+        for task in self.pending:
+            task.cancel()
+        self.samples = defaultdict(list)
+        self.pending = []
+
+    def record(self, sample: InstructionSample):
+        self.samples[sample.event_type].append(sample)
+
+    async def _fill_compute_units(
+        self, connection: AsyncClient, sample: InstructionSample
+    ):
+        try:
+            sample.compute_units = await fetch_compute_units(connection, sample.sig)
+        except Exception as e:
+            print(f"failed to fetch compute units for {sample.sig}: {e}")
+
+    @asynccontextmanager
+    async def track(
+        self,
+        event_type: str,
+        connection: Optional[AsyncClient] = None,
+        retries: int = 0,
+    ):
+        """
+        Times the wrapped block. Set `sample.sig` inside the block to have the
+        compute units of that tx filled in; exceptions are recorded and re-raised.
+        """
+        sample = InstructionSample(event_type, 0.0, retries=retries)
+        start = time.perf_counter()
+        try:
+            yield sample
+        except BaseException as e:
+            sample.error_code = error_code_from_exception(e)
+            raise
+        finally:
+            sample.latency = time.perf_counter() - start
+            self.record(sample)
+            if connection is not None:
+                self.fill_compute_units(connection, sample)
+
+    def fill_compute_units(self, connection: AsyncClient, sample: InstructionSample):
+        if (
+            self.collect_compute_units
+            and sample.sig is not None
+            and sample.compute_units is None
+        ):
+            self.pending.append(
+                asyncio.create_task(self._fill_compute_units(connection, sample))
+            )
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        await asyncio.gather(*pending)
+
+    def summary(self) -> dict:
+        summary = {}
+        for event_type, samples in sorted(self.samples.items()):
+            errors = Counter(s.error_code for s in samples if s.error_code is not None)
+            summary[event_type] = {
+                "count": len(samples),
+                "errors": sum(errors.values()),
+                "retries": sum(s.retries for s in samples),
+                "error_codes": dict(errors),
+                "latency_s": percentiles([s.latency for s in samples]),
+                "compute_units": percentiles(
+                    [s.compute_units for s in samples if s.compute_units is not None]
+                ),
+            }
+        return summary
+
+    def print_summary(self):
+        print(
+            f"{'event':<24} {'n':>6} {'err':>5} "
+            f"{'lat p50/p95/p99 (s)':>24} {'cu p50/p95/p99':>24}"
+        )
+        for event_type, stats in self.summary().items():
+            latency = stats["latency_s"]
+            cu = stats["compute_units"]
+            latency_str = "/".join(f"{latency[f'p{p}']:.3f}" for p in PERCENTILES)
+            cu_str = (
+                "/".join(f"{cu[f'p{p}']:.0f}" for p in PERCENTILES) if cu else "-"
+            )
+            print(
+                f"{event_type:<24} {stats['count']:>6} {stats['errors']:>5} "
+                f"{latency_str:>24} {cu_str:>24}"
+            )
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "commit": os.environ.get("COMMIT"),
+                    "created_at": time.time(),
+                    "events": self.summary(),
+                },
+                f,
+                indent=4,
+            )
+        print(f"metrics written to {path}")
+
+
+# process wide collector shared by the event runners, actions and scenarios
+metrics = MetricsCollector()
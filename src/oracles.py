@@ -0,0 +1,142 @@
+import asyncio
+
+from fractions import Fraction
+from pathlib import Path
+from typing import Optional
+
+from anchorpy import Context, Idl, Program, Provider
+
+from solders.instruction import Instruction  # type: ignore
+from solders.pubkey import Pubkey  # type: ignore
+from solders.signature import Signature  # type: ignore
+
+from driftpy.admin import Admin
+from driftpy.constants.numeric_constants import PRICE_PRECISION
+from driftpy.drift_client import DEFAULT_TX_OPTIONS
+from driftpy.setup.helpers import parse_price_data
+from driftpy.types import OracleSource
+
+from src.recorder import recorder
+
+PYTH_PROGRAM_ID = Pubkey.from_string("FsJ3A3u2vn5cTVofAjvy6y5kwABJAqYWpe4975bi2epH")
+PYTH_IDL_PATH = Path("src/pyth.json")
+
+# a setPrice ix is one account and 16 bytes of data: 20 of them fill a legacy tx,
+# leave room for the compute budget ixs send_ixs may add
+MAX_PRICE_UPDATES_PER_TX = 16
+# getMultipleAccounts accepts at most 100 keys per request
+ACCOUNTS_PER_REQUEST = 100
+# drift prices of these sources are the feed price times the multiplier
+ORACLE_SOURCE_MULTIPLIERS = {"Pyth1K": 1_000, "Pyth1M": 1_000_000}
+
+
+def oracle_source_multiplier(oracle_source: OracleSource) -> int:
+    return ORACLE_SOURCE_MULTIPLIERS.get(type(oracle_source).__name__, 1)
+
+
+def to_feed_price(price: int, exponent: int, multiplier: int = 1) -> int:
+    """
+    Converts a PRICE_PRECISION price to the feed's integer price. `multiplier`
+    is the oracle source's scale, e.g. 1000 for Pyth1K feeds.
+    """
+    return int(
+        Fraction(price, PRICE_PRECISION * multiplier) * Fraction(10) ** -exponent
+    )
+
+
+class OracleController:
+    """
+    Sets mock pyth prices. The IDL is loaded once and feed exponents are
+    cached, so an update costs no reads, and `set_prices` packs the
+    `setPrice` ixs for many feeds into as few txs as fit.
+    """
+
+    def __init__(self, admin: Admin, program_id: Pubkey = PYTH_PROGRAM_ID):
+        self.admin = admin
+        idl = Idl.from_json(PYTH_IDL_PATH.read_text())
+        provider = Provider(admin.connection, admin.wallet, DEFAULT_TX_OPTIONS)
+        self.program = Program(idl, program_id, provider)
+        self.exponents: dict[Pubkey, int] = {}
+
+    async def get_exponents(self, oracles: list[Pubkey]) -> dict[Pubkey, int]:
+        missing = [oracle for oracle in oracles if oracle not in self.exponents]
+        for i in range(0, len(missing), ACCOUNTS_PER_REQUEST):
+            chunk = missing[i : i + ACCOUNTS_PER_REQUEST]
+            resp = await self.admin.connection.get_multiple_accounts(chunk)
+            for oracle, account in zip(chunk, resp.value):
+                if account is None:
+                    raise ValueError(f"oracle {oracle} does not exist")
+                self.exponents[oracle] = parse_price_data(account.data).exponent
+        return {oracle: self.exponents[oracle] for oracle in oracles}
+
+    async def set_price_ixs(
+        self,
+        prices: dict[Pubkey, int],
+        multipliers: Optional[dict[Pubkey, int]] = None,
+    ) -> list[Instruction]:
+        exponents = await self.get_exponents(list(prices.keys()))
+        multipliers = multipliers if multipliers is not None else {}
+        return [
+            self.program.instruction["set_price"](
+                to_feed_price(price, exponents[oracle], multipliers.get(oracle, 1)),
+                ctx=Context(accounts={"price": oracle}),
+            )
+            for oracle, price in prices.items()
+        ]
+
+    async def _send(
+        self, prices: dict[Pubkey, int], multipliers: Optional[dict[Pubkey, int]]
+    ) -> Signature:
+        multipliers = multipliers if multipliers is not None else {}
+        ixs = await self.set_price_ixs(prices, multipliers)
+        try:
+            # the updates are recorded below, not as the tx sender's raw ixs
+            with recorder.suppressed():
+                sig = (await self.admin.send_ixs(ixs)).tx_sig
+        except Exception:
+            for oracle, price in prices.items():
+                recorder.record_oracle_update(
+                    oracle, price, None, multipliers.get(oracle, 1)
+                )
+            raise
+        for oracle, price in prices.items():
+            multiplier = multipliers.get(oracle, 1)
+            recorder.record_oracle_update(oracle, price, sig, multiplier)
+        return sig
+
+    async def set_prices(
+        self,
+        prices: dict[Pubkey, int],
+        multipliers: Optional[dict[Pubkey, int]] = None,
+    ) -> list[Signature]:
+        """
+        Sets every oracle in `prices` (oracle -> price in PRICE_PRECISION),
+        sending one tx per `MAX_PRICE_UPDATES_PER_TX` feeds concurrently.
+        `multipliers` maps oracles of scaled sources (Pyth1K/Pyth1M) to their
+        scale, so `prices` can be given as drift sees them.
+        """
+        items = list(prices.items())
+        chunks = [
+            dict(items[i : i + MAX_PRICE_UPDATES_PER_TX])
+            for i in range(0, len(items), MAX_PRICE_UPDATES_PER_TX)
+        ]
+        return list(
+            await asyncio.gather(*[self._send(chunk, multipliers) for chunk in chunks])
+        )
+
+    async def set_price(
+        self, oracle: Pubkey, price: int, multiplier: int = 1
+    ) -> Signature:
+        return (await self.set_prices({oracle: price}, {oracle: multiplier}))[0]
+
+
+_controllers: dict[Pubkey, OracleController] = {}
+
+
+def get_oracle_controller(admin: Admin) -> OracleController:
+    """Returns the process wide controller for the admin's authority"""
+    controller: Optional[OracleController] = _controllers.get(admin.authority)
+    if controller is None or controller.admin is not admin:
+        controller = OracleController(admin)
+        _controllers[admin.authority] = controller
+    return controller
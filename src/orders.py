@@ -0,0 +1,84 @@
+import asyncio
+
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from driftpy.drift_client import DriftClient
+from driftpy.types import MarketType, UserAccount, is_variant
+
+OrderKey = tuple[str, int]  # (market type, market index)
+UserKey = tuple[int, int]  # (agent index, sub account id)
+
+
+def order_key(market_type: MarketType, market_index: int) -> OrderKey:
+    return (type(market_type).__name__, market_index)
+
+
+def count_open_orders(user_account: UserAccount) -> dict[OrderKey, int]:
+    counts: dict[OrderKey, int] = defaultdict(int)
+    for order in user_account.orders:
+        if is_variant(order.status, "Open"):
+            counts[order_key(order.market_type, order.market_index)] += 1
+    return counts
+
+
+class OpenOrderIndex:
+    """
+    Open orders of every agent subaccount, by market. Built from the agents'
+    cached user accounts with one pass over each `orders` array; a subaccount
+    is re-indexed by `update_user` / `refresh_users` when its account changes.
+    """
+
+    def __init__(self, agents: list[DriftClient]):
+        self.agents = agents
+        self.index: dict[OrderKey, dict[UserKey, int]] = defaultdict(dict)
+        self.by_user: dict[UserKey, dict[OrderKey, int]] = {}
+
+    def keys(self) -> list[UserKey]:
+        return [
+            (i, sub_account_id)
+            for i, agent in enumerate(self.agents)
+            for sub_account_id in agent.sub_account_ids
+        ]
+
+    def update_user(self, key: UserKey, user_account: Optional[UserAccount] = None):
+        if user_account is None:
+            agent_index, sub_account_id = key
+            user_account = self.agents[agent_index].get_user_account(sub_account_id)
+
+        for market in self.by_user.pop(key, {}):
+            self.index[market].pop(key, None)
+            if len(self.index[market]) == 0:
+                del self.index[market]
+
+        counts = count_open_orders(user_account)  # type: ignore
+        if len(counts) > 0:
+            self.by_user[key] = counts
+        for market, count in counts.items():
+            self.index[market][key] = count
+
+    def build(self):
+        self.index.clear()
+        self.by_user.clear()
+        for key in self.keys():
+            self.update_user(key)
+
+    async def refresh_users(self, keys: Optional[Iterable[UserKey]] = None):
+        """Re-reads the user accounts of `keys` (default all) and re-indexes them"""
+        keys = list(keys) if keys is not None else self.keys()
+
+        async def refresh(key: UserKey):
+            agent_index, sub_account_id = key
+            user = self.agents[agent_index].get_user(sub_account_id)
+            await user.account_subscriber.update_cache()
+
+        await asyncio.gather(*[refresh(key) for key in keys])
+        for key in keys:
+            self.update_user(key)
+
+    def users(self, market_type: MarketType, market_index: int) -> dict[UserKey, int]:
+        """(agent index, sub account id) -> open order count in the market"""
+        return dict(self.index.get(order_key(market_type, market_index), {}))
+
+    def count(self, market_type: MarketType, market_index: int) -> int:
+        return sum(self.users(market_type, market_index).values())
@@ -0,0 +1,226 @@
+import asyncio
+import base64
+import re
+
+from dataclasses import dataclass, field, replace
+from typing import Any, Optional, Sequence
+
+from solana.rpc.async_api import AsyncClient
+
+from solders.compute_budget import set_compute_unit_limit  # type: ignore
+from solders.hash import Hash  # type: ignore
+from solders.instruction import Instruction  # type: ignore
+from solders.message import Message  # type: ignore
+from solders.pubkey import Pubkey  # type: ignore
+from solders.transaction import Transaction  # type: ignore
+
+# getMultipleAccounts accepts at most 100 keys per request
+ACCOUNTS_PER_REQUEST = 100
+SIMULATIONS_PER_BATCH = 100
+
+error_message_pattern = re.compile(r"Error Message: (.+)")
+
+
+class PreflightError(Exception):
+    """Raised in place of sending a tx that a (cached) simulation says will fail"""
+
+
+@dataclass
+class SimulationOutcome:
+    ok: bool
+    err: Any = None
+    logs: list[str] = field(default_factory=list)
+    units_consumed: Optional[int] = None
+    cached: bool = False
+
+    @property
+    def error_message(self) -> Optional[str]:
+        for log in self.logs:
+            match = error_message_pattern.search(log)
+            if match:
+                return match.group(1)
+        return None if self.err is None else str(self.err)
+
+
+def touched_accounts(ixs: Sequence[Instruction]) -> list[Pubkey]:
+    accounts: dict[Pubkey, None] = {}
+    for ix in ixs:
+        accounts[ix.program_id] = None
+        for meta in ix.accounts:
+            accounts[meta.pubkey] = None
+    return list(accounts.keys())
+
+
+def instruction_key(payer: Pubkey, ixs: Sequence[Instruction]) -> tuple:
+    return (payer,) + tuple(
+        (
+            ix.program_id,
+            bytes(ix.data),
+            tuple((meta.pubkey, meta.is_writable) for meta in ix.accounts),
+        )
+        for ix in ixs
+    )
+
+
+class PreflightCache:
+    """
+    Optional preflight stage: simulates txs in batched `simulateTransaction`
+    requests and caches each outcome keyed by the instructions plus a version
+    (hash of the raw data) of every account they touch.
+
+    Versions are read with one batched `getMultipleAccounts` per check, so a
+    cached outcome is only reused while none of its touched accounts changed;
+    a new version replaces the stale entry.
+    """
+
+    def __init__(
+        self, connection: AsyncClient, compute_unit_limit: int = 1_400_000
+    ):
+        self.connection = connection
+        self.compute_unit_limit = compute_unit_limit
+        # instruction key -> (account versions, outcome)
+        self.outcomes: dict[tuple, tuple[tuple, SimulationOutcome]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _post(self, requests: list[dict]) -> list[dict]:
+        provider = self.connection._provider
+        resp = await provider.session.post(provider.endpoint_uri, json=requests)
+        return sorted(resp.json(), key=lambda r: r["id"])
+
+    async def fetch_versions(self, pubkeys: list[Pubkey]) -> dict[Pubkey, int]:
+        chunks = [
+            pubkeys[i : i + ACCOUNTS_PER_REQUEST]
+            for i in range(0, len(pubkeys), ACCOUNTS_PER_REQUEST)
+        ]
+        requests = [
+            {
+                "jsonrpc": "2.0",
+                "id": i,
+                "method": "getMultipleAccounts",
+                "params": [
+                    [str(pubkey) for pubkey in chunk],
+                    {"encoding": "base64", "commitment": "confirmed"},
+                ],
+            }
+            for i, chunk in enumerate(chunks)
+        ]
+        if len(requests) == 0:
+            return {}
+
+        versions = {}
+        for chunk, resp in zip(chunks, await self._post(requests)):
+            for pubkey, account in zip(chunk, resp["result"]["value"]):
+                data = None if account is None else account["data"][0]
+                versions[pubkey] = hash(data)
+        return versions
+
+    def _simulation_request(
+        self, i: int, payer: Pubkey, ixs: Sequence[Instruction]
+    ) -> dict:
+        ixs = [set_compute_unit_limit(self.compute_unit_limit)] + list(ixs)
+        message = Message.new_with_blockhash(ixs, payer, Hash.default())
+        tx = Transaction.new_unsigned(message)
+        return {
+            "jsonrpc": "2.0",
+            "id": i,
+            "method": "simulateTransaction",
+            "params": [
+                base64.b64encode(bytes(tx)).decode("utf-8"),
+                {
+                    "encoding": "base64",
+                    "sigVerify": False,
+                    "replaceRecentBlockhash": True,
+                    "commitment": "confirmed",
+                },
+            ],
+        }
+
+    async def _simulate(
+        self, items: list[tuple[Pubkey, Sequence[Instruction]]]
+    ) -> list[SimulationOutcome]:
+        batches = [
+            items[i : i + SIMULATIONS_PER_BATCH]
+            for i in range(0, len(items), SIMULATIONS_PER_BATCH)
+        ]
+        responses = await asyncio.gather(
+            *[
+                self._post(
+                    [
+                        self._simulation_request(i, payer, ixs)
+                        for i, (payer, ixs) in enumerate(batch)
+                    ]
+                )
+                for batch in batches
+            ]
+        )
+
+        outcomes = []
+        for resp in [r for batch in responses for r in batch]:
+            if "error" in resp:
+                outcomes.append(SimulationOutcome(False, resp["error"]))
+                continue
+            value = resp["result"]["value"]
+            outcomes.append(
+                SimulationOutcome(
+                    value["err"] is None,
+                    value["err"],
+                    value.get("logs") or [],
+                    value.get("unitsConsumed"),
+                )
+            )
+        return outcomes
+
+    async def check(
+        self, items: list[tuple[Pubkey, Sequence[Instruction]]]
+    ) -> list[SimulationOutcome]:
+        """
+        Returns one outcome per (payer, ixs) item, simulating only the items
+        whose instructions or touched accounts are not already cached.
+        """
+        pubkeys: dict[Pubkey, None] = {}
+        for payer, ixs in items:
+            pubkeys[payer] = None
+            for pubkey in touched_accounts(ixs):
+                pubkeys[pubkey] = None
+        versions = await self.fetch_versions(list(pubkeys.keys()))
+
+        results: list[Optional[SimulationOutcome]] = []
+        keys = []
+        misses = []
+        for i, (payer, ixs) in enumerate(items):
+            key = instruction_key(payer, ixs)
+            account_versions = tuple(
+                versions.get(pubkey) for pubkey in [payer] + touched_accounts(ixs)
+            )
+            keys.append((key, account_versions))
+
+            cached = self.outcomes.get(key)
+            if cached is not None and cached[0] == account_versions:
+                results.append(replace(cached[1], cached=True))
+            else:
+                results.append(None)
+                misses.append(i)
+
+        self.hits += len(items) - len(misses)
+        self.misses += len(misses)
+
+        if len(misses) > 0:
+            # identical txs in one check only need to be simulated once
+            unique: dict[tuple, int] = {}
+            for i in misses:
+                unique.setdefault(keys[i], i)
+            outcomes = await self._simulate([items[i] for i in unique.values()])
+            simulated = dict(zip(unique.keys(), outcomes))
+            for i in misses:
+                key, account_versions = keys[i]
+                self.outcomes[key] = (account_versions, simulated[keys[i]])
+                results[i] = simulated[keys[i]]
+
+        return results  # type: ignore
+
+    async def should_send(self, payer: Pubkey, ixs: Sequence[Instruction]) -> bool:
+        return (await self.check([(payer, ixs)]))[0].ok
+
+    def clear(self):
+        self.outcomes.clear()
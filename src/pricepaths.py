@@ -0,0 +1,210 @@
+"""
+Vectorized oracle price paths for every perp and spot market at once.
+
+Paths are (n_steps + 1, n_feeds) arrays in PRICE_PRECISION, row 0 being the
+cloned `historical_oracle_data.last_oracle_price` of each feed. They are
+played through the `OracleController`, so each step moves every feed in one
+batch of txs, on a fixed slot schedule.
+"""
+import time
+
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import numpy as np
+
+from solders.pubkey import Pubkey  # type: ignore
+from solders.signature import Signature  # type: ignore
+
+from driftpy.admin import Admin
+from driftpy.types import OracleSource
+
+from src.oracles import (
+    OracleController,
+    get_oracle_controller,
+    oracle_source_multiplier,
+)
+from src.recorder import SlotClock
+
+# sources without a settable pyth feed
+FIXED_ORACLE_SOURCES = {"QuoteAsset"}
+
+Sigma = Union[float, np.ndarray]
+
+
+def oracle_source_name(oracle_source: OracleSource) -> str:
+    return type(oracle_source).__name__
+
+
+@dataclass
+class PriceFeed:
+    oracle: Pubkey
+    oracle_source: OracleSource
+    price: int
+    twap: int
+    twap_5min: int
+    # e.g. ["perp 0", "spot 1"], markets sharing the oracle move together
+    markets: list[str] = field(default_factory=list)
+
+    @property
+    def multiplier(self) -> int:
+        return oracle_source_multiplier(self.oracle_source)
+
+
+def load_price_feeds(admin: Admin, include_spot: bool = True) -> list[PriceFeed]:
+    """One feed per distinct oracle of the admin's cached perp/spot markets"""
+    perp_markets = admin.get_perp_market_accounts()
+    markets = [("perp", market, market.amm) for market in perp_markets]
+    if include_spot:
+        markets += [
+            ("spot", market, market) for market in admin.get_spot_market_accounts()
+        ]
+
+    feeds: dict[Pubkey, PriceFeed] = {}
+    for kind, market, oracle_info in markets:
+        if oracle_source_name(oracle_info.oracle_source) in FIXED_ORACLE_SOURCES:
+            continue
+        data = oracle_info.historical_oracle_data
+        feed = feeds.get(oracle_info.oracle)
+        if feed is None:
+            feed = PriceFeed(
+                oracle_info.oracle,
+                oracle_info.oracle_source,
+                data.last_oracle_price,
+                data.last_oracle_price_twap,
+                data.last_oracle_price_twap5min,
+            )
+            feeds[oracle_info.oracle] = feed
+        feed.markets.append(f"{kind} {market.market_index}")
+    return list(feeds.values())
+
+
+def start_prices(feeds: list[PriceFeed]) -> np.ndarray:
+    return np.array([feed.price for feed in feeds], dtype=np.float64)
+
+
+def uniform_correlation(n: int, rho: float) -> np.ndarray:
+    corr = np.full((n, n), rho, dtype=np.float64)
+    np.fill_diagonal(corr, 1.0)
+    return corr
+
+
+def correlated_normals(
+    rng: np.random.Generator, n_steps: int, corr: np.ndarray
+) -> np.ndarray:
+    """(n_steps, n) standard normals with correlation `corr` across columns"""
+    # eigh tolerates the semi-definite matrices cholesky rejects (e.g. rho=1)
+    eigenvalues, eigenvectors = np.linalg.eigh(corr)
+    root = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+    return rng.standard_normal((n_steps, corr.shape[0])) @ root.T
+
+
+def _from_log_returns(start: np.ndarray, log_returns: np.ndarray) -> np.ndarray:
+    log_paths = np.vstack([np.zeros(len(start)), np.cumsum(log_returns, axis=0)])
+    return start * np.exp(log_paths)
+
+
+def gbm_paths(
+    start: np.ndarray,
+    n_steps: int,
+    sigma: Sigma,
+    mu: Sigma = 0.0,
+    corr: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """Geometric brownian motion, `sigma` and `mu` are per step"""
+    rng = np.random.default_rng(seed)
+    corr = np.eye(len(start)) if corr is None else corr
+    z = correlated_normals(rng, n_steps, corr)
+    sigma = np.asarray(sigma, dtype=np.float64)
+    log_returns = (mu - 0.5 * sigma**2) + sigma * z
+    return _from_log_returns(start, log_returns)
+
+
+def jump_diffusion_paths(
+    start: np.ndarray,
+    n_steps: int,
+    sigma: Sigma,
+    jump_intensity: float,
+    jump_mean: float,
+    jump_std: float,
+    mu: Sigma = 0.0,
+    corr: Optional[np.ndarray] = None,
+    common_jumps: bool = True,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Merton jump diffusion: GBM plus Poisson(`jump_intensity` per step) jumps
+    with normally distributed log sizes. With `common_jumps` every market
+    jumps at the same steps, i.e. a market-wide crash.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(start)
+    corr = np.eye(n) if corr is None else corr
+    z = correlated_normals(rng, n_steps, corr)
+    sigma = np.asarray(sigma, dtype=np.float64)
+    log_returns = (mu - 0.5 * sigma**2) + sigma * z
+
+    jump_shape = (n_steps, 1) if common_jumps else (n_steps, n)
+    jumps = rng.poisson(jump_intensity, jump_shape)
+    noise = rng.standard_normal(jump_shape)
+    jump_sizes = jumps * jump_mean + np.sqrt(jumps) * jump_std * noise
+    return _from_log_returns(start, log_returns + jump_sizes)
+
+
+def twap_history(feeds: list[PriceFeed]) -> np.ndarray:
+    """(3, n) of the cloned twap, 5min twap and last price, oldest first"""
+    return np.array(
+        [
+            [feed.twap for feed in feeds],
+            [feed.twap_5min for feed in feeds],
+            [feed.price for feed in feeds],
+        ],
+        dtype=np.float64,
+    )
+
+
+def twap_replay_paths(history: np.ndarray, n_steps: int) -> np.ndarray:
+    """Linearly resamples a (n_points, n) price history to n_steps + 1 rows"""
+    points = np.linspace(0, 1, history.shape[0])
+    steps = np.linspace(0, 1, n_steps + 1)
+    return np.column_stack(
+        [np.interp(steps, points, history[:, i]) for i in range(history.shape[1])]
+    )
+
+
+async def play_price_paths(
+    admin: Admin,
+    feeds: list[PriceFeed],
+    paths: np.ndarray,
+    slots_per_step: int = 2,
+    controller: Optional[OracleController] = None,
+) -> list[list[Signature]]:
+    """
+    Sets every feed to row k of `paths` at `k * slots_per_step` slots after
+    the start, one batched `set_prices` per step. Row 0 is the start state
+    and is not sent. Returns the tx signatures of each step.
+    """
+    controller = controller if controller is not None else get_oracle_controller(admin)
+    multipliers = {feed.oracle: feed.multiplier for feed in feeds}
+    int_paths = np.maximum(np.rint(paths), 1).astype(np.int64)
+
+    clock = SlotClock(admin.connection)
+    start_slot = await clock.start()
+    start = time.time()
+    sigs = []
+    try:
+        for step in range(1, len(int_paths)):
+            await clock.wait_for(start_slot + step * slots_per_step)
+            prices = {
+                feed.oracle: int(price) for feed, price in zip(feeds, int_paths[step])
+            }
+            sigs.append(await controller.set_prices(prices, multipliers))
+    finally:
+        clock.stop()
+
+    print(
+        f"played {len(int_paths) - 1} steps over {len(feeds)} feeds "
+        f"in {time.time() - start:.2f}s"
+    )
+    return sigs
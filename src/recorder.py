@@ -0,0 +1,361 @@
+"""
+Records everything a simulation run does to the chain (admin actions, oracle
+updates and agent instructions) into an event log, and replays a recorded run
+against a fresh snapshot at the same relative slots.
+
+    await recorder.start("runs/<name>", connection)
+    ...  # run the simulation
+    await recorder.stop()
+
+    await replay("runs/<name>", admin, agents)
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import time
+
+from dataclasses import dataclass, fields
+from typing import Any, Optional, Sequence
+
+from solana.rpc.async_api import AsyncClient
+
+from solders.compute_budget import ID as COMPUTE_BUDGET_PROGRAM_ID  # type: ignore
+from solders.instruction import AccountMeta, Instruction  # type: ignore
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.admin import Admin
+from driftpy.drift_client import DriftClient
+
+from src.eventlog import EventLogReader, EventLogWriter
+from src.main import Event
+
+
+@dataclass
+class ActionRecord(Event):
+    slot: int
+    action: str
+    market_index: int
+    parameters: str
+    sig: str
+    ok: bool
+    _event_name: str = "recorded_action"
+
+
+@dataclass
+class OracleUpdateRecord(Event):
+    slot: int
+    oracle: str
+    price: int
+    sig: str
+    ok: bool
+    # logs written before multipliers were recorded have no such column
+    multiplier: int = 1
+    _event_name: str = "recorded_oracle_update"
+
+
+@dataclass
+class InstructionRecord(Event):
+    slot: int
+    authority: str
+    instructions: str
+    sig: str
+    ok: bool
+    error: str
+    _event_name: str = "recorded_instruction"
+
+
+def serialize_instructions(ixs: Sequence[Instruction]) -> str:
+    return json.dumps(
+        [
+            {
+                "program_id": str(ix.program_id),
+                "data": bytes(ix.data).hex(),
+                "accounts": [
+                    [str(meta.pubkey), meta.is_signer, meta.is_writable]
+                    for meta in ix.accounts
+                ],
+            }
+            for ix in ixs
+        ]
+    )
+
+
+def deserialize_instructions(raw: str) -> list[Instruction]:
+    return [
+        Instruction(
+            Pubkey.from_string(ix["program_id"]),
+            bytes.fromhex(ix["data"]),
+            [
+                AccountMeta(Pubkey.from_string(pubkey), is_signer, is_writable)
+                for pubkey, is_signer, is_writable in ix["accounts"]
+            ],
+        )
+        for ix in json.loads(raw)
+    ]
+
+
+class SlotClock:
+    """Tracks the current slot with one background `getSlot` per interval"""
+
+    def __init__(self, connection: AsyncClient, poll_interval: float = 0.4):
+        self.connection = connection
+        self.poll_interval = poll_interval
+        self.slot = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> int:
+        self.slot = (await self.connection.get_slot()).value
+        if self.task is None:
+            self.task = asyncio.create_task(self._poll_loop())
+        return self.slot
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.slot = (await self.connection.get_slot()).value
+            except Exception as e:
+                print(f"failed to fetch slot: {e}")
+
+    async def wait_for(self, slot: int):
+        while self.slot < slot:
+            await asyncio.sleep(self.poll_interval / 2)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# set while an action executes, or an oracle update sends its txs, so the
+# inner oracle updates and txs are not recorded (and later replayed) twice
+_inside_action: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "inside_action", default=False
+)
+
+
+class Recorder:
+    """
+    Appends records to an `EventLogWriter`. Does nothing until `start` is
+    called, so the hooks can stay in place for runs that are not recorded.
+    """
+
+    def __init__(self):
+        self.writer: Optional[EventLogWriter] = None
+        self.clock: Optional[SlotClock] = None
+
+    @property
+    def active(self) -> bool:
+        return self.writer is not None and not _inside_action.get()
+
+    async def start(self, path: str, connection: AsyncClient):
+        self.writer = EventLogWriter(path)
+        self.clock = SlotClock(connection)
+        await self.clock.start()
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.clock is not None:
+            self.clock.stop()
+        self.writer = None
+        self.clock = None
+
+    @contextlib.contextmanager
+    def suppressed(self):
+        """Records nothing inside, for txs recorded at a higher level"""
+        token = _inside_action.set(True)
+        try:
+            yield
+        finally:
+            _inside_action.reset(token)
+
+    def _slot(self) -> int:
+        return self.clock.slot if self.clock is not None else 0
+
+    def record_action(self, action: Any, sig: Any):
+        if not self.active:
+            return
+        parameters = {
+            f.name: str(getattr(action, f.name))
+            if isinstance(getattr(action, f.name), Pubkey)
+            else getattr(action, f.name)
+            for f in fields(action)
+            if f.name != "market_index"
+        }
+        self.writer.append(  # type: ignore
+            ActionRecord(
+                int(time.time()),
+                self._slot(),
+                type(action).__name__,
+                action.market_index,
+                json.dumps(parameters),
+                str(sig) if sig is not None else "",
+                sig is not None,
+            )
+        )
+
+    def record_oracle_update(
+        self, oracle: Pubkey, price: int, sig: Any, multiplier: int = 1
+    ):
+        if not self.active:
+            return
+        self.writer.append(  # type: ignore
+            OracleUpdateRecord(
+                int(time.time()),
+                self._slot(),
+                str(oracle),
+                price,
+                str(sig) if sig is not None else "",
+                sig is not None,
+                multiplier,
+            )
+        )
+
+    def record_instructions(
+        self,
+        authority: Pubkey,
+        ixs: Sequence[Instruction],
+        sig: Any = None,
+        slot: Optional[int] = None,
+        error: Optional[BaseException] = None,
+    ):
+        if not self.active:
+            return
+        # send_ixs adds the client's compute budget ixs again on replay
+        ixs = [ix for ix in ixs if ix.program_id != COMPUTE_BUDGET_PROGRAM_ID]
+        self.writer.append(  # type: ignore
+            InstructionRecord(
+                int(time.time()),
+                slot if slot is not None else self._slot(),
+                str(authority),
+                serialize_instructions(ixs),
+                str(sig) if sig is not None else "",
+                error is None,
+                "" if error is None else str(error),
+            )
+        )
+
+
+recorder = Recorder()
+
+
+def recorded_action(execute):
+    """Records each call of a decorated `Action.execute` with its result"""
+
+    @functools.wraps(execute)
+    async def wrapper(self, admin, *args, **kwargs):
+        with recorder.suppressed():
+            sig = await execute(self, admin, *args, **kwargs)
+        recorder.record_action(self, sig)
+        return sig
+
+    return wrapper
+
+
+async def _replay_event(
+    event: Event, admin: Admin, clients: dict[str, DriftClient]
+) -> bool:
+    # imported here since src.actions records through this module
+    from src.actions import ACTION_CLASSES
+    from src.oracles import get_oracle_controller
+
+    if isinstance(event, ActionRecord):
+        action_class = {cls.__name__: cls for cls in ACTION_CLASSES}[event.action]
+        parameters = json.loads(event.parameters)
+        for f in fields(action_class):
+            if f.type is Pubkey:
+                parameters[f.name] = Pubkey.from_string(parameters[f.name])
+        action = action_class(market_index=event.market_index, **parameters)
+        return (await action.execute(admin)) is not None
+    elif isinstance(event, OracleUpdateRecord):
+        oracle = Pubkey.from_string(event.oracle)
+        await get_oracle_controller(admin).set_prices(
+            {oracle: event.price}, {oracle: event.multiplier}
+        )
+        return True
+    elif isinstance(event, InstructionRecord):
+        client = clients.get(event.authority)
+        if client is None:
+            print(f"no client loaded for {event.authority}, skipping")
+            return False
+        await client.send_ixs(deserialize_instructions(event.instructions))
+        return True
+    return False
+
+
+def is_oracle_update_tx(event: InstructionRecord) -> bool:
+    """
+    True for a tx of only setPrice ixs. Logs recorded before oracle updates
+    suppressed the tx sender have these next to their `OracleUpdateRecord`s.
+    """
+    # imported here since src.oracles records through this module
+    from src.oracles import PYTH_PROGRAM_ID
+
+    ixs = json.loads(event.instructions)
+    return len(ixs) > 0 and all(
+        ix["program_id"] == str(PYTH_PROGRAM_ID) for ix in ixs
+    )
+
+
+async def replay(
+    path: str,
+    admin: Admin,
+    agents: list[DriftClient],
+    only_successful: bool = True,
+) -> dict[str, int]:
+    """
+    Re-issues a recorded run against the current (fresh) chain state, each
+    event at the same slot offset from the first recorded event as when it
+    was recorded. Events that failed during recording are skipped unless
+    `only_successful` is False. Returns replayed/failed/skipped counts.
+    """
+    clients = {str(agent.authority): agent for agent in agents}
+    clients[str(admin.authority)] = admin
+    clock = SlotClock(admin.connection)
+    start_slot = await clock.start()
+
+    counts = {"replayed": 0, "failed": 0, "skipped": 0}
+    duplicate_oracle_txs = 0
+    first_slot: Optional[int] = None
+    tasks = []
+
+    async def issue(event: Event):
+        try:
+            ok = await _replay_event(event, admin, clients)
+        except Exception as e:
+            print(f"failed to replay {event._event_name}: {e}")  # type: ignore
+            ok = False
+        counts["replayed" if ok else "failed"] += 1
+
+    try:
+        for event in EventLogReader(path):
+            if not isinstance(
+                event, (ActionRecord, OracleUpdateRecord, InstructionRecord)
+            ):
+                continue
+            if only_successful and not event.ok:
+                counts["skipped"] += 1
+                continue
+            if isinstance(event, InstructionRecord) and is_oracle_update_tx(event):
+                # replayed from the oracle update records already
+                counts["skipped"] += 1
+                duplicate_oracle_txs += 1
+                continue
+            if first_slot is None:
+                first_slot = event.slot
+            await clock.wait_for(start_slot + event.slot - first_slot)
+            tasks.append(asyncio.create_task(issue(event)))
+        await asyncio.gather(*tasks)
+    finally:
+        clock.stop()
+
+    print(
+        f"replayed {counts['replayed']} events from {path} "
+        f"({counts['failed']} failed, {counts['skipped']} skipped)"
+    )
+    if duplicate_oracle_txs > 0:
+        print(f"skipped {duplicate_oracle_txs} setPrice txs recorded twice")
+    return counts
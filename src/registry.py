@@ -0,0 +1,357 @@
+"""
+Registry of simulation runs keyed by program commit (`COMMIT`), snapshot slot
+and scenario, and a report comparing the results files of two runs: end of
+run market state, settle success rates and phase timings, with outcome and
+performance regressions flagged.
+
+    poetry run python -m src.registry list --scenario=exchange_behavior
+    poetry run python -m src.registry report --scenario=exchange_behavior
+    poetry run python -m src.registry report --baseline=<run id> --candidate=<run id>
+
+By default the candidate is the latest run of the scenario and the baseline
+the latest earlier run of the same scenario and snapshot on another commit.
+`report` exits with 1 when the candidate regressed.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+import time
+
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import pandas as pd
+
+from src.results import load_results
+
+DEFAULT_REGISTRY_PATH = "runs/registry.jsonl"
+# record type of the market state written when a run finishes
+RUN_END = "run end"
+
+# (table, column) -> the direction that is better, None to report only
+MARKET_METRICS: dict[tuple[str, str], Optional[str]] = {
+    ("perp_market", "amm.total_social_loss"): "lower",
+    ("perp_market", "amm.total_fee_minus_distributions"): "higher",
+    ("perp_market", "amm.base_asset_amount_with_amm"): None,
+    ("perp_market", "amm.user_lp_shares"): None,
+    ("perp_market", "amm.fee_pool.scaled_balance"): None,
+    ("perp_market", "pnl_pool.scaled_balance"): None,
+    ("spot_market", "total_social_loss"): "lower",
+    ("spot_market", "total_quote_social_loss"): "lower",
+    ("spot_market", "deposit_balance"): None,
+    ("spot_market", "borrow_balance"): None,
+    ("spot_market", "revenue_pool.scaled_balance"): None,
+    ("vault_balance", "spot_vault_balance"): None,
+    ("vault_balance", "insurance_fund_balance"): "higher",
+}
+
+
+@dataclass
+class RunEntry:
+    run_id: str
+    commit: Optional[str]
+    snapshot_slot: Optional[int]
+    scenario: str
+    results_path: str
+    ok: bool
+    created_at: float
+
+
+def snapshot_slot(perp_markets: list) -> Optional[int]:
+    """
+    `SNAPSHOT_SLOT` if set, else the last amm update slot of the cloned
+    markets, which identifies the snapshot as long as no trade ran yet
+    """
+    if os.environ.get("SNAPSHOT_SLOT") is not None:
+        return int(os.environ["SNAPSHOT_SLOT"])
+    if len(perp_markets) == 0:
+        return None
+    return max(market.amm.last_update_slot for market in perp_markets)
+
+
+class RunRegistry:
+    """Append-only JSON lines, safe to share between runner workers"""
+
+    def __init__(self, path: str = DEFAULT_REGISTRY_PATH):
+        self.path = path
+
+    def register(
+        self,
+        scenario: str,
+        snapshot_slot: Optional[int],
+        results_path: str,
+        ok: bool = True,
+    ) -> RunEntry:
+        created_at = time.time()
+        entry = RunEntry(
+            f"{scenario}-{dt.datetime.utcfromtimestamp(created_at):%Y%m%d-%H%M%S}",
+            os.environ.get("COMMIT"),
+            snapshot_slot,
+            scenario,
+            results_path,
+            ok,
+            created_at,
+        )
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        # one write per line, so concurrent workers do not interleave
+        with open(self.path, "a") as f:
+            f.write(json.dumps(asdict(entry)) + "\n")
+        print(f"registered run {entry.run_id} (commit {entry.commit})")
+        return entry
+
+    def entries(
+        self,
+        scenario: Optional[str] = None,
+        commit: Optional[str] = None,
+        snapshot_slot: Optional[int] = None,
+    ) -> list[RunEntry]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            entries = [RunEntry(**json.loads(line)) for line in f if line.strip()]
+        return [
+            entry
+            for entry in sorted(entries, key=lambda e: e.created_at)
+            if (scenario is None or entry.scenario == scenario)
+            and (commit is None or entry.commit == commit)
+            and (snapshot_slot is None or entry.snapshot_slot == snapshot_slot)
+        ]
+
+    def get(self, run_id: str) -> RunEntry:
+        for entry in self.entries():
+            if entry.run_id == run_id:
+                return entry
+        raise KeyError(f"no run {run_id} in {self.path}")
+
+    def latest(self, scenario: Optional[str] = None) -> Optional[RunEntry]:
+        entries = self.entries(scenario)
+        return entries[-1] if len(entries) > 0 else None
+
+    def baseline_for(self, candidate: RunEntry) -> Optional[RunEntry]:
+        """The latest earlier run of the scenario and snapshot on another commit"""
+        earlier = [
+            entry
+            for entry in self.entries(candidate.scenario, None, candidate.snapshot_slot)
+            if entry.created_at < candidate.created_at
+            and entry.commit != candidate.commit
+        ]
+        return earlier[-1] if len(earlier) > 0 else None
+
+
+@dataclass
+class Thresholds:
+    # relative slowdown of a phase, ignored below `min_timing_seconds`
+    timing: float = 0.2
+    min_timing_seconds: float = 1.0
+    # absolute drop of a market's settle success rate
+    settle_rate: float = 0.0
+    # relative change of a market metric in its worse direction
+    metric: float = 0.01
+
+
+@dataclass
+class Comparison:
+    # "run", "market", "settle" or "timing"
+    kind: str
+    name: str
+    baseline: Optional[float]
+    candidate: Optional[float]
+    regression: bool = False
+
+    @property
+    def change(self) -> Optional[float]:
+        if self.baseline is None or self.candidate is None:
+            return None
+        return self.candidate - self.baseline
+
+
+def _worse(
+    baseline: float, candidate: float, better: Optional[str], threshold: float
+) -> bool:
+    if better is None:
+        return False
+    change = candidate - baseline if better == "lower" else baseline - candidate
+    return change > threshold * max(abs(baseline), 1.0)
+
+
+def _load(entry: RunEntry) -> dict[str, pd.DataFrame]:
+    # a run that failed early may not have written any results
+    if not os.path.exists(entry.results_path):
+        return {}
+    return load_results(entry.results_path)
+
+
+def _by_market(tables: dict[str, pd.DataFrame], table: str) -> pd.DataFrame:
+    """The table's last row per market, of the end of run records if typed"""
+    df = tables.get(table)
+    if df is None:
+        return pd.DataFrame()
+    if "record_type" in df.columns:
+        df = df[df["record_type"] == RUN_END]
+    return df.drop_duplicates("market_index", keep="last").set_index("market_index")
+
+
+def _value(df: pd.DataFrame, column: str, market_index: int) -> Optional[float]:
+    if column not in df.columns or market_index not in df.index:
+        return None
+    value = df.at[market_index, column]
+    return None if pd.isna(value) else float(value)
+
+
+def compare_runs(
+    baseline: RunEntry,
+    candidate: RunEntry,
+    thresholds: Optional[Thresholds] = None,
+) -> list[Comparison]:
+    thresholds = thresholds if thresholds is not None else Thresholds()
+    comparisons = [
+        Comparison(
+            "run",
+            "ok",
+            float(baseline.ok),
+            float(candidate.ok),
+            baseline.ok and not candidate.ok,
+        )
+    ]
+    before = _load(baseline)
+    after = _load(candidate)
+
+    for table in sorted({table for table, _ in MARKET_METRICS}):
+        base_df = _by_market(before, table)
+        cand_df = _by_market(after, table)
+        for market_index in sorted(set(base_df.index) | set(cand_df.index)):
+            for (metric_table, column), better in MARKET_METRICS.items():
+                if metric_table != table:
+                    continue
+                b = _value(base_df, column, market_index)
+                c = _value(cand_df, column, market_index)
+                if b is None and c is None:
+                    continue
+                regression = (
+                    b is not None
+                    and c is not None
+                    and _worse(b, c, better, thresholds.metric)
+                )
+                name = f"{table.replace('_', ' ')} {market_index} {column}"
+                comparisons.append(Comparison("market", name, b, c, regression))
+
+    base_settle = _by_market(before, "settle_result")
+    cand_settle = _by_market(after, "settle_result")
+    for market_index in sorted(set(base_settle.index) | set(cand_settle.index)):
+        b = _value(base_settle, "success_rate", market_index)
+        c = _value(cand_settle, "success_rate", market_index)
+        regression = (b is not None and c is None) or (
+            b is not None and c is not None and b - c > thresholds.settle_rate
+        )
+        comparisons.append(
+            Comparison(
+                "settle", f"perp market {market_index} success rate", b, c, regression
+            )
+        )
+
+    def timings(tables: dict[str, pd.DataFrame]) -> dict[str, float]:
+        df = tables.get("phase_timing")
+        if df is None:
+            return {}
+        return df.groupby("phase")["seconds"].sum().to_dict()
+
+    base_timings = timings(before)
+    cand_timings = timings(after)
+    for phase in sorted(set(base_timings) | set(cand_timings)):
+        b = base_timings.get(phase)
+        c = cand_timings.get(phase)
+        regression = (
+            b is not None
+            and c is not None
+            and c - b > max(thresholds.min_timing_seconds, thresholds.timing * b)
+        )
+        comparisons.append(Comparison("timing", phase, b, c, regression))
+
+    return comparisons
+
+
+def print_report(
+    baseline: RunEntry, candidate: RunEntry, comparisons: list[Comparison]
+) -> list[Comparison]:
+    print(
+        f"baseline  {baseline.run_id} commit {baseline.commit} "
+        f"snapshot slot {baseline.snapshot_slot}"
+    )
+    print(
+        f"candidate {candidate.run_id} commit {candidate.commit} "
+        f"snapshot slot {candidate.snapshot_slot}"
+    )
+
+    def fmt(value: Optional[float]) -> str:
+        return f"{value:.6g}" if value is not None else "-"
+
+    for kind in ["run", "settle", "timing", "market"]:
+        rows = [c for c in comparisons if c.kind == kind]
+        if len(rows) == 0:
+            continue
+        print(f"\n{kind}:")
+        for c in rows:
+            flag = "REGRESSION" if c.regression else ""
+            change = f"{c.change:+.6g}" if c.change is not None else "-"
+            print(
+                f"  {c.name:<56} {fmt(c.baseline):>14} -> {fmt(c.candidate):<14} "
+                f"{change:>14} {flag}"
+            )
+
+    regressions = [c for c in comparisons if c.regression]
+    print(f"\n{len(regressions)} regressions")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["list", "report"])
+    parser.add_argument("--registry", default=DEFAULT_REGISTRY_PATH)
+    parser.add_argument("--scenario", default=None)
+    parser.add_argument("--baseline", default=None, help="run id")
+    parser.add_argument("--candidate", default=None, help="run id")
+    parser.add_argument("--timing-threshold", type=float, default=0.2)
+    parser.add_argument("--metric-threshold", type=float, default=0.01)
+    args = parser.parse_args()
+
+    registry = RunRegistry(args.registry)
+    if args.command == "list":
+        for entry in registry.entries(args.scenario):
+            status = "ok" if entry.ok else "failed"
+            print(
+                f"{entry.run_id:<40} commit {str(entry.commit):<12} "
+                f"snapshot slot {str(entry.snapshot_slot):<12} {status:<6} "
+                f"{entry.results_path}"
+            )
+        return
+
+    if args.candidate is not None:
+        candidate = registry.get(args.candidate)
+    else:
+        latest = registry.latest(args.scenario)
+        if latest is None:
+            sys.exit(f"no runs in {args.registry}")
+        candidate = latest
+    if args.baseline is not None:
+        baseline = registry.get(args.baseline)
+    else:
+        previous = registry.baseline_for(candidate)
+        if previous is None:
+            sys.exit(f"no baseline for {candidate.run_id} on another commit")
+        baseline = previous
+
+    thresholds = Thresholds(
+        timing=args.timing_threshold, metric=args.metric_threshold
+    )
+    regressions = print_report(
+        baseline, candidate, compare_runs(baseline, candidate, thresholds)
+    )
+    sys.exit(1 if len(regressions) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Simulation results as typed columns, one `.npz` file per run.
+
+Market and insurance fund structs are flattened along their type hints into
+one column per leaf field (`amm.historical_oracle_data.last_oracle_price`),
+with pubkeys as strings, enums as their variant name, names decoded and
+padding dropped. Rows are buffered per table and every flush appends one
+chunk of columns to the run's file:
+
+    <run>.npz
+        perp_market/000000/amm.sqrt_k.npy
+        perp_market/000000/record_type.npy
+        insurance_fund/000000/...
+
+    tables = load_results("runs/20240101-000000/results.npz")
+    tables["perp_market"][["record_type", "amm.sqrt_k"]]
+"""
+import dataclasses
+import os
+import re
+import time
+import typing
+import zipfile
+
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.decode.utils import decode_name
+
+DEFAULT_FLUSH_EVERY = 64
+
+Column = tuple[str, Callable[[Any], Any], Any]  # (name, getter, dtype)
+
+
+def table_name(struct_type: type) -> str:
+    """PerpMarketAccount -> perp_market"""
+    name = re.sub(r"Account$", "", struct_type.__name__)
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def _getter(get: Callable[[Any], Any], name: str) -> Callable[[Any], Any]:
+    return lambda obj: getattr(get(obj), name)
+
+
+@lru_cache(maxsize=None)
+def struct_columns(struct_type: type) -> list[Column]:
+    """Leaf columns of a driftpy struct, from its type hints"""
+    columns: list[Column] = []
+
+    def walk(cls: type, prefix: str, get: Callable[[Any], Any]):
+        hints = typing.get_type_hints(cls)
+        for f in dataclasses.fields(cls):
+            name = f"{prefix}{f.name}"
+            field_type = hints[f.name]
+            field_get = _getter(get, f.name)
+            if f.name.startswith("padding"):
+                continue
+            if dataclasses.is_dataclass(field_type):
+                walk(field_type, f"{name}.", field_get)  # type: ignore
+            elif f.name == "name" and typing.get_origin(field_type) is list:
+                columns.append(
+                    (name, lambda obj, g=field_get: decode_name(g(obj)), np.str_)
+                )
+            elif field_type is bool:
+                columns.append((name, field_get, np.bool_))
+            elif field_type is int:
+                columns.append((name, field_get, np.int64))
+            elif field_type is float:
+                columns.append((name, field_get, np.float64))
+            elif field_type is Pubkey:
+                columns.append((name, lambda obj, g=field_get: str(g(obj)), np.str_))
+            else:
+                # rust enums, e.g. OracleSource.Pyth() -> "Pyth"
+                columns.append(
+                    (name, lambda obj, g=field_get: type(g(obj)).__name__, np.str_)
+                )
+
+    walk(struct_type, "", lambda obj: obj)
+    return columns
+
+
+def to_column(values: list, dtype: Any) -> np.ndarray:
+    try:
+        return np.asarray(values, dtype=dtype)
+    except OverflowError:
+        # u128 amounts beyond int64 stay numeric, at float precision
+        return np.asarray(values, dtype=np.float64)
+
+
+class ResultsWriter:
+    """
+    Buffers flattened records per table in memory and appends them to the
+    run's file every `flush_every` records. Use as a context manager or call
+    `close()`.
+    """
+
+    def __init__(self, path: str, flush_every: int = DEFAULT_FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.rows: dict[type, list[tuple[Any, dict]]] = defaultdict(list)
+        self.buffered = 0
+        self.chunks: dict[str, int] = defaultdict(int)
+        if os.path.exists(path):
+            # continue the chunk numbering of an existing file
+            with zipfile.ZipFile(path) as zf:
+                for member in zf.namelist():
+                    table, chunk, _ = member.split("/", 2)
+                    self.chunks[table] = max(self.chunks[table], int(chunk) + 1)
+
+    def append(self, struct: Any, record_type: str, **extra: Any):
+        """`extra` columns must be the same for every record of a table"""
+        meta = {"record_type": record_type, "timestamp": time.time(), **extra}
+        self.rows[type(struct)].append((struct, meta))
+        self.buffered += 1
+        if self.buffered >= self.flush_every:
+            self.flush()
+
+    def _open(self) -> zipfile.ZipFile:
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        return zipfile.ZipFile(self.path, "a", zipfile.ZIP_DEFLATED)
+
+    def _write_chunk(self, zf: zipfile.ZipFile, table: str, arrays: dict):
+        prefix = f"{table}/{self.chunks[table]:06d}"
+        for name, array in arrays.items():
+            with zf.open(f"{prefix}/{name}.npy", "w") as f:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+        self.chunks[table] += 1
+
+    def write_columns(self, table: str, arrays: dict[str, np.ndarray]):
+        """Appends already columnar rows (equal length arrays) as one chunk"""
+        with self._open() as zf:
+            self._write_chunk(zf, table, arrays)
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        with self._open() as zf:
+            for struct_type, rows in self.rows.items():
+                structs = [struct for struct, _ in rows]
+                arrays = {
+                    name: np.asarray([meta[name] for _, meta in rows])
+                    for name in rows[0][1]
+                }
+                for name, get, dtype in struct_columns(struct_type):
+                    arrays[name] = to_column([get(s) for s in structs], dtype)
+                self._write_chunk(zf, table_name(struct_type), arrays)
+
+        self.rows.clear()
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_results(path: str, table: Optional[str] = None) -> dict[str, pd.DataFrame]:
+    """Every table (or just `table`) of a run's results file, chunks concatenated"""
+    chunks: dict[str, dict[str, dict[str, np.ndarray]]] = defaultdict(dict)
+    with np.load(path, allow_pickle=False) as data:
+        for key in data.files:
+            table_key, chunk, column = key.split("/", 2)
+            if table is not None and table_key != table:
+                continue
+            chunks[table_key].setdefault(chunk, {})[column] = data[key]
+
+    return {
+        table_key: pd.concat(
+            [pd.DataFrame(columns) for _, columns in sorted(table_chunks.items())],
+            ignore_index=True,
+        )
+        for table_key, table_chunks in chunks.items()
+    }
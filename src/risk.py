@@ -0,0 +1,457 @@
+"""
+Offline, vectorized margin engine over the cloned `accounts/` snapshot. Every
+User, PerpMarket and SpotMarket account is loaded into dense NumPy arrays once,
+then margin requirement, total collateral and health of all users are
+evaluated for a whole vector of oracle shocks at a time, without a validator.
+
+    poetry run python -m src.risk --shocks=-0.5,-0.3,-0.1,0,0.1,0.3,0.5
+
+Prices start at each market's cloned `historical_oracle_data.last_oracle_price`
+and the weights follow `driftpy.math.margin` with its precision constants.
+Open orders, LP shares, unsettled funding and the upnl max imbalance discount
+are not modelled, so results are an estimate to pick scenarios with and to
+cross-check on-chain runs against, not the program's exact margin calculation.
+"""
+import argparse
+import base64
+import json
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import driftpy
+
+from anchorpy import Idl
+from anchorpy.coder.accounts import AccountsCoder
+from driftpy.constants.numeric_constants import (
+    AMM_RESERVE_PRECISION,
+    BASE_PRECISION,
+    MARGIN_PRECISION,
+    PRICE_PRECISION,
+    SPOT_IMF_PRECISION,
+    SPOT_WEIGHT_PRECISION,
+)
+from driftpy.decode.user import decode_user
+from driftpy.types import is_variant
+
+from src.pricepaths import FIXED_ORACLE_SOURCES, oracle_source_name
+
+DRIFT_IDL_PATH = Path(driftpy.__file__).parent / "idl" / "drift.json"
+SNAPSHOT_ACCOUNTS = ("User", "PerpMarket", "SpotMarket")
+
+
+@dataclass
+class Snapshot:
+    users: dict  # pubkey -> UserAccount
+    perp_markets: list
+    spot_markets: list
+
+
+def load_snapshot(account_dir: str = "accounts/") -> Snapshot:
+    """Decodes the User, PerpMarket and SpotMarket accounts of a clone"""
+    coder = AccountsCoder(Idl.from_json(DRIFT_IDL_PATH.read_text()))
+    discriminators = {
+        coder.acc_name_to_discriminator[name]: name for name in SNAPSHOT_ACCOUNTS
+    }
+
+    users = {}
+    perp_markets = []
+    spot_markets = []
+    for path in sorted(Path(account_dir).glob("*.json")):
+        with open(path) as f:
+            account = json.load(f)
+        data = base64.b64decode(account["account"]["data"][0])
+        name = discriminators.get(data[:8])
+        if name == "User":
+            users[account["pubkey"]] = decode_user(data)
+        elif name == "PerpMarket":
+            perp_markets.append(coder.parse(data).data)
+        elif name == "SpotMarket":
+            spot_markets.append(coder.parse(data).data)
+
+    perp_markets.sort(key=lambda m: m.market_index)
+    spot_markets.sort(key=lambda m: m.market_index)
+    return Snapshot(users, perp_markets, spot_markets)
+
+
+def size_discount_asset_weight(
+    size: np.ndarray, imf_factor: np.ndarray, asset_weight: np.ndarray
+) -> np.ndarray:
+    """`calculate_size_discount_asset_weight` over arrays"""
+    size_sqrt = np.ceil(np.sqrt(np.abs(size) * 10)) + 1
+    imf_num = SPOT_IMF_PRECISION + SPOT_IMF_PRECISION / 10
+    discount = np.ceil(
+        imf_num
+        * SPOT_WEIGHT_PRECISION
+        / (SPOT_IMF_PRECISION + size_sqrt * imf_factor / 100_000)
+    )
+    return np.where(imf_factor == 0, asset_weight, np.minimum(asset_weight, discount))
+
+
+def size_premium_liability_weight(
+    size: np.ndarray,
+    imf_factor: np.ndarray,
+    liability_weight: np.ndarray,
+    precision: int,
+) -> np.ndarray:
+    """`calculate_size_premium_liability_weight` over arrays"""
+    size_sqrt = np.floor(np.sqrt(np.abs(size) * 10 + 1))
+    safe_imf_factor = np.where(imf_factor == 0, 1, imf_factor)
+    denom0 = np.maximum(1, SPOT_IMF_PRECISION / safe_imf_factor)
+    numerator = liability_weight - liability_weight / denom0
+    denom = 100_000 * SPOT_IMF_PRECISION / precision
+    premium = numerator + size_sqrt * imf_factor / denom
+    return np.where(
+        imf_factor == 0, liability_weight, np.maximum(liability_weight, premium)
+    )
+
+
+@dataclass
+class RiskArrays:
+    """
+    Snapshot state as arrays. Users are rows; perp and spot markets are
+    columns, in `perp_market_indexes` / `spot_market_indexes` order. Markets
+    map to a column of `oracles` so markets sharing an oracle move together.
+    """
+
+    users: list[str]
+    oracles: list[str]
+    # per oracle, True for sources that are never shocked (e.g. QuoteAsset)
+    oracle_fixed: np.ndarray
+
+    perp_market_indexes: np.ndarray
+    perp_oracle: np.ndarray
+    perp_price: np.ndarray
+    perp_base: np.ndarray  # (users, perps) BASE_PRECISION
+    perp_quote: np.ndarray  # (users, perps) QUOTE_PRECISION
+    # (users, perps) margin ratios, size premium included
+    perp_initial_ratio: np.ndarray
+    perp_maintenance_ratio: np.ndarray
+    upnl_initial_weight: np.ndarray
+    upnl_maintenance_weight: np.ndarray
+    upnl_imf_factor: np.ndarray
+
+    spot_market_indexes: np.ndarray
+    spot_oracle: np.ndarray
+    spot_price: np.ndarray
+    spot_precision: np.ndarray  # 10 ** decimals
+    spot_tokens: np.ndarray  # (users, spots) signed, borrows negative
+    spot_deposits: np.ndarray  # market wide deposit token amount
+    spot_scale_initial_start: np.ndarray
+    spot_initial_asset_weight: np.ndarray
+    # (users, spots) size discount / premium weights
+    spot_initial_discount: np.ndarray
+    spot_maintenance_asset_weight: np.ndarray
+    spot_initial_liability_weight: np.ndarray
+    spot_maintenance_liability_weight: np.ndarray
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Snapshot) -> "RiskArrays":
+        perps = snapshot.perp_markets
+        spots = snapshot.spot_markets
+        perp_column = {m.market_index: i for i, m in enumerate(perps)}
+        spot_column = {m.market_index: i for i, m in enumerate(spots)}
+
+        oracles: dict[str, int] = {}
+        fixed = []
+
+        def oracle_column(oracle, oracle_source) -> int:
+            key = str(oracle)
+            if key not in oracles:
+                oracles[key] = len(oracles)
+                fixed.append(oracle_source_name(oracle_source) in FIXED_ORACLE_SOURCES)
+            return oracles[key]
+
+        perp_oracle = [oracle_column(m.amm.oracle, m.amm.oracle_source) for m in perps]
+        spot_oracle = [oracle_column(m.oracle, m.oracle_source) for m in spots]
+
+        users = list(snapshot.users.keys())
+        perp_base = np.zeros((len(users), len(perps)))
+        perp_quote = np.zeros((len(users), len(perps)))
+        spot_tokens = np.zeros((len(users), len(spots)))
+        for row, user in enumerate(snapshot.users.values()):
+            for position in user.perp_positions:
+                column = perp_column.get(position.market_index)
+                if column is None:
+                    continue
+                perp_base[row, column] += position.base_asset_amount
+                perp_quote[row, column] += position.quote_asset_amount
+            for position in user.spot_positions:
+                column = spot_column.get(position.market_index)
+                if column is None or position.scaled_balance == 0:
+                    continue
+                market = spots[column]
+                if is_variant(position.balance_type, "Deposit"):
+                    interest = market.cumulative_deposit_interest
+                    sign = 1
+                else:
+                    interest = market.cumulative_borrow_interest
+                    sign = -1
+                # get_token_amount, in ints
+                tokens = (
+                    position.scaled_balance
+                    * interest
+                    // 10 ** (19 - market.decimals)
+                )
+                spot_tokens[row, column] += sign * tokens
+
+        def perp_field(get) -> np.ndarray:
+            return np.array([get(m) for m in perps], dtype=np.float64)
+
+        def spot_field(get) -> np.ndarray:
+            return np.array([get(m) for m in spots], dtype=np.float64)
+
+        imf_factor = perp_field(lambda m: m.imf_factor)
+        spot_imf_factor = spot_field(lambda m: m.imf_factor)
+        spot_precision = spot_field(lambda m: 10**m.decimals)
+        spot_size = np.abs(spot_tokens) * AMM_RESERVE_PRECISION / spot_precision
+        spot_deposits = spot_field(
+            lambda m: m.deposit_balance
+            * m.cumulative_deposit_interest
+            // 10 ** (19 - m.decimals)
+        )
+
+        return cls(
+            users=users,
+            oracles=list(oracles.keys()),
+            oracle_fixed=np.array(fixed, dtype=bool),
+            perp_market_indexes=np.array([m.market_index for m in perps]),
+            perp_oracle=np.array(perp_oracle, dtype=np.int64),
+            perp_price=perp_field(
+                lambda m: m.amm.historical_oracle_data.last_oracle_price
+            ),
+            perp_base=perp_base,
+            perp_quote=perp_quote,
+            perp_initial_ratio=size_premium_liability_weight(
+                perp_base,
+                imf_factor,
+                perp_field(lambda m: m.margin_ratio_initial),
+                MARGIN_PRECISION,
+            ),
+            perp_maintenance_ratio=size_premium_liability_weight(
+                perp_base,
+                imf_factor,
+                perp_field(lambda m: m.margin_ratio_maintenance),
+                MARGIN_PRECISION,
+            ),
+            upnl_initial_weight=perp_field(
+                lambda m: m.unrealized_pnl_initial_asset_weight
+            ),
+            upnl_maintenance_weight=perp_field(
+                lambda m: m.unrealized_pnl_maintenance_asset_weight
+            ),
+            upnl_imf_factor=perp_field(lambda m: m.unrealized_pnl_imf_factor),
+            spot_market_indexes=np.array([m.market_index for m in spots]),
+            spot_oracle=np.array(spot_oracle, dtype=np.int64),
+            spot_price=spot_field(lambda m: m.historical_oracle_data.last_oracle_price),
+            spot_precision=spot_precision,
+            spot_tokens=spot_tokens,
+            spot_deposits=spot_deposits,
+            spot_scale_initial_start=spot_field(
+                lambda m: m.scale_initial_asset_weight_start
+            ),
+            spot_initial_asset_weight=spot_field(lambda m: m.initial_asset_weight),
+            # the initial weight is min(scaled weight, size discount), the
+            # discount alone does not depend on the price
+            spot_initial_discount=size_discount_asset_weight(
+                spot_size, spot_imf_factor, np.full_like(spot_size, np.inf)
+            ),
+            spot_maintenance_asset_weight=size_discount_asset_weight(
+                spot_size,
+                spot_imf_factor,
+                spot_field(lambda m: m.maintenance_asset_weight),
+            ),
+            spot_initial_liability_weight=size_premium_liability_weight(
+                spot_size,
+                spot_imf_factor,
+                spot_field(lambda m: m.initial_liability_weight),
+                SPOT_WEIGHT_PRECISION,
+            ),
+            spot_maintenance_liability_weight=size_premium_liability_weight(
+                spot_size,
+                spot_imf_factor,
+                spot_field(lambda m: m.maintenance_liability_weight),
+                SPOT_WEIGHT_PRECISION,
+            ),
+        )
+
+    def oracle_multipliers(self, shocks: np.ndarray) -> np.ndarray:
+        """
+        (K, oracles) price multipliers from relative shocks: a (K,) vector
+        moves every oracle together, a (K, oracles) matrix moves each one.
+        """
+        shocks = np.asarray(shocks, dtype=np.float64)
+        if shocks.ndim == 1:
+            shocks = np.repeat(shocks[:, None], len(self.oracles), axis=1)
+        multipliers = np.maximum(1 + shocks, 0)
+        multipliers[:, self.oracle_fixed] = 1
+        return multipliers
+
+
+@dataclass
+class RiskResult:
+    """(K, users) arrays in QUOTE_PRECISION, one row per shock"""
+
+    shocks: np.ndarray
+    initial_collateral: np.ndarray
+    maintenance_collateral: np.ndarray
+    initial_requirement: np.ndarray
+    maintenance_requirement: np.ndarray
+
+    @property
+    def free_collateral(self) -> np.ndarray:
+        return np.maximum(self.initial_collateral - self.initial_requirement, 0)
+
+    @property
+    def shortfall(self) -> np.ndarray:
+        """Maintenance requirement not covered by maintenance collateral"""
+        return np.maximum(self.maintenance_requirement - self.maintenance_collateral, 0)
+
+    @property
+    def liquidatable(self) -> np.ndarray:
+        return self.maintenance_collateral < self.maintenance_requirement
+
+    @property
+    def health(self) -> np.ndarray:
+        """0 to 100, as `DriftUser.get_health`"""
+        collateral = self.maintenance_collateral
+        requirement = self.maintenance_requirement
+        with np.errstate(divide="ignore", invalid="ignore"):
+            health = 100 - 100 * requirement / collateral
+        health = np.where(collateral <= 0, 0, np.round(np.clip(health, 0, 100)))
+        return np.where((requirement == 0) & (collateral >= 0), 100, health)
+
+    def summary(self) -> pd.DataFrame:
+        """One row per shock"""
+        # matrix shocks are labelled by row
+        if self.shocks.ndim == 1:
+            labels = self.shocks
+        else:
+            labels = np.arange(len(self.shocks))
+        return pd.DataFrame(
+            {
+                "shock": labels,
+                "liquidatable": self.liquidatable.sum(axis=1),
+                "shortfall": self.shortfall.sum(axis=1) / PRICE_PRECISION,
+                "free_collateral": self.free_collateral.sum(axis=1) / PRICE_PRECISION,
+                "mean_health": self.health.mean(axis=1),
+            }
+        )
+
+
+def evaluate(arrays: RiskArrays, shocks: np.ndarray) -> RiskResult:
+    """Margin state of every user under each row of shocks"""
+    multipliers = arrays.oracle_multipliers(shocks)
+    # (K, 1, markets) so prices broadcast over users
+    perp_price = (arrays.perp_price * multipliers[:, arrays.perp_oracle])[:, None, :]
+    spot_price = (arrays.spot_price * multipliers[:, arrays.spot_oracle])[:, None, :]
+
+    # perps: unrealized pnl is collateral, position value times ratio is required
+    perp_value = np.abs(arrays.perp_base) * perp_price / BASE_PRECISION
+    pnl = arrays.perp_base * perp_price / BASE_PRECISION + arrays.perp_quote
+    upnl_initial_weight = size_discount_asset_weight(
+        pnl, arrays.upnl_imf_factor, arrays.upnl_initial_weight
+    )
+    perp_initial_collateral = np.where(
+        pnl > 0, pnl * upnl_initial_weight / SPOT_WEIGHT_PRECISION, pnl
+    ).sum(axis=2)
+    perp_maintenance_collateral = np.where(
+        pnl > 0, pnl * arrays.upnl_maintenance_weight / SPOT_WEIGHT_PRECISION, pnl
+    ).sum(axis=2)
+    perp_initial_requirement = (
+        perp_value * arrays.perp_initial_ratio / MARGIN_PRECISION
+    ).sum(axis=2)
+    perp_maintenance_requirement = (
+        perp_value * arrays.perp_maintenance_ratio / MARGIN_PRECISION
+    ).sum(axis=2)
+
+    # spot: deposits are weighted collateral, borrows weighted requirement
+    spot_value = arrays.spot_tokens * spot_price / arrays.spot_precision
+    deposits = np.maximum(spot_value, 0)
+    borrows = np.maximum(-spot_value, 0)
+
+    deposits_value = arrays.spot_deposits * spot_price / arrays.spot_precision
+    scale_start = arrays.spot_scale_initial_start
+    scaled = (scale_start != 0) & (deposits_value >= scale_start)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled_weight = np.where(
+            scaled,
+            np.floor(arrays.spot_initial_asset_weight * scale_start / deposits_value),
+            arrays.spot_initial_asset_weight,
+        )
+    initial_asset_weight = np.minimum(scaled_weight, arrays.spot_initial_discount)
+
+    spot_initial_collateral = (
+        deposits * initial_asset_weight / SPOT_WEIGHT_PRECISION
+    ).sum(axis=2)
+    spot_maintenance_collateral = (
+        deposits * arrays.spot_maintenance_asset_weight / SPOT_WEIGHT_PRECISION
+    ).sum(axis=2)
+    spot_initial_requirement = (
+        borrows * arrays.spot_initial_liability_weight / SPOT_WEIGHT_PRECISION
+    ).sum(axis=2)
+    spot_maintenance_requirement = (
+        borrows * arrays.spot_maintenance_liability_weight / SPOT_WEIGHT_PRECISION
+    ).sum(axis=2)
+
+    return RiskResult(
+        np.asarray(shocks, dtype=np.float64),
+        spot_initial_collateral + perp_initial_collateral,
+        spot_maintenance_collateral + perp_maintenance_collateral,
+        spot_initial_requirement + perp_initial_requirement,
+        spot_maintenance_requirement + perp_maintenance_requirement,
+    )
+
+
+def user_table(arrays: RiskArrays, result: RiskResult, k: int) -> pd.DataFrame:
+    """Per user state under shock `k`, to compare with on-chain users"""
+    return pd.DataFrame(
+        {
+            "user": arrays.users,
+            "initial_collateral": result.initial_collateral[k],
+            "maintenance_collateral": result.maintenance_collateral[k],
+            "initial_requirement": result.initial_requirement[k],
+            "maintenance_requirement": result.maintenance_requirement[k],
+            "health": result.health[k],
+            "liquidatable": result.liquidatable[k],
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--accounts", default="accounts/")
+    parser.add_argument(
+        "--shocks", default="-0.5,-0.2,0,0.2,0.5", help="comma separated returns"
+    )
+    parser.add_argument("--users-output", default=None, help="csv at shock 0")
+    args = parser.parse_args()
+
+    start = time.time()
+    snapshot = load_snapshot(args.accounts)
+    arrays = RiskArrays.from_snapshot(snapshot)
+    print(
+        f"loaded {len(arrays.users)} users, {len(arrays.perp_market_indexes)} perp "
+        f"and {len(arrays.spot_market_indexes)} spot markets "
+        f"in {time.time() - start:.2f}s"
+    )
+
+    shocks = np.array([float(s) for s in args.shocks.split(",")])
+    start = time.time()
+    result = evaluate(arrays, shocks)
+    elapsed = time.time() - start
+    print(f"evaluated {len(shocks)} shocks in {elapsed * 1000:.1f}ms")
+    print(result.summary().to_string(index=False))
+
+    if args.users_output is not None:
+        k = int(np.argmin(np.abs(shocks)))
+        user_table(arrays, result, k).to_csv(args.users_output, index=False)
+        print(f"users at shock {shocks[k]} written to {args.users_output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Runs independent experiment scenarios in parallel, each worker process owning
+one `solana-test-validator` on its own ports and ledger dir, started fresh from
+the cloned `accounts/` snapshot for every scenario.
+
+    poetry run python -m src.runner --workers 4 --seeds 8 --num-actions 20
+
+A scenario is a module level `async def scenario(simulator, **kwargs) -> dict`
+so it can be sent to a worker process; results are merged into one JSON file.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import IO, Any, Awaitable, Callable, Optional
+
+from solana.rpc.async_api import AsyncClient
+
+from driftpy.admin import Admin
+
+from src.balances import get_vault_balances
+from src.blockhash import reset_blockhash_providers
+from src.experiments import Simulator
+from src.metrics import metrics
+from src.oracles import PYTH_PROGRAM_ID
+from src.recorder import recorder
+from src.slack import SimulationResultBuilder, Slack
+from src.waiters import wait_until, ws_url
+
+DRIFT_PROGRAM_ID = "dRiftyHA39MWEi3m9aunc5MzRF1JYuBsbn6VPcn33UH"
+VALIDATOR_PROGRAMS = [
+    (DRIFT_PROGRAM_ID, f"accounts/{DRIFT_PROGRAM_ID}.so"),
+    (str(PYTH_PROGRAM_ID), f"accounts/{PYTH_PROGRAM_ID}.so"),
+]
+# each validator also needs a contiguous block of dynamic (tpu, tvu, ...) ports
+DYNAMIC_PORTS_PER_VALIDATOR = 50
+# a validator is cpu bound on several cores, leave room for the worker itself
+CORES_PER_VALIDATOR = 4
+
+ScenarioFn = Callable[..., Awaitable[Optional[dict]]]
+
+
+class LocalValidator:
+    """`solana-test-validator` on ports and a ledger dir derived from `slot`"""
+
+    def __init__(
+        self,
+        slot: int,
+        account_dir: str = "accounts/",
+        ledger_root: str = "ledgers",
+        base_rpc_port: int = 8899,
+    ):
+        self.slot = slot
+        self.account_dir = account_dir
+        self.ledger = os.path.join(ledger_root, f"validator-{slot}")
+        # the websocket listens on rpc_port + 1
+        self.rpc_port = base_rpc_port + 10 * slot
+        self.faucet_port = 9900 + slot
+        self.gossip_port = 20000 + slot
+        self.dynamic_port_start = 10000 + DYNAMIC_PORTS_PER_VALIDATOR * slot
+        self.process: Optional[subprocess.Popen] = None
+        self.log: Optional[IO] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.rpc_port}"
+
+    @property
+    def ws_url(self) -> str:
+        return ws_url(self.url)
+
+    def command(self) -> list[str]:
+        dynamic_port_end = self.dynamic_port_start + DYNAMIC_PORTS_PER_VALIDATOR - 1
+        command = [
+            "solana-test-validator",
+            "--account-dir",
+            self.account_dir,
+            "--ledger",
+            self.ledger,
+            "--rpc-port",
+            str(self.rpc_port),
+            "--faucet-port",
+            str(self.faucet_port),
+            "--gossip-port",
+            str(self.gossip_port),
+            "--dynamic-port-range",
+            f"{self.dynamic_port_start}-{dynamic_port_end}",
+            "--reset",
+            "--quiet",
+        ]
+        for program_id, path in VALIDATOR_PROGRAMS:
+            command += ["--bpf-program", program_id, path]
+        return command
+
+    async def start(self, timeout: float = 120.0):
+        if os.path.exists(self.ledger):
+            shutil.rmtree(self.ledger)
+        os.makedirs(self.ledger)
+        self.log = open(os.path.join(self.ledger, "validator.log"), "w")
+        self.process = subprocess.Popen(
+            self.command(), stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+        connection = AsyncClient(self.url)
+
+        async def ready():
+            if self.process.poll() is not None:  # type: ignore
+                raise RuntimeError(
+                    f"validator {self.slot} exited, see {self.ledger}/validator.log"
+                )
+            try:
+                return await connection.is_connected()
+            except Exception:
+                return False
+
+        try:
+            await wait_until(
+                ready, timeout, 1.0, description=f"validator {self.slot} at {self.url}"
+            )
+        finally:
+            await connection.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+@dataclass
+class Scenario:
+    name: str
+    fn: ScenarioFn
+    kwargs: dict = field(default_factory=dict)
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    kwargs: dict
+    worker: int
+    ok: bool
+    elapsed: float
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    metrics: dict = field(default_factory=dict)
+
+
+async def market_metrics(admin: Admin, market_index: int) -> dict:
+    """Perp market and quote insurance fund state to compare runs by"""
+    await admin.account_subscriber.update_cache()
+    market = admin.get_perp_market_account(market_index)
+    quote_spot_market = admin.get_spot_market_account(0)
+    balances = await get_vault_balances(admin.connection, [quote_spot_market])  # type: ignore
+    amm = market.amm  # type: ignore
+    return {
+        "market_index": market_index,
+        "sqrt_k": amm.sqrt_k,
+        "peg_multiplier": amm.peg_multiplier,
+        "imf_factor": market.imf_factor,  # type: ignore
+        "unrealized_pnl_imf_factor": market.unrealized_pnl_imf_factor,  # type: ignore
+        "base_asset_amount_with_amm": amm.base_asset_amount_with_amm,
+        "base_asset_amount_long": amm.base_asset_amount_long,
+        "base_asset_amount_short": amm.base_asset_amount_short,
+        "total_fee_minus_distributions": amm.total_fee_minus_distributions,
+        "pnl_pool_balance": market.pnl_pool.scaled_balance,  # type: ignore
+        "fee_pool_balance": amm.fee_pool.scaled_balance,
+        "insurance_fund_balance": balances[0].insurance_fund_balance,
+    }
+
+
+async def random_actions(
+    simulator: Simulator, num_actions: int = 10, seed: int = 0, market_index: int = 9
+) -> dict:
+    """`Simulator.experiment` with a seeded action stream"""
+    await simulator.experiment(num_actions, seed)
+    return await market_metrics(simulator.admin, market_index)  # type: ignore
+
+
+_worker_slot: Optional[int] = None
+
+
+def _init_worker(slots: Any):
+    global _worker_slot
+    _worker_slot = slots.get()
+
+
+async def _run_scenario(slot: int, scenario: Scenario) -> ScenarioResult:
+    validator = LocalValidator(slot)
+    start = time.time()
+    metrics.reset()
+    slack = Slack()
+    # the ledger is reset, so are the blockhashes cached for this endpoint
+    reset_blockhash_providers()
+    simulator: Optional[Simulator] = None
+    try:
+        await validator.start()
+        # one directory per run: the event log appends and results are
+        # compared across runs, so repeated scenario names must not share one
+        run_dir = f"{scenario.name}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}"
+        simulator = Simulator(
+            SimulationResultBuilder(slack),
+            url=validator.url,
+            record_path=os.path.join("runs", run_dir),
+        )
+        await simulator.setup()
+        result = await scenario.fn(simulator, **scenario.kwargs)
+        await simulator.finish(scenario.name)
+        await metrics.flush()
+        return ScenarioResult(
+            scenario.name,
+            scenario.kwargs,
+            slot,
+            True,
+            time.time() - start,
+            result,
+            metrics=metrics.summary(),
+        )
+    except Exception as e:
+        traceback.print_exc()
+        if simulator is not None:
+            simulator.register(scenario.name, ok=False)
+        return ScenarioResult(
+            scenario.name,
+            scenario.kwargs,
+            slot,
+            False,
+            time.time() - start,
+            error=f"{type(e).__name__}: {e}",
+            metrics=metrics.summary(),
+        )
+    finally:
+        await recorder.stop()
+        await slack.close()
+        validator.stop()
+
+
+def _run_in_worker(scenario: Scenario) -> dict:
+    return asdict(asyncio.run(_run_scenario(_worker_slot, scenario)))  # type: ignore
+
+
+def default_workers(n_scenarios: int) -> int:
+    return max(1, min(n_scenarios, (os.cpu_count() or 1) // CORES_PER_VALIDATOR))
+
+
+def run_scenarios(
+    scenarios: list[Scenario],
+    workers: Optional[int] = None,
+    output: Optional[str] = "runner_results.json",
+) -> list[dict]:
+    """
+    Runs every scenario on its own fresh validator, at most `workers` at a
+    time (by default as many as the cores allow), and returns the results in
+    scenario order.
+    """
+    workers = workers if workers is not None else default_workers(len(scenarios))
+    context = multiprocessing.get_context("spawn")
+    slots = context.Manager().Queue()
+    for slot in range(workers):
+        slots.put(slot)
+
+    start = time.time()
+    print(f"running {len(scenarios)} scenarios on {workers} validators")
+    with ProcessPoolExecutor(
+        workers, mp_context=context, initializer=_init_worker, initargs=(slots,)
+    ) as executor:
+        results = list(executor.map(_run_in_worker, scenarios))
+
+    failed = [r for r in results if not r["ok"]]
+    print(
+        f"ran {len(scenarios)} scenarios in {time.time() - start:.2f}s "
+        f"({len(failed)} failed)"
+    )
+    for r in failed:
+        print(f"  {r['name']}: {r['error']}")
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "commit": os.environ.get("COMMIT"),
+                    "created_at": time.time(),
+                    "workers": workers,
+                    "scenarios": results,
+                },
+                f,
+                indent=4,
+                default=str,
+            )
+        print(f"results written to {output}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seeds", type=int, default=4)
+    parser.add_argument("--num-actions", type=int, default=10)
+    parser.add_argument("--market-index", type=int, default=9)
+    parser.add_argument("--output", default="runner_results.json")
+    args = parser.parse_args()
+
+    scenarios = [
+        Scenario(
+            f"random_actions-{seed}",
+            random_actions,
+            {
+                "num_actions": args.num_actions,
+                "seed": seed,
+                "market_index": args.market_index,
+            },
+        )
+        for seed in range(args.seeds)
+    ]
+    run_scenarios(scenarios, args.workers, args.output)
+
+
+if __name__ == "__main__":
+    main()
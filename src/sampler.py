@@ -0,0 +1,267 @@
+"""
+Background market-state sampler. Every `every_slots` slots it reads all perp
+markets, spot markets and insurance fund vaults in one batched
+getMultipleAccounts and stores the sampled fields in preallocated NumPy ring
+buffers, which are written to the run's results file as `perp_market_samples`
+and `spot_market_samples` (one row per sample and market).
+
+The sampler runs on the simulation's event loop, so the time it spends
+decoding and storing is time the tx path waits; it is measured per sample and
+reported as a share of the run's wall time.
+"""
+import asyncio
+import operator
+import time
+
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.addresses import get_perp_market_public_key, get_spot_market_public_key
+from driftpy.admin import Admin
+
+from src.balances import parse_token_amount
+from src.oracles import ACCOUNTS_PER_REQUEST
+from src.recorder import SlotClock
+from src.results import ResultsWriter
+
+PERP_SAMPLE_FIELDS = [
+    "amm.base_asset_reserve",
+    "amm.quote_asset_reserve",
+    "amm.sqrt_k",
+    "amm.peg_multiplier",
+    "amm.base_asset_amount_with_amm",
+    "amm.base_asset_amount_long",
+    "amm.base_asset_amount_short",
+    "amm.quote_asset_amount",
+    "amm.total_fee_minus_distributions",
+    "amm.total_social_loss",
+    "amm.fee_pool.scaled_balance",
+    "amm.historical_oracle_data.last_oracle_price",
+    "amm.last_mark_price_twap",
+    "pnl_pool.scaled_balance",
+    "number_of_users_with_base",
+]
+SPOT_SAMPLE_FIELDS = [
+    "deposit_balance",
+    "borrow_balance",
+    "cumulative_deposit_interest",
+    "cumulative_borrow_interest",
+    "revenue_pool.scaled_balance",
+    "spot_fee_pool.scaled_balance",
+    "total_social_loss",
+    "total_quote_social_loss",
+    "historical_oracle_data.last_oracle_price",
+]
+
+
+class RingBuffer:
+    """
+    `capacity` samples of float64 fields for `width` markets each. Once full
+    the oldest samples are overwritten (and counted in `dropped`).
+    """
+
+    def __init__(self, fields: list[str], width: int, capacity: int):
+        self.fields = fields
+        self.capacity = capacity
+        self.slots = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = {name: np.zeros((capacity, width)) for name in fields}
+        self.count = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    @property
+    def full(self) -> bool:
+        return len(self) == self.capacity
+
+    def next_row(self, slot: int, timestamp: float) -> int:
+        """Claims the next row; the caller fills `values[field][row]`"""
+        if self.full:
+            self.dropped += 1
+        row = self.count % self.capacity
+        self.slots[row] = slot
+        self.timestamps[row] = timestamp
+        self.count += 1
+        return row
+
+    def rows(self) -> np.ndarray:
+        """Row indexes in sample order"""
+        if not self.full:
+            return np.arange(self.count)
+        start = self.count % self.capacity
+        return np.roll(np.arange(self.capacity), -start)
+
+    def to_columns(self, market_indexes: np.ndarray) -> dict[str, np.ndarray]:
+        """Long format: one row per (sample, market)"""
+        rows = self.rows()
+        width = len(market_indexes)
+        columns = {
+            "slot": np.repeat(self.slots[rows], width),
+            "timestamp": np.repeat(self.timestamps[rows], width),
+            "market_index": np.tile(market_indexes, len(rows)),
+        }
+        for name in self.fields:
+            columns[name] = self.values[name][rows].reshape(-1)
+        return columns
+
+    def clear(self):
+        self.count = 0
+
+
+@dataclass
+class SamplerStats:
+    samples: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    # seconds awaiting getMultipleAccounts, off the event loop
+    fetch_time: float = 0.0
+    # seconds decoding and storing, during which the tx path cannot run
+    loop_time: float = 0.0
+
+    @property
+    def loop_share(self) -> float:
+        return self.loop_time / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class MarketSampler:
+    def __init__(
+        self,
+        admin: Admin,
+        results: Optional[ResultsWriter] = None,
+        every_slots: int = 5,
+        capacity: int = 2048,
+    ):
+        self.admin = admin
+        self.results = results
+        self.every_slots = every_slots
+        self.capacity = capacity
+        self.clock = SlotClock(admin.connection)  # type: ignore
+        self.task: Optional[asyncio.Task] = None
+        self.stats = SamplerStats()
+        self.started_at = 0.0
+
+        perp_markets = admin.get_perp_market_accounts()
+        spot_markets = admin.get_spot_market_accounts()
+        program_id = admin.program_id
+        self.perp_market_indexes = np.array([m.market_index for m in perp_markets])
+        self.spot_market_indexes = np.array([m.market_index for m in spot_markets])
+        self.accounts: list[Pubkey] = [
+            get_perp_market_public_key(program_id, i) for i in self.perp_market_indexes
+        ]
+        self.accounts += [
+            get_spot_market_public_key(program_id, i) for i in self.spot_market_indexes
+        ]
+        self.accounts += [m.insurance_fund.vault for m in spot_markets]
+
+        self.perp_getters = [operator.attrgetter(f) for f in PERP_SAMPLE_FIELDS]
+        self.spot_getters = [operator.attrgetter(f) for f in SPOT_SAMPLE_FIELDS]
+        self.perp_buffer = RingBuffer(PERP_SAMPLE_FIELDS, len(perp_markets), capacity)
+        self.spot_buffer = RingBuffer(
+            SPOT_SAMPLE_FIELDS + ["insurance_fund_balance"],
+            len(spot_markets),
+            capacity,
+        )
+
+    async def _fetch(self) -> tuple[int, list]:
+        responses = await asyncio.gather(
+            *[
+                self.admin.connection.get_multiple_accounts(
+                    self.accounts[i : i + ACCOUNTS_PER_REQUEST]
+                )
+                for i in range(0, len(self.accounts), ACCOUNTS_PER_REQUEST)
+            ]
+        )
+        slot = min(resp.context.slot for resp in responses)
+        return slot, [account for resp in responses for account in resp.value]
+
+    def _store(
+        self,
+        buffer: RingBuffer,
+        row: int,
+        getters: list[Callable],
+        markets: list,
+    ):
+        for name, get in zip(buffer.fields, getters):
+            buffer.values[name][row] = [float(get(market)) for market in markets]
+
+    def _record(self, slot: int, accounts: list):
+        decode = self.admin.program.coder.accounts.parse
+        n_perp = len(self.perp_market_indexes)
+        n_spot = len(self.spot_market_indexes)
+        perp_markets = [decode(a.data).data for a in accounts[:n_perp]]
+        spot_markets = [decode(a.data).data for a in accounts[n_perp : n_perp + n_spot]]
+        insurance_fund_vaults = accounts[n_perp + n_spot :]
+
+        timestamp = time.time()
+        # both buffers fill at the same rate
+        if self.perp_buffer.full and self.results is not None:
+            self.flush()
+        row = self.perp_buffer.next_row(slot, timestamp)
+        self._store(self.perp_buffer, row, self.perp_getters, perp_markets)
+        row = self.spot_buffer.next_row(slot, timestamp)
+        self._store(self.spot_buffer, row, self.spot_getters, spot_markets)
+        self.spot_buffer.values["insurance_fund_balance"][row] = [
+            parse_token_amount(vault.data) if vault is not None else np.nan
+            for vault in insurance_fund_vaults
+        ]
+
+    async def sample(self):
+        start = time.time()
+        try:
+            slot, accounts = await self._fetch()
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"failed to sample markets: {e}")
+            return
+        fetched = time.time()
+        self._record(slot, accounts)
+        self.stats.fetch_time += fetched - start
+        self.stats.loop_time += time.time() - fetched
+        self.stats.samples += 1
+
+    async def _run(self):
+        slot = await self.clock.start()
+        while True:
+            await self.sample()
+            slot += self.every_slots
+            await self.clock.wait_for(slot)
+
+    def start(self):
+        self.started_at = time.time()
+        self.task = asyncio.create_task(self._run())
+
+    def flush(self):
+        if self.results is None:
+            return
+        start = time.time()
+        for table, buffer, market_indexes in [
+            ("perp_market_samples", self.perp_buffer, self.perp_market_indexes),
+            ("spot_market_samples", self.spot_buffer, self.spot_market_indexes),
+        ]:
+            if len(buffer) > 0:
+                self.results.write_columns(table, buffer.to_columns(market_indexes))
+            buffer.clear()
+        self.stats.loop_time += time.time() - start
+
+    async def stop(self) -> SamplerStats:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.clock.stop()
+        self.flush()
+        self.stats.elapsed = time.time() - self.started_at
+        print(
+            f"sampled {len(self.perp_market_indexes)} perp and "
+            f"{len(self.spot_market_indexes)} spot markets {self.stats.samples} "
+            f"times ({self.stats.failed} failed), "
+            f"{self.stats.loop_time * 1000:.1f}ms on the event loop "
+            f"({self.stats.loop_share:.3%} of {self.stats.elapsed:.2f}s)"
+        )
+        return self.stats
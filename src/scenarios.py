@@ -1,12 +1,7 @@
 import asyncio
-import pprint
-import subprocess
 import traceback
 
-from typing import Optional
-from termcolor import colored
-
-from solana.rpc.async_api import AsyncClient
+from typing import Callable, Optional
 
 from solders.signature import Signature  # type: ignore
 
@@ -16,77 +11,156 @@ from driftpy.decode.utils import decode_name
 from driftpy.types import *
 
 from src.actions import *
+from src.balances import get_vault_balances
+from src.confirm import SignatureConfirmer
+from src.lp import unwind_lp_positions
+from src.oracles import oracle_source_multiplier
+from src.orders import OpenOrderIndex
+from src.preflight import PreflightCache
+from src.pricepaths import (
+    jump_diffusion_paths,
+    load_price_feeds,
+    play_price_paths,
+    start_prices,
+    uniform_correlation,
+)
+from src.scheduler import Condition, Scheduler, Step, StepFn
+from src.settle import SettleEngine
 from src.slack import ExpiredMarket, SimulationResultBuilder
+from src.waiters import (
+    wait_for_block_time,
+    wait_for_oracle_price,
+    wait_for_perp_market,
+)
+
+async def record_spot_markets(
+    admin: Admin, add_spot_market: Callable[..., None]
+) -> list[SpotMarketAccount]:
+    """
+    Passes (insurance fund balance, spot vault balance, market) of every spot
+    market to `add_spot_market`, e.g. `sim_results.add_initial_spot_market`
+    """
+    spot_markets = admin.get_spot_market_accounts()
+    balances = await get_vault_balances(admin.connection, spot_markets)
+    for market in spot_markets:
+        balance = balances[market.market_index]
+        if_balance = balance.insurance_fund_balance
+        vault_balance = balance.spot_vault_balance
+        print(f"{decode_name(market.name)}: {if_balance} {vault_balance}")
+        add_spot_market(if_balance, vault_balance, market)
+    return spot_markets
 
-async def get_insurance_fund_balance(connection: AsyncClient, spot_market: SpotMarketAccount):
-    print(spot_market.insurance_fund.vault)
-    balance = await connection.get_token_account_balance(
-        spot_market.insurance_fund.vault
-    )
-    if not hasattr(balance, 'value'):
-        return
-    return balance.value.ui_amount
+
+def oracle_move(
+    market_index: int,
+    pct_delta: Optional[float] = None,
+    price_delta: Optional[int] = None,
+) -> StepFn:
+    """Step that moves a perp market's oracle from its current price"""
+    if price_delta is None and pct_delta is None:
+        raise ValueError("need to provide price or pct delta")
+
+    async def move(admin: Admin):
+        await admin.account_subscriber.update_cache()
+        amm = admin.get_perp_market_account(market_index).amm  # type: ignore
+        price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
+        if price_delta is not None:
+            new_price = price + price_delta
+        else:
+            new_price = int(price * (1 + pct_delta))  # type: ignore
+        multiplier = oracle_source_multiplier(amm.oracle_source)
+        sig = await set_oracle_price(admin, amm.oracle, new_price, multiplier)
+        print(f"oracle price {price} -> {new_price} for perp market {market_index}")
+        return sig
+
+    return move
+
+
+def action(a: Action) -> StepFn:
+    async def execute(admin: Admin):
+        return await a.execute(admin)
+
+    return execute
 
 
-async def get_spot_vault_balance(connection: AsyncClient, spot_market: SpotMarketAccount):
-    print(spot_market.vault)
-    balance = await connection.get_token_account_balance(spot_market.vault)
-    if not hasattr(balance, 'value'):
-        return
-    return balance.value.ui_amount
+def cancel_market_orders(agents: list[DriftClient], market_index: int) -> StepFn:
+    """Step that cancels every agent subaccount's orders in a perp market"""
+
+    async def cancel(admin: Admin):
+        index = OpenOrderIndex(agents)
+        await index.refresh_users()
+        targets = index.users(MarketType.Perp(), market_index)
+        return await asyncio.gather(
+            *[
+                agents[agent_index].cancel_orders(
+                    sub_account_id=sub_account_id,
+                    market_index=market_index,
+                    market_type=MarketType.Perp(),
+                )
+                for agent_index, sub_account_id in targets
+            ]
+        )
+
+    return cancel
+
+
+def expire_perp_market(market_index: int, offset: int = 50) -> StepFn:
+    """Step that sets the market's expiry to `offset` seconds after block time"""
+
+    async def expire(admin: Admin):
+        slot = (await admin.connection.get_slot()).value
+        blocktime: int = (await admin.connection.get_block_time(slot)).value  # type: ignore
+        return await admin.update_perp_market_expiry(market_index, blocktime + offset)
+
+    return expire
+
+
+def settle_expired_market(market_index: int) -> StepFn:
+    async def settle(admin: Admin):
+        return await admin.settle_expired_market(market_index)
+
+    return settle
+
+
+def perp_market_status(market_index: int, status: str) -> Condition:
+    async def has_status(admin: Admin) -> bool:
+        await admin.account_subscriber.update_cache()
+        market = admin.get_perp_market_account(market_index)
+        return is_variant(market.status, status)  # type: ignore
+
+    return has_status
+
 
 async def oracle_jump(
     admin: Admin,
-    sleep: int,
+    every: int,
     market_index: int,
     price_delta: Optional[int] = None,
     pct_delta: Optional[float] = None,
-):
-    async def price_jump():
-        while True:
-            oracle = admin.get_perp_market_account(market_index).amm.oracle  # type: ignore
-            price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
-            print(f"old price: {price}")
-            new_price = price + price_delta
-            print(f"new price: {new_price}")
-            sig = await set_oracle_price(admin, oracle, new_price)
-            print(
-                f"new oracle price: {new_price} set for perp market: {market_index}: {sig}"
-            )
-            await asyncio.sleep(sleep)
-            await admin.account_subscriber.update_cache()
-
-    async def pct_jump():
-        while True:
-            oracle = admin.get_perp_market_account(market_index).amm.oracle  # type: ignore
-            price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
-            print(f"old price: {price}")
-            new_price = int(price * (1 + pct_delta))
-            print(f"new price: {new_price}")
-            sig = await set_oracle_price(admin, oracle, new_price)
-            print(
-                f"new oracle price: {new_price} set for perp market: {market_index}: {sig}"
-            )
-            await asyncio.sleep(sleep)
-            await admin.account_subscriber.update_cache()
-
-    if price_delta is not None:
-        asyncio.create_task(price_jump())
-    elif pct_delta is not None:
-        asyncio.create_task(pct_jump())
-    else:
-        raise ValueError("need to provide price or pct delta")
+) -> asyncio.Task:
+    """
+    Moves the oracle every `every` slots in the background until the returned
+    task is cancelled
+    """
+    step = Step(
+        f"oracle_jump {market_index}",
+        oracle_move(market_index, pct_delta, price_delta),
+        at_slot=0,
+        every=every,
+    )
+    return asyncio.create_task(Scheduler(admin, [step]).run())
 
 
 async def move_oracle_up_40(admin: Admin, market_index: int):
     await admin.update_liquidation_duration(0) # type: ignore
 
-    oracle = admin.get_perp_market_account(market_index).amm.oracle  # type: ignore
+    amm = admin.get_perp_market_account(market_index).amm  # type: ignore
     price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
     new_price = int(price * 1.4)
-    sig = await set_oracle_price(admin, oracle, new_price)
+    multiplier = oracle_source_multiplier(amm.oracle_source)
+    sig = await set_oracle_price(admin, amm.oracle, new_price, multiplier)
     print(f"new oracle price: {new_price} set for perp market: {market_index}: {sig}")
-    await asyncio.sleep(30)
+    await wait_for_oracle_price(admin, amm.oracle, new_price, amm.oracle_source)
     await admin.account_subscriber.update_cache()
     assert admin.get_oracle_price_data_for_perp_market(market_index).price == new_price, f"oracle price {admin.get_oracle_price_data_for_perp_market(market_index).price} dne {new_price}"  # type: ignore
 
@@ -95,21 +169,72 @@ async def move_oracle_down_40(admin: Admin, market_index: int):
     await admin.update_liquidation_duration(0) # type: ignore
     oracle_guard_rails = OracleGuardRails(PriceDivergenceGuardRails(1_000_000, 1_000_000), ValidityGuardRails(1_000_000, 1_000_000, 1_000_000, 1_000_000))
     await admin.update_oracle_guard_rails(oracle_guard_rails)  # type: ignore
-    oracle = admin.get_perp_market_account(market_index).amm.oracle  # type: ignore
+    amm = admin.get_perp_market_account(market_index).amm  # type: ignore
     price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
     new_price = int(price * 0.2)
-    sig = await set_oracle_price(admin, oracle, new_price)
+    multiplier = oracle_source_multiplier(amm.oracle_source)
+    sig = await set_oracle_price(admin, amm.oracle, new_price, multiplier)
     print(f"new oracle price: {new_price} set for perp market: {market_index}: {sig}")
-    await asyncio.sleep(30)
+    await wait_for_oracle_price(admin, amm.oracle, new_price, amm.oracle_source)
     await admin.account_subscriber.update_cache()
     assert admin.get_oracle_price_data_for_perp_market(market_index).price == new_price, f"oracle price {admin.get_oracle_price_data_for_perp_market(market_index).price} dne {new_price}"  # type: ignore
 
+async def move_perp_oracles(admin: Admin, market_indexes: list[int], multiplier: float):
+    """Moves the oracles of all `market_indexes` in the same tx(s)"""
+    markets = [admin.get_perp_market_account(i) for i in market_indexes]
+    prices = {}
+    source_multipliers = {}
+    for market_index, market in zip(market_indexes, markets):
+        price = admin.get_oracle_price_data_for_perp_market(market_index).price  # type: ignore
+        prices[market.amm.oracle] = int(price * multiplier)  # type: ignore
+        source_multipliers[market.amm.oracle] = oracle_source_multiplier(market.amm.oracle_source)  # type: ignore
+    sigs = await set_oracle_prices(admin, prices, source_multipliers)
+    print(f"new oracle prices set for perp markets: {market_indexes}: {sigs}")
+    await asyncio.gather(
+        *[
+            wait_for_oracle_price(admin, market.amm.oracle, prices[market.amm.oracle], market.amm.oracle_source)  # type: ignore
+            for market in markets
+        ]
+    )
+    await admin.account_subscriber.update_cache()
+
+
+async def crash_all_markets(
+    admin: Admin,
+    n_steps: int = 30,
+    crash: float = -0.4,
+    sigma: float = 0.01,
+    rho: float = 0.8,
+    slots_per_step: int = 2,
+    seed: int = 0,
+):
+    """
+    Correlated jump diffusion across every perp and spot oracle with one
+    market-wide jump of `crash` (log size) expected over the run.
+    """
+    await admin.account_subscriber.update_cache()
+    feeds = load_price_feeds(admin)
+    paths = jump_diffusion_paths(
+        start_prices(feeds),
+        n_steps,
+        sigma,
+        jump_intensity=1 / n_steps,
+        jump_mean=crash,
+        jump_std=abs(crash) / 4,
+        corr=uniform_correlation(len(feeds), rho),
+        seed=seed,
+    )
+    await play_price_paths(admin, feeds, paths, slots_per_step)
+    await admin.account_subscriber.update_cache()
+
+
 async def usdc_to_zero(admin: Admin):
-    oracle = admin.get_spot_market_account(0).oracle # type: ignore
+    spot_market = admin.get_spot_market_account(0)  # type: ignore
     new_price = 0
-    sig = await set_oracle_price(admin, oracle, new_price)
+    multiplier = oracle_source_multiplier(spot_market.oracle_source)  # type: ignore
+    sig = await set_oracle_price(admin, spot_market.oracle, new_price, multiplier)  # type: ignore
     print(f"new oracle price: {new_price} set for spot market: {0}: {sig}")
-    await asyncio.sleep(15)
+    await wait_for_oracle_price(admin, spot_market.oracle, new_price, spot_market.oracle_source)  # type: ignore
     await admin.account_subscriber.update_cache()   
     assert admin.get_oracle_price_data_for_spot_market(0).price == new_price, f"oracle price {admin.get_oracle_price_data_for_spot_market(0).price} dne {new_price}"  # type: ignore
 
@@ -118,18 +243,18 @@ async def close_market(
     agents: list[DriftClient],
     sim_results: SimulationResultBuilder,
     market_index: int,
+    preflight: Optional[PreflightCache] = None,
 ):
+    confirmer = SignatureConfirmer(admin.connection)
+
     # record stats pre-closing
     await admin.account_subscriber.update_cache()
     perp_market = admin.get_perp_market_account(market_index)
     sim_results.add_initial_perp_market(perp_market)  # type: ignore
 
-    spot_markets = admin.get_spot_market_accounts()
-    for market in spot_markets:
-        if_balance = await get_insurance_fund_balance(admin.connection, market)
-        vault_balance = await get_spot_vault_balance(admin.connection, market)
-        print(f"{decode_name(market.name)}: {if_balance} {vault_balance}")
-        sim_results.add_initial_spot_market(if_balance, vault_balance, market)
+    spot_markets = await record_spot_markets(
+        admin, sim_results.add_initial_spot_market
+    )
 
     # update state
     await admin.update_perp_auction_duration(0)
@@ -141,14 +266,14 @@ async def close_market(
 
     print("updating expiries")
     offset = 50
+    expiry_ts = blocktime + offset
     sigs: list[Signature] = []
-    sig = await admin.update_perp_market_expiry(market_index, blocktime + offset)
+    sig = await admin.update_perp_market_expiry(market_index, expiry_ts)
     sigs.append(sig)
 
     for market in spot_markets:
-        sig = await admin.update_spot_market_expiry(
-            market.market_index, blocktime + offset
-        )
+        sig = await admin.update_spot_market_expiry(market.market_index, expiry_ts)
+        sigs.append(sig)
 
     before_user_lp_shares = perp_market.amm.user_lp_shares  # type: ignore
 
@@ -156,43 +281,28 @@ async def close_market(
     print("removing all user liq")
     print(f"removing lp for {len(agents)} agents")
     print(f"total market lp shares: {perp_market.amm.user_lp_shares}")  # type: ignore
-    running_lp_removed = 0
-    for i, agent in enumerate(agents):
-        print(f"removing liq for agent: {i}")
-        for subaccount in agent.sub_account_ids:
-            print(f"removing liq for agent: {i} subaccount: {subaccount}")
-            position = agent.get_perp_position(market_index, subaccount)
-            print(f"agent has position: {position is not None}")
-            print(f"agent has lp shares: {position.lp_shares > 0}")  # type: ignore
-            print(f"total lp shares for agent: {position.lp_shares}")  # type: ignore
-            if position is not None and position.lp_shares > 0:
-                print(
-                    f"removing lp on market {market_index} "
-                    f"for user: {str(agent.authority)} "
-                    f"(sub_account_id: {subaccount}, shares: {position.lp_shares})"
-                )
-                running_lp_removed += position.lp_shares
-                sig = await agent.remove_liquidity(
-                    position.lp_shares, market_index, subaccount
-                )
-                command = ["solana", "confirm", f"{sig}"]
-                output = subprocess.run(
-                    command, capture_output=True, text=True
-                ).stdout.strip()
-                if (
-                    "Confirmed" in output
-                    or "Processed" in output
-                    or "Finalized" in output
-                ):
-                    print(f"confirmed remove liq tx: {sig}")
-                else:
-                    print(f"failed to confirm remove liq tx: {output}")
-                await asyncio.sleep(5)
-                await admin.account_subscriber.update_cache()
-                perp_market = admin.get_perp_market_account(market_index)
-                assert perp_market.amm.user_lp_shares == before_user_lp_shares - running_lp_removed, f"user lp shares {perp_market.amm.user_lp_shares} dne {before_user_lp_shares - running_lp_removed}"  # type: ignore
-
-    await asyncio.sleep(15)  # make sure we get a new account
+    lp_unwind = await unwind_lp_positions(admin, agents, market_index, confirmer)
+    running_lp_removed = lp_unwind.removed_shares
+    elapsed = lp_unwind.elapsed
+    if len(lp_unwind.failed) > 0:
+        # mostly dropped or expired txs, retry those subaccounts once
+        await admin.account_subscriber.update_cache()
+        lp_unwind = await unwind_lp_positions(
+            admin, agents, market_index, confirmer, removals=lp_unwind.failed
+        )
+        running_lp_removed += lp_unwind.removed_shares
+        elapsed += lp_unwind.elapsed
+    sim_results.add_phase_timing("remove liquidity", elapsed)
+    if len(lp_unwind.failed) > 0:
+        failed = ", ".join(
+            f"{removal.agent.authority} (sub_account_id: {removal.sub_account_id})"
+            for removal in lp_unwind.failed
+        )
+        sim_results.post_fail(
+            f"failed to remove lp on market {market_index} for: {failed}"
+        )
+
+    # unwind_lp_positions waited for the shares it removed already
     await admin.account_subscriber.update_cache()
     perp_market = admin.get_perp_market_account(market_index)
     assert perp_market
@@ -205,19 +315,15 @@ async def close_market(
     print("waiting for expiry...")
 
     # fully expire market
-    for sig in sigs:
-        try:
-            command = ["solana", "confirm", f"{sig}"]
-            output = subprocess.run(
-                command, capture_output=True, text=True
-            ).stdout.strip()
-            if "Confirmed" in output or "Processed" in output or "Finalized" in output:
-                pass
-            else:
-                print(f"failed to confirm update transaction: {output}")
-        except Exception as e:
-            print(f"error confirming update_[perp|spot]_market txs: {e}")
-            traceback.print_exc()
+    try:
+        for result in await confirmer.confirm_all(sigs):
+            if not result.ok:
+                print(f"failed to confirm update transaction: {result.sig} {result.err}")
+    except Exception as e:
+        print(f"error confirming update_[perp|spot]_market txs: {e}")
+        traceback.print_exc()
+
+    await wait_for_block_time(admin.connection, expiry_ts)
 
     print("settling expired market")
     print(
@@ -226,14 +332,18 @@ async def close_market(
     print(f"user lp shares: {perp_market.amm.user_lp_shares}")
 
     sig = await admin.settle_expired_market(perp_market.market_index)
-    command = ["solana", "confirm", f"{sig}"]
-    output = subprocess.run(command, capture_output=True, text=True).stdout.strip()
-    if "Confirmed" in output or "Processed" in output or "Finalized" in output:
+    result = await confirmer.confirm(sig)
+    if result.ok:
         print(f"confirmed settle tx: {sig}")
     else:
-        print(f"failed to confirm settle tx: {output}")
+        print(f"failed to confirm settle tx: {sig} {result.err}")
 
-    await asyncio.sleep(30)  # make sure we get a new account from update cache
+    await wait_for_perp_market(
+        admin,
+        market_index,
+        lambda m: is_variant(m.status, "Settlement"),
+        description=f"perp market {market_index} status == Settlement",
+    )
     await admin.account_subscriber.update_cache()
     perp_market = admin.get_perp_market_account(market_index)
     assert perp_market
@@ -254,46 +364,16 @@ async def close_market(
     )
     sim_results.add_settled_expired_market(expired_market)
 
-    success = False
-    while not success:
-        attempt = -1
-        num_fails = 0
-        success = True
-        i = 0
-        errors = []  # type: ignore
-
-        if attempt > 5:
-            msg = "something went wrong during settle expired position with market "
-            msg += f"{10}... \n"
-            msg += f"failed to 10 {num_fails} users... \n"
-            msg += f"error msgs: {pprint.pformat(errors, indent=4)}"
-            sim_results.post_fail(msg)
-            return
-
-        attempt += 1
-
-        print(colored(f" =>> market 10: settle attempt {attempt}", "blue"))
-
-        for i, agent in enumerate(agents):
-            await agent.account_subscriber.update_cache()
-            for subaccount in agent.sub_account_ids:
-                position = agent.get_perp_position(market_index, subaccount)
-                if position is None:
-                    continue
-                user_account = agent.get_user_account(subaccount)
-                try:
-                    await agent.settle_pnl(
-                        agent.get_user_account_public_key(subaccount),
-                        user_account,
-                        market_index,
-                    )
-                    sim_results.add_settle_user_success(market_index)
-                except Exception as e:
-                    success = False
-                    num_fails += 1
-                    if attempt > 0:
-                        print(position, i, subaccount)
-                    errors.append(e)
-                    sim_results.add_settle_user_fail(e, market_index)
-
-        print(f"settled fin... {i + 1}/{len(agents)}")  # +1 cause i starts at 0)
+    settle_engine = SettleEngine(
+        agents,
+        market_index,
+        sim_results,
+        preflight=preflight,
+    )
+    settled = await settle_engine.run()
+
+    # record stats post-settling
+    await admin.account_subscriber.update_cache()
+    sim_results.add_final_perp_market(admin.get_perp_market_account(market_index))  # type: ignore
+    await record_spot_markets(admin, sim_results.add_final_spot_market)
+    return settled
@@ -0,0 +1,228 @@
+"""
+Runs a declarative timeline of scenario steps against the chain's slot clock,
+e.g. with the step builders of `src.scenarios`:
+
+    timeline = [
+        Step("crash", oracle_move(9, -0.4), at_slot=0),
+        Step("pause", action(UpdateImfAction(9, 0, 0)), at_slot=0),
+        Step("expire", expire_perp_market(9, 30), after=["crash", "pause"]),
+        Step("settle", settle_expired_market(9), after=["expire"],
+             when=perp_market_status(9, "Settlement")),
+        Step("noise", oracle_move(0, 0.01), every=5, until_slot=200),
+    ]
+    results = await Scheduler(admin, timeline).run()
+
+A step starts as soon as all of its `after` steps succeeded, `at_slot` slots
+have passed since the timeline started and its `when` condition holds, so
+independent steps run concurrently. Steps with `every` repeat every that many
+slots until `until_slot`, or until the rest of the timeline is done.
+"""
+import asyncio
+import time
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from driftpy.admin import Admin
+
+from src.recorder import SlotClock
+from src.waiters import wait_until
+
+StepFn = Callable[[Admin], Awaitable[Any]]
+Condition = Callable[[Admin], Union[bool, Awaitable[bool]]]
+
+
+@dataclass
+class Step:
+    name: str
+    fn: StepFn
+    # slots after the timeline start
+    at_slot: Optional[int] = None
+    after: list[str] = field(default_factory=list)
+    when: Optional[Condition] = None
+    every: Optional[int] = None
+    until_slot: Optional[int] = None
+    # seconds, for the `when` condition and for each run
+    timeout: float = 120.0
+
+    @property
+    def open_ended(self) -> bool:
+        return self.every is not None and self.until_slot is None
+
+
+@dataclass
+class StepResult:
+    name: str
+    run: int
+    # "ok", "failed", "skipped" or "cancelled"
+    status: str
+    scheduled_slot: Optional[int] = None
+    start_slot: Optional[int] = None
+    # seconds since the timeline started
+    started: Optional[float] = None
+    latency: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+
+    @property
+    def slot_lag(self) -> Optional[int]:
+        if self.scheduled_slot is None or self.start_slot is None:
+            return None
+        return self.start_slot - self.scheduled_slot
+
+
+class Scheduler:
+    def __init__(
+        self,
+        admin: Admin,
+        steps: list[Step],
+        fail_fast: bool = False,
+        poll_interval: float = 0.4,
+    ):
+        names = [step.name for step in steps]
+        if len(set(names)) != len(names):
+            raise ValueError(f"step names must be unique: {names}")
+        for step in steps:
+            unknown = [name for name in step.after if name not in names]
+            if len(unknown) > 0:
+                raise ValueError(f"step {step.name} runs after unknown {unknown}")
+
+        self.admin = admin
+        self.steps = steps
+        self.fail_fast = fail_fast
+        self.poll_interval = poll_interval
+        self.clock = SlotClock(admin.connection, poll_interval)  # type: ignore
+        self.start_slot = 0
+        self.start = 0.0
+        self.results: list[StepResult] = []
+        self.status: dict[str, str] = {}
+        self.done: dict[str, asyncio.Event] = {}
+        self.tasks: list[asyncio.Task] = []
+
+    def relative_slot(self) -> int:
+        return self.clock.slot - self.start_slot
+
+    async def _execute(self, step: Step, run: int, scheduled: Optional[int]) -> bool:
+        result = StepResult(
+            step.name,
+            run,
+            "ok",
+            scheduled,
+            self.clock.slot,
+            time.time() - self.start,
+        )
+        self.results.append(result)
+        start = time.time()
+        try:
+            result.result = await asyncio.wait_for(step.fn(self.admin), step.timeout)
+        except asyncio.CancelledError:
+            result.status = "cancelled"
+            raise
+        except Exception as e:
+            result.status = "failed"
+            result.error = f"{type(e).__name__}: {e}"
+            print(f"step {step.name} (run {run}) failed: {result.error}")
+        finally:
+            result.latency = time.time() - start
+        return result.status == "ok"
+
+    async def _run_step(self, step: Step):
+        status = "ok"
+        run = 0
+        started = 0
+        try:
+            for name in step.after:
+                await self.done[name].wait()
+                if self.status[name] != "ok":
+                    status = "skipped"
+                    self.results.append(
+                        StepResult(step.name, run, status, error=f"{name} did not run")
+                    )
+                    return
+
+            slot = step.at_slot
+            while True:
+                scheduled = None
+                if slot is not None:
+                    scheduled = self.start_slot + slot
+                    await self.clock.wait_for(scheduled)
+                if step.when is not None:
+                    when = step.when
+                    await wait_until(
+                        lambda: when(self.admin),
+                        step.timeout,
+                        self.poll_interval,
+                        description=f"condition of step {step.name}",
+                    )
+                started += 1
+                if not await self._execute(step, run, scheduled):
+                    status = "failed"
+                    if self.fail_fast:
+                        self.cancel()
+
+                if step.every is None:
+                    break
+                slot = (slot if slot is not None else self.relative_slot()) + step.every
+                if step.until_slot is not None and slot > step.until_slot:
+                    break
+                run += 1
+        except asyncio.CancelledError:
+            if status == "ok":
+                status = "cancelled"
+            # a run that was cut short is already recorded by `_execute`
+            if started == run and (not step.open_ended or run == 0):
+                self.results.append(StepResult(step.name, run, "cancelled"))
+        except Exception as e:
+            # e.g. the `when` condition timed out
+            status = "failed"
+            self.results.append(
+                StepResult(step.name, run, status, error=f"{type(e).__name__}: {e}")
+            )
+            if self.fail_fast:
+                self.cancel()
+        finally:
+            if step.open_ended and status == "cancelled":
+                # stopping with the timeline is how open ended steps finish
+                status = "ok"
+            self.status[step.name] = status
+            self.done[step.name].set()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def run(self) -> list[StepResult]:
+        self.start_slot = await self.clock.start()
+        self.start = time.time()
+        self.done = {step.name: asyncio.Event() for step in self.steps}
+        self.tasks = [asyncio.create_task(self._run_step(step)) for step in self.steps]
+        bounded = [
+            task for step, task in zip(self.steps, self.tasks) if not step.open_ended
+        ]
+        try:
+            # a timeline of only open ended steps runs until it is cancelled
+            await asyncio.gather(
+                *(bounded if len(bounded) > 0 else self.tasks), return_exceptions=True
+            )
+        finally:
+            # open ended steps (and everything, if we were cancelled) stop here
+            self.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.clock.stop()
+            self.report()
+        return self.results
+
+    def report(self):
+        elapsed = time.time() - self.start
+        print(
+            f"timeline of {len(self.steps)} steps done in {elapsed:.2f}s, "
+            f"{self.relative_slot()} slots"
+        )
+        for result in self.results:
+            started = f"{result.started:.2f}s" if result.started is not None else "-"
+            latency = f"{result.latency:.2f}s" if result.latency is not None else "-"
+            lag = result.slot_lag if result.slot_lag is not None else "-"
+            print(
+                f"  {result.name + ':':<24} run {result.run:<3} {result.status:<9} "
+                f"started {started:<8} slot lag {lag:<4} latency {latency}"
+            )
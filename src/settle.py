@@ -0,0 +1,244 @@
+import asyncio
+import pprint
+import time
+
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from termcolor import colored
+
+from solana.rpc.core import RPCException
+
+from driftpy.drift_client import DriftClient
+
+from src.actions import extract_error
+from src.blockhash import SharedBlockhashTxSender
+from src.metrics import metrics
+from src.preflight import PreflightCache, PreflightError
+from src.slack import SimulationResultBuilder
+
+
+@dataclass(eq=False)
+class SettleTarget:
+    agent: DriftClient
+    sub_account_id: int
+    last_error: Optional[Exception] = None
+    ix: Any = None
+
+
+@dataclass
+class SettleAttemptStats:
+    attempt: int
+    submitted: int
+    succeeded: int
+    failed: int
+    elapsed: float
+    fail_reasons: Counter = field(default_factory=Counter)
+
+    @property
+    def throughput(self) -> float:
+        return self.submitted / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def settle_error_reason(e: Exception) -> str:
+    if isinstance(e, RPCException):
+        try:
+            reason = extract_error(e.args[0])
+            if reason is not None:
+                return reason
+        except Exception:
+            pass
+    return f"{type(e).__name__}: {e}"
+
+
+class SettleEngine:
+    """
+    Settles pnl for every (agent, subaccount) with a position in `market_index`.
+
+    Each attempt settles the current queue with at most `concurrency` settle
+    txs in flight; only the users that failed are re-queued for the next
+    attempt, after an exponential backoff.
+
+    With a `preflight` cache the settle txs of an attempt are simulated as a
+    batch first and users whose settle is known to fail are not sent.
+    """
+
+    def __init__(
+        self,
+        agents: list[DriftClient],
+        market_index: int,
+        sim_results: SimulationResultBuilder,
+        concurrency: int = 32,
+        max_attempts: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 15.0,
+        preflight: Optional[PreflightCache] = None,
+    ):
+        self.agents = agents
+        self.market_index = market_index
+        self.sim_results = sim_results
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.preflight = preflight
+        self.attempts: list[SettleAttemptStats] = []
+
+    async def _refresh(self, target: SettleTarget):
+        async with self.semaphore:
+            user = target.agent.get_user(target.sub_account_id)
+            await user.account_subscriber.update_cache()
+
+    async def _preflight(self, queue: list[SettleTarget]) -> set[SettleTarget]:
+        """Returns the targets whose settle simulated (or was cached) as failing"""
+        for target in queue:
+            agent = target.agent
+            target.ix = agent.get_settle_pnl_ix(
+                agent.get_user_account_public_key(target.sub_account_id),
+                agent.get_user_account(target.sub_account_id),
+                self.market_index,
+            )
+
+        outcomes = await self.preflight.check(  # type: ignore
+            [(target.agent.authority, [target.ix]) for target in queue]
+        )
+
+        doomed = set()
+        for target, outcome in zip(queue, outcomes):
+            if not outcome.ok:
+                target.last_error = PreflightError(outcome.error_message)
+                doomed.add(target)
+        return doomed
+
+    async def _settle(
+        self, target: SettleTarget, attempt: int, doomed: bool = False
+    ) -> bool:
+        if doomed:
+            return False
+
+        async with self.semaphore:
+            agent = target.agent
+            user_account = agent.get_user_account(target.sub_account_id)
+            try:
+                async with metrics.track(
+                    "settle_pnl", agent.connection, retries=attempt
+                ) as sample:
+                    if target.ix is not None:
+                        sample.sig = (await agent.send_ixs([target.ix])).tx_sig
+                    else:
+                        sample.sig = await agent.settle_pnl(
+                            agent.get_user_account_public_key(target.sub_account_id),
+                            user_account,
+                            self.market_index,
+                        )
+                target.last_error = None
+                return True
+            except Exception as e:
+                target.last_error = e
+                return False
+
+    async def _refresh_blockhashes(self, queue: list[SettleTarget]):
+        # a retry within the provider's refresh interval would rebuild a byte
+        # identical tx that the validator drops as a duplicate signature
+        providers = {
+            id(sender.blockhash_provider): sender.blockhash_provider
+            for sender in (target.agent.tx_sender for target in queue)
+            if isinstance(sender, SharedBlockhashTxSender)
+        }
+        await asyncio.gather(*[provider.refresh() for provider in providers.values()])
+
+    async def collect_targets(self) -> list[SettleTarget]:
+        targets = [
+            SettleTarget(agent, sub_account_id)
+            for agent in self.agents
+            for sub_account_id in agent.sub_account_ids
+        ]
+        await asyncio.gather(*[self._refresh(target) for target in targets])
+        return [
+            target
+            for target in targets
+            if target.agent.get_perp_position(
+                self.market_index, target.sub_account_id
+            )
+            is not None
+        ]
+
+    async def run(self) -> bool:
+        queue = await self.collect_targets()
+        print(f"settling {len(queue)} users in market {self.market_index}")
+
+        for attempt in range(self.max_attempts):
+            if len(queue) == 0:
+                break
+
+            if attempt > 0:
+                backoff = min(self.base_backoff * 2 ** (attempt - 1), self.max_backoff)
+                await asyncio.sleep(backoff)
+                # positions may have moved since the failed attempt
+                await asyncio.gather(*[self._refresh(target) for target in queue])
+                await self._refresh_blockhashes(queue)
+
+            print(
+                colored(
+                    f" =>> market {self.market_index}: settle attempt {attempt} "
+                    f"({len(queue)} users)",
+                    "blue",
+                )
+            )
+
+            start = time.time()
+            doomed: set[SettleTarget] = set()
+            if self.preflight is not None:
+                doomed = await self._preflight(queue)
+                if len(doomed) > 0:
+                    print(f"skipping {len(doomed)} settles that fail preflight")
+
+            results = await asyncio.gather(
+                *[self._settle(target, attempt, target in doomed) for target in queue]
+            )
+            elapsed = time.time() - start
+
+            failures = []
+            fail_reasons: Counter = Counter()
+            for target, ok in zip(queue, results):
+                if ok:
+                    self.sim_results.add_settle_user_success(self.market_index)
+                    continue
+                failures.append(target)
+                reason = settle_error_reason(target.last_error)  # type: ignore
+                fail_reasons[reason] += 1
+                self.sim_results.add_settle_user_fail(
+                    target.last_error, self.market_index  # type: ignore
+                )
+
+            stats = SettleAttemptStats(
+                attempt,
+                len(queue),
+                len(queue) - len(failures),
+                len(failures),
+                elapsed,
+                fail_reasons,
+            )
+            self.attempts.append(stats)
+            self.sim_results.add_settle_attempt(self.market_index, stats)
+            print(
+                f"settled {stats.succeeded}/{stats.submitted} in {elapsed:.2f}s "
+                f"({stats.throughput:.1f} settles/s)"
+            )
+
+            queue = failures
+
+        if len(queue) > 0:
+            errors = [settle_error_reason(t.last_error) for t in queue]  # type: ignore
+            msg = "something went wrong during settle expired position with market "
+            msg += f"{self.market_index}... \n"
+            msg += f"failed to settle {len(queue)} users "
+            msg += f"after {self.max_attempts} attempts... \n"
+            msg += f"error msgs: {pprint.pformat(Counter(errors), indent=4)}"
+            self.sim_results.add_final_settle_results(self.market_index, False)
+            self.sim_results.post_fail(msg)
+            return False
+
+        self.sim_results.add_final_settle_results(self.market_index, True)
+        return True
@@ -1,9 +1,14 @@
+import asyncio
 import os
 import datetime as dt
 from collections import namedtuple
-from typing import List
-from slack_sdk import WebClient
+from typing import List, Optional
+
+import numpy as np
+
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
 from driftpy.types import PerpMarketAccount, SpotMarketAccount, SpotBalanceType
 from driftpy.constants.numeric_constants import (
     AMM_RESERVE_PRECISION,
@@ -14,33 +19,131 @@ from driftpy.constants.numeric_constants import (
     SPOT_CUMULATIVE_INTEREST_PRECISION,
 )
 
+from src.results import ResultsWriter
+
+DEFAULT_FALLBACK_PATH = "slack_messages.log"
+# well below the 40k chars slack accepts, so long coalesced posts stay readable
+MAX_MESSAGE_CHARS = 3500
+
 
 class Slack:
-    def __init__(self) -> None:
-        token = os.environ.get("SLACK_BOT_TOKEN")
-        channel = os.environ.get("SLACK_CHANNEL")
+    """
+    Posts messages from a background task so callers never wait on Slack.
+    `send_message` only enqueues (up to `queue_size` pending messages, later
+    ones are dropped); the task coalesces whatever is queued into as few
+    messages as fit `max_chars`, posts at most one every `min_interval`
+    seconds and retries rate limited posts. Without a token and channel, or
+    when a post fails, messages are appended to `fallback_path` instead.
+
+    `base_url` points the client at a local stand-in of the Slack web api.
+    Call `close()` before the event loop ends to deliver what is queued.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        channel: Optional[str] = None,
+        base_url: Optional[str] = None,
+        fallback_path: str = DEFAULT_FALLBACK_PATH,
+        queue_size: int = 256,
+        min_interval: float = 1.0,
+        max_chars: int = MAX_MESSAGE_CHARS,
+    ) -> None:
+        token = token if token is not None else os.environ.get("SLACK_BOT_TOKEN")
+        channel = channel if channel is not None else os.environ.get("SLACK_CHANNEL")
+        self.fallback_path = fallback_path
+        self.min_interval = min_interval
+        self.max_chars = max_chars
+        self.queue: asyncio.Queue[str] = asyncio.Queue(queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.written = 0
+        self.dropped = 0
         if token is None or channel is None:
             print(
                 "SLACK_BOT_TOKEN or SLACK_CHANNEL environment variables not set."
-                " Skipping slack notifications."
+                f" Writing slack notifications to {fallback_path}."
             )
             self.client = None
             self.channel = None
         else:
-            self.client = WebClient(token=token)
+            self.client = AsyncWebClient(
+                token=token,
+                base_url=base_url or AsyncWebClient.BASE_URL,
+                retry_handlers=[AsyncRateLimitErrorRetryHandler(max_retry_count=3)],
+            )
             self.channel = channel
 
     def can_send_messages(self) -> bool:
         return self.client is not None and self.channel is not None
 
-    def send_message(self, msg):
-        if self.client is None or self.channel is None:
+    def send_message(self, msg: str):
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.dropped += 1
             return
-
+        if self.task is None:
+            try:
+                self.task = asyncio.get_running_loop().create_task(self._run())
+            except RuntimeError:
+                # no loop yet, the first send (or close) inside one starts it
+                pass
+
+    def _coalesce(self, first: str) -> list[list[str]]:
+        batches = [[first]]
+        size = len(first)
+        while not self.queue.empty():
+            msg = self.queue.get_nowait()
+            if size + 1 + len(msg) <= self.max_chars:
+                batches[-1].append(msg)
+                size += 1 + len(msg)
+            else:
+                batches.append([msg])
+                size = len(msg)
+        return batches
+
+    def _write_fallback(self, text: str):
+        with open(self.fallback_path, "a") as f:
+            f.write(f"[{dt.datetime.utcnow():%Y-%m-%d %H:%M:%S}] {text}\n\n")
+
+    async def _post(self, text: str):
+        if self.client is not None:
+            try:
+                await self.client.chat_postMessage(channel=self.channel, text=text)
+                self.sent += 1
+                return
+            except Exception as e:
+                # the reporter must outlive any slack or network error
+                reason = e.response["error"] if isinstance(e, SlackApiError) else e
+                print(f"failed to post to slack ({reason}), writing to file")
+        await asyncio.to_thread(self._write_fallback, text)
+        self.written += 1
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            for batch in self._coalesce(first):
+                await self._post("\n".join(batch))
+                for _ in batch:
+                    self.queue.task_done()
+                if self.client is not None:
+                    await asyncio.sleep(self.min_interval)
+
+    async def close(self, timeout: float = 30):
+        """Delivers the queued messages, waiting at most `timeout` seconds"""
+        if self.task is None and not self.queue.empty():
+            self.task = asyncio.create_task(self._run())
         try:
-            self.client.chat_postMessage(channel=self.channel, text=msg)
-        except SlackApiError as e:
-            assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"gave up on {self.queue.qsize()} queued slack messages")
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.dropped > 0:
+            print(f"dropped {self.dropped} slack messages, the queue was full")
 
 
 ExpiredMarket = namedtuple(
@@ -111,11 +214,13 @@ class SimulationResultBuilder:
         self.total_users = 0
         self.settle_user_success = {}  # type: ignore
         self.settle_user_fail_reasons = {}  # type: ignore
+        self.settle_attempts = {}  # type: ignore
         self.initial_perp_markets = []  # type: ignore
         self.initial_spot_markets = []  # type: ignore
         self.final_perp_markets = []  # type: ignore
         self.final_spot_markets = []  # type: ignore
         self.final_settle_results = {}  # type: ignore
+        self.phase_timings = {}  # type: ignore
 
         start_time_str = self.start_time.strftime("%Y-%m-%d %H:%M:%S UTC")
         self.slack.send_message(
@@ -146,10 +251,73 @@ class SimulationResultBuilder:
     def add_settle_user_fail(self, e: Exception, market_index):
         failed_settles = self.settle_user_fail_reasons.get(market_index, [])
         failed_settles.append(e)
+        self.settle_user_fail_reasons[market_index] = failed_settles
+
+    def add_settle_attempt(self, market_index, attempt_stats):
+        """`attempt_stats` is a `src.settle.SettleAttemptStats`"""
+        attempts = self.settle_attempts.get(market_index, [])
+        attempts.append(attempt_stats)
+        self.settle_attempts[market_index] = attempts
 
     def add_final_settle_results(self, market_index, full_settled_ok):
         self.final_settle_results[market_index] = full_settled_ok
 
+    def add_phase_timing(self, phase: str, seconds: float):
+        self.phase_timings[phase] = self.phase_timings.get(phase, 0) + seconds
+
+    def settle_success_rate(self, market_index) -> Optional[float]:
+        """Share of the users to settle that settled, None if none were"""
+        settled = self.settle_user_success.get(market_index, 0)
+        attempts = self.settle_attempts.get(market_index, [])
+        users = attempts[0].submitted if len(attempts) > 0 else settled
+        return settled / users if users > 0 else None
+
+    def write_results(self, results: ResultsWriter):
+        """Phase timings and settle outcomes as tables of the run's results"""
+        if len(self.phase_timings) > 0:
+            results.write_columns(
+                "phase_timing",
+                {
+                    "phase": np.array(list(self.phase_timings.keys())),
+                    "seconds": np.array(list(self.phase_timings.values())),
+                },
+            )
+
+        attempts = [
+            (market_index, stats)
+            for market_index, market_attempts in self.settle_attempts.items()
+            for stats in market_attempts
+        ]
+        if len(attempts) > 0:
+            results.write_columns(
+                "settle_attempt",
+                {
+                    "market_index": np.array([m for m, _ in attempts]),
+                    "attempt": np.array([s.attempt for _, s in attempts]),
+                    "submitted": np.array([s.submitted for _, s in attempts]),
+                    "succeeded": np.array([s.succeeded for _, s in attempts]),
+                    "failed": np.array([s.failed for _, s in attempts]),
+                    "elapsed": np.array([s.elapsed for _, s in attempts]),
+                },
+            )
+
+        markets = sorted(self.final_settle_results.keys())
+        if len(markets) > 0:
+            rates = [self.settle_success_rate(m) for m in markets]
+            results.write_columns(
+                "settle_result",
+                {
+                    "market_index": np.array(markets),
+                    "settled": np.array(
+                        [self.settle_user_success.get(m, 0) for m in markets]
+                    ),
+                    "success_rate": np.array(
+                        [r if r is not None else np.nan for r in rates]
+                    ),
+                    "ok": np.array([self.final_settle_results[m] for m in markets]),
+                },
+            )
+
     def perp_market_to_tuple(self, market: PerpMarketAccount) -> PerpMarketTuple:
         return PerpMarketTuple(
             market.market_index,
@@ -282,19 +450,36 @@ class SimulationResultBuilder:
         msg += "```\n"
         msgs.append(msg)
 
+        if len(self.phase_timings) > 0:
+            msg = "*Phase timings:*\n"
+            msg += "```\n"
+            for phase, seconds in self.phase_timings.items():
+                msg += f" {phase + ':':<30} {seconds:.2f}s\n"
+            msg += "```\n"
+            msgs.append(msg)
+
         if len(self.settle_user_fail_reasons.keys()) > 0:
             msg = f"*Failed Settle User Reasons:*\n"
             for market_index in self.settle_user_fail_reasons.keys():
-                n_success = self.settle_user_fail_reasons[market_index]
-                n_fail = self.settle_user_success[
-                    market_index
-                ]  # if this > 0 then the program would never succeed
+                n_success = self.settle_user_success.get(market_index, 0)
+                attempts = self.settle_attempts.get(market_index, [])
+                n_fail = (
+                    attempts[-1].failed
+                    if len(attempts) > 0
+                    else len(self.settle_user_fail_reasons[market_index])
+                )
 
                 msg += f"\n*Settled Users Perp Market {market_index}:*\n"
                 msg += "```\n"
                 msg += f" Total users: {self.total_users}\n"
                 msg += f" {n_success}/{self.total_users} users settled successfully ✅\n"
                 msg += f" {n_fail}/{self.total_users} users settled with error ❌\n"
+                for stats in attempts:
+                    msg += f" Attempt {stats.attempt}: "
+                    msg += f"{stats.succeeded}/{stats.submitted} ok in "
+                    msg += f"{stats.elapsed:.2f}s ({stats.throughput:.1f} settles/s)\n"
+                    for reason, count in stats.fail_reasons.most_common():
+                        msg += f"   {count}x {reason}\n"
                 msg += "```\n"
             msgs.append(msg)
 
@@ -349,12 +534,10 @@ class SimulationResultBuilder:
 
     def post_fail(self, msg):
         print(msg)
-        if self.slack.can_send_messages():
-            self.slack.send_message(msg)
+        self.slack.send_message(msg)
 
     def post_result(self):
         msgs = self.build_slack_message()
         for msg in msgs:
             print(msg)
-            if self.slack.can_send_messages():
-                self.slack.send_message(msg)
+            self.slack.send_message(msg)
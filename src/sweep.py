@@ -0,0 +1,196 @@
+"""
+Parameter sweeps over the market-parameter actions. Each sweep point sets
+(imf_factor, upnl_imf_factor, sqrt_k, peg) of one perp market to multiples of
+their cloned values on a fresh validator, optionally runs a stress scenario,
+and records the resulting market and insurance fund state. Points are fanned
+out over `src.runner` workers and collected into one table.
+
+    poetry run python -m src.sweep --markets 9 --method lhs --samples 16 \
+        --imf 0.5,2 --upnl-imf 0.5,2 --sqrt-k 0.8,1.2 --peg 0.95,1.05
+"""
+import argparse
+import itertools
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from driftpy.admin import Admin
+
+from src.actions import UpdateCurveAction, UpdateImfAction, UpdateKAction
+from src.experiments import Simulator
+from src.runner import Scenario, ScenarioFn, market_metrics, run_scenarios
+
+SWEEP_PARAMETERS = ("imf_factor", "upnl_imf_factor", "sqrt_k", "peg")
+
+
+@dataclass
+class ParameterRange:
+    """Multipliers of the market's current value, `points` is for grids only"""
+
+    low: float
+    high: float
+    points: int = 3
+
+
+def grid(ranges: dict[str, ParameterRange]) -> list[dict[str, float]]:
+    names = list(ranges.keys())
+    axes = [np.linspace(r.low, r.high, r.points) for r in ranges.values()]
+    return [
+        dict(zip(names, map(float, values))) for values in itertools.product(*axes)
+    ]
+
+
+def latin_hypercube(
+    ranges: dict[str, ParameterRange], samples: int, seed: Optional[int] = None
+) -> list[dict[str, float]]:
+    """One sample in each of `samples` equal strata of every parameter"""
+    rng = np.random.default_rng(seed)
+    names = list(ranges.keys())
+    strata = np.column_stack([rng.permutation(samples) for _ in names])
+    unit = (strata + rng.random((samples, len(names)))) / samples
+    low = np.array([r.low for r in ranges.values()])
+    high = np.array([r.high for r in ranges.values()])
+    values = low + unit * (high - low)
+    return [dict(zip(names, map(float, row))) for row in values]
+
+
+async def apply_parameters(admin: Admin, market_index: int, multipliers: dict) -> dict:
+    """Runs the actions for `multipliers` and returns the values they set"""
+    await admin.account_subscriber.update_cache()
+    market = admin.get_perp_market_account(market_index)
+    applied = {}
+    sigs = {}
+
+    if "imf_factor" in multipliers or "upnl_imf_factor" in multipliers:
+        imf_multiplier = multipliers.get("imf_factor", 1)
+        upnl_imf_multiplier = multipliers.get("upnl_imf_factor", 1)
+        imf_factor = int(market.imf_factor * imf_multiplier)  # type: ignore
+        upnl_imf_factor = int(market.unrealized_pnl_imf_factor * upnl_imf_multiplier)  # type: ignore
+        action = UpdateImfAction(market_index, imf_factor, upnl_imf_factor)
+        sigs["imf"] = await action.execute(admin)
+        applied.update(imf_factor=imf_factor, upnl_imf_factor=upnl_imf_factor)
+
+    if "sqrt_k" in multipliers:
+        sqrt_k = int(market.amm.sqrt_k * multipliers["sqrt_k"])  # type: ignore
+        sigs["sqrt_k"] = await UpdateKAction(market_index, sqrt_k).execute(admin)
+        applied["sqrt_k"] = sqrt_k
+
+    if "peg" in multipliers:
+        await admin.account_subscriber.update_cache()
+        market = admin.get_perp_market_account(market_index)
+        peg = int(market.amm.peg_multiplier * multipliers["peg"])  # type: ignore
+        sigs["peg"] = await UpdateCurveAction(market_index, peg).execute(admin)
+        applied["peg"] = peg
+
+    return {
+        **{f"set_{name}": value for name, value in applied.items()},
+        **{f"{name}_ok": sig is not None for name, sig in sigs.items()},
+    }
+
+
+async def sweep_point(
+    simulator: Simulator,
+    market_index: int,
+    multipliers: dict,
+    stress: Optional[ScenarioFn] = None,
+) -> dict:
+    admin: Admin = simulator.admin  # type: ignore
+    applied = await apply_parameters(admin, market_index, multipliers)
+    if stress is not None:
+        await stress(admin)
+    return {**applied, **await market_metrics(admin, market_index)}
+
+
+def sweep_scenarios(
+    market_indexes: list[int],
+    points: list[dict[str, float]],
+    stress: Optional[ScenarioFn] = None,
+) -> list[Scenario]:
+    return [
+        Scenario(
+            f"sweep-{market_index}-{i}",
+            sweep_point,
+            {
+                "market_index": market_index,
+                "multipliers": point,
+                "stress": stress,
+            },
+        )
+        for market_index in market_indexes
+        for i, point in enumerate(points)
+    ]
+
+
+def run_sweep(
+    market_indexes: list[int],
+    points: list[dict[str, float]],
+    stress: Optional[ScenarioFn] = None,
+    workers: Optional[int] = None,
+    output: Optional[str] = "sweep_results.csv",
+) -> pd.DataFrame:
+    """Runs every point on every market and returns one row per run"""
+    scenarios = sweep_scenarios(market_indexes, points, stress)
+    results = run_scenarios(scenarios, workers, output=None)
+
+    rows = []
+    for result in results:
+        kwargs = result["kwargs"]
+        row = {
+            "name": result["name"],
+            "market_index": kwargs["market_index"],
+            **{f"{k}_multiplier": v for k, v in kwargs["multipliers"].items()},
+            "ok": result["ok"],
+            "error": result["error"],
+            "elapsed": result["elapsed"],
+        }
+        row.update(result["result"] or {})
+        rows.append(row)
+
+    table = pd.DataFrame(rows)
+    if output is not None:
+        table.to_csv(output, index=False)
+        print(f"sweep results written to {output}")
+    return table
+
+
+def parse_range(value: str, points: int) -> ParameterRange:
+    low, high = [float(v) for v in value.split(",")]
+    return ParameterRange(low, high, points)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--markets", default="9", help="comma separated indexes")
+    parser.add_argument("--method", choices=["grid", "lhs"], default="grid")
+    parser.add_argument("--points", type=int, default=3, help="per axis (grid)")
+    parser.add_argument("--samples", type=int, default=16, help="lhs samples")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="sweep_results.csv")
+    for name in SWEEP_PARAMETERS:
+        flag = "--" + name.replace("_factor", "").replace("_", "-")
+        parser.add_argument(flag, dest=name, help="low,high multipliers")
+    args = parser.parse_args()
+
+    ranges = {
+        name: parse_range(getattr(args, name), args.points)
+        for name in SWEEP_PARAMETERS
+        if getattr(args, name) is not None
+    }
+    if len(ranges) == 0:
+        parser.error("give at least one of --imf, --upnl-imf, --sqrt-k, --peg")
+
+    if args.method == "grid":
+        points = grid(ranges)
+    else:
+        points = latin_hypercube(ranges, args.samples, args.seed)
+
+    markets = [int(m) for m in args.markets.split(",")]
+    run_sweep(markets, points, workers=args.workers, output=args.output)
+
+
+if __name__ == "__main__":
+    main()
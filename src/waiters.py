@@ -0,0 +1,207 @@
+import asyncio
+import inspect
+import time
+
+from typing import Any, Awaitable, Callable, Optional, Union
+from urllib.parse import urlparse
+
+from anchorpy import Program
+
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.commitment import Commitment
+from solana.rpc.websocket_api import connect
+
+from solders.pubkey import Pubkey  # type: ignore
+
+from driftpy.accounts import DataAndSlot, get_account_data_and_slot
+from driftpy.accounts.oracle import get_oracle_decode_fn
+from driftpy.addresses import get_perp_market_public_key, get_spot_market_public_key
+from driftpy.admin import Admin
+from driftpy.types import OracleSource, PerpMarketAccount, SpotMarketAccount
+
+
+class WaitTimeoutError(TimeoutError):
+    pass
+
+
+def ws_url(endpoint: str) -> str:
+    """
+    The pubsub url of an rpc endpoint. Validators serve it on the rpc port + 1
+    (8899 -> 8900), endpoints on the default http(s) port on the same port.
+    """
+    url = urlparse(endpoint)
+    scheme = "wss" if url.scheme == "https" else "ws"
+    netloc = url.netloc
+    if url.port is not None and url.port not in (80, 443):
+        netloc = f"{url.hostname}:{url.port + 1}"
+    return url._replace(scheme=scheme, netloc=netloc).geturl()
+
+
+async def wait_until(
+    check: Callable[[], Union[Any, Awaitable[Any]]],
+    timeout: float = 60.0,
+    poll_interval: float = 0.4,
+    description: str = "condition",
+):
+    """
+    Polls `check` until it returns something truthy and returns that value.
+    Raises `WaitTimeoutError` if it has not held after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            raise WaitTimeoutError(
+                f"timed out after {timeout}s waiting for {description}"
+            )
+        await asyncio.sleep(poll_interval)
+
+
+async def wait_for_slot(
+    connection: AsyncClient, slot: int, timeout: float = 60.0
+) -> int:
+    async def reached():
+        current = (await connection.get_slot()).value
+        return current if current >= slot else None
+
+    return await wait_until(reached, timeout, description=f"slot {slot}")
+
+
+async def wait_for_block_time(
+    connection: AsyncClient, unix_timestamp: int, timeout: float = 120.0
+) -> int:
+    async def reached():
+        slot = (await connection.get_slot()).value
+        block_time = (await connection.get_block_time(slot)).value
+        if block_time is None or block_time < unix_timestamp:
+            return None
+        return block_time
+
+    return await wait_until(
+        reached, timeout, poll_interval=1.0, description=f"block time {unix_timestamp}"
+    )
+
+
+async def wait_for_account(
+    program: Program,
+    pubkey: Pubkey,
+    predicate: Callable[[Any], bool],
+    decode: Optional[Callable[[bytes], Any]] = None,
+    timeout: float = 60.0,
+    poll_interval: float = 0.4,
+    use_websocket: bool = False,
+    commitment: Commitment = "confirmed",
+    description: Optional[str] = None,
+    ws_endpoint: Optional[str] = None,
+) -> DataAndSlot:
+    """
+    Waits until the decoded account at `pubkey` satisfies `predicate` and
+    returns it. Watches the account with `accountSubscribe` when
+    `use_websocket` is set, otherwise polls `getAccountInfo`. `ws_endpoint`
+    defaults to the `ws_url` of the program's rpc endpoint.
+    """
+    description = description or f"account {pubkey}"
+
+    async def fetch_matching():
+        data_and_slot = await get_account_data_and_slot(
+            pubkey, program, commitment, decode
+        )
+        if data_and_slot is not None and predicate(data_and_slot.data):
+            return data_and_slot
+        return None
+
+    if not use_websocket:
+        return await wait_until(fetch_matching, timeout, poll_interval, description)
+
+    decode = decode if decode is not None else program.coder.accounts.decode
+    if ws_endpoint is None:
+        ws_endpoint = ws_url(program.provider.connection._provider.endpoint_uri)
+
+    async def watch():
+        async with connect(ws_endpoint) as ws:  # type: ignore
+            await ws.account_subscribe(
+                pubkey, commitment=commitment, encoding="base64"
+            )
+            await ws.recv()  # subscription id
+
+            # the account may already match from before we subscribed
+            data_and_slot = await fetch_matching()
+            if data_and_slot is not None:
+                return data_and_slot
+
+            async for msg in ws:
+                result = msg[0].result  # type: ignore
+                if result.value is None:
+                    continue
+                data = decode(result.value.data)
+                if predicate(data):
+                    return DataAndSlot(int(result.context.slot), data)
+
+    try:
+        return await asyncio.wait_for(watch(), timeout)
+    except asyncio.TimeoutError:
+        raise WaitTimeoutError(
+            f"timed out after {timeout}s waiting for {description}"
+        )
+
+
+async def wait_for_perp_market(
+    admin: Admin,
+    market_index: int,
+    predicate: Callable[[PerpMarketAccount], bool],
+    timeout: float = 60.0,
+    **kwargs,
+) -> PerpMarketAccount:
+    pubkey = get_perp_market_public_key(admin.program_id, market_index)
+    data_and_slot = await wait_for_account(
+        admin.program,
+        pubkey,
+        predicate,
+        timeout=timeout,
+        description=kwargs.pop("description", f"perp market {market_index}"),
+        **kwargs,
+    )
+    return data_and_slot.data
+
+
+async def wait_for_spot_market(
+    admin: Admin,
+    market_index: int,
+    predicate: Callable[[SpotMarketAccount], bool],
+    timeout: float = 60.0,
+    **kwargs,
+) -> SpotMarketAccount:
+    pubkey = get_spot_market_public_key(admin.program_id, market_index)
+    data_and_slot = await wait_for_account(
+        admin.program,
+        pubkey,
+        predicate,
+        timeout=timeout,
+        description=kwargs.pop("description", f"spot market {market_index}"),
+        **kwargs,
+    )
+    return data_and_slot.data
+
+
+async def wait_for_oracle_price(
+    admin: Admin,
+    oracle: Pubkey,
+    price: int,
+    oracle_source: OracleSource = OracleSource.Pyth(),  # type: ignore
+    timeout: float = 60.0,
+    **kwargs,
+):
+    data_and_slot = await wait_for_account(
+        admin.program,
+        oracle,
+        lambda oracle_price_data: oracle_price_data.price == price,
+        decode=get_oracle_decode_fn(oracle_source),
+        timeout=timeout,
+        description=f"oracle {oracle} price == {price}",
+        **kwargs,
+    )
+    return data_and_slot.data